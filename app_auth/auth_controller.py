@@ -4,6 +4,7 @@ from flask import Flask, request, redirect, session, url_for,Blueprint, jsonify,
 import boto3
 import copy
 import json
+import gzip
 from datetime import datetime
 from common import *
 import uuid
@@ -30,14 +31,9 @@ class AuthController:
         data['user_id'] = self.get_current_user()
         response = self.get_tree_full(**data)
 
-        # Initialize S3 client and define bucket name and file path
-        s3_client = boto3.client('s3')  # Ensure boto3 is imported
-        bucket_name = current_app.config['S3_BUCKET_NAME']  
-        file_path = f'auth/tree/{data["user_id"]}'
-
         # Store the new version in S3
         try:
-            s3_client.put_object(Bucket=bucket_name, Key=file_path, Body=json.dumps(response['document']))
+            self.store_tree(data['user_id'], response['document'])
         except Exception as e:
             current_app.logger.error(f"Failed to upload to S3: {str(e)}")
             return jsonify({"success": False, "message": "Failed to upload to S3", "status": 500}), 500
@@ -45,6 +41,37 @@ class AuthController:
         return response
         
         
+    def store_tree(self,user_id,document):
+        '''
+        Stores the tree document of a user in S3, gzip compressed (Content-Encoding: gzip)
+        '''
+        s3_client = boto3.client('s3')
+        s3_client.put_object(
+            Bucket=current_app.config['S3_BUCKET_NAME'],
+            Key=f'auth/tree/{user_id}',
+            Body=gzip.compress(json.dumps(document).encode('utf-8'), 6),
+            ContentType='application/json',
+            ContentEncoding='gzip'
+        )
+        
+        
+    def load_tree(self,user_id):
+        '''
+        Stored tree document of a user, as stored (one GET, no parsing)
+        
+        @OUT:
+          ok: ((bytes), (Content-Encoding) or None) Trees written before compression have no encoding
+          ko: None if there is no tree yet
+        '''
+        s3_client = boto3.client('s3')
+        try:
+            response = s3_client.get_object(Bucket=current_app.config['S3_BUCKET_NAME'], Key=f'auth/tree/{user_id}')
+        except s3_client.exceptions.NoSuchKey:
+            return None
+        
+        return response['Body'].read(), response.get('ContentEncoding')
+        
+        
         
     
     def get_current_user(self):
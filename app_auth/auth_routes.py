@@ -1,8 +1,9 @@
 #app_auth.py
-from flask import Flask, redirect, request, session, url_for,Blueprint, jsonify, current_app
+from flask import Flask, redirect, request, session, url_for,Blueprint, jsonify, current_app, Response
 from common import *
 import re
 import json
+import gzip
 import boto3
 
 
@@ -276,14 +277,9 @@ def refresh_tree():
     data['user_id'] = get_current_user()
     response = AUC.get_tree_full(**data)
 
-    # Initialize S3 client and define bucket name and file path
-    s3_client = boto3.client('s3')  # Ensure boto3 is imported
-    bucket_name = current_app.config['S3_BUCKET_NAME']  
-    file_path = f'auth/tree/{data["user_id"]}'
-
     # Store the new version in S3
     try:
-        s3_client.put_object(Bucket=bucket_name, Key=file_path, Body=json.dumps(response['document']))
+        AUC.store_tree(data['user_id'], response['document'])
     except Exception as e:
         current_app.logger.error(f"Failed to upload to S3: {str(e)}")
         return jsonify({"success": False, "message": "Failed to upload to S3", "status": 500}), 500
@@ -314,22 +310,29 @@ def get_tree():
     data['user_id'] = get_current_user()
     
     # Check if the document already exists in the S3 bucket
-    s3_client = boto3.client('s3')
-    bucket_name = current_app.config['S3_BUCKET_NAME']  
-    file_path = f'auth/tree/{data["user_id"]}'
-    
     try:
-        s3_client.head_object(Bucket=bucket_name, Key=file_path)
-        # If it exists, return the document from the S3 bucket
-        response = s3_client.get_object(Bucket=bucket_name, Key=file_path)
-        document = json.loads(response['Body'].read())
-        current_app.logger.debug('Tree already exists, retrieving from S3:'+str(document))
-        return jsonify(document), 200
-    except s3_client.exceptions.ClientError:
+        stored = AUC.load_tree(data['user_id'])
+    except Exception as e:
+        current_app.logger.error(f"Failed to read the tree from S3: {str(e)}")
+        stored = None
+    
+    if stored:
+        # If it exists, return the document from the S3 bucket as it is stored
+        body, encoding = stored
+        current_app.logger.debug('Tree already exists, retrieving from S3')
+        response = Response(body, mimetype='application/json')
+        response.vary.add('Accept-Encoding')
+        if encoding == 'gzip':
+            if request.accept_encodings['gzip'] > 0:
+                response.headers['Content-Encoding'] = 'gzip'
+            else:
+                response.set_data(gzip.decompress(body))
+        return response, 200
+    else:
         # If it does not exist, call AUC.get_tree_full()
         current_app.logger.debug('Tree not found in s3, creating new one')
         response = AUC.get_tree_full(**data)
-        s3_client.put_object(Bucket=bucket_name, Key=file_path, Body=json.dumps(response['document']))
+        AUC.store_tree(data['user_id'], response['document'])
     
     if response['success']:
         return jsonify(response['document']), response['status']
@@ -0,0 +1,73 @@
+#blueprint_cache.py
+import copy
+import threading
+import time
+
+
+class BlueprintCache:
+    '''
+    Process wide registry of blueprints (shared by every BlueprintModel in the container).
+
+    Entries are keyed by (irn, version). A 'last' lookup is stored under (irn,'last') and under the
+    version it resolved to. Any write to a blueprint drops every entry of its irn, since a new
+    version changes what 'last' points to. Other containers only see the change once the TTL expires.
+    '''
+
+    def __init__(self):
+
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+
+    def get(self,irn,v):
+
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get((irn,v))
+            if entry and entry[0] > now:
+                self.hits += 1
+                # Callers are free to modify what they get back
+                return copy.deepcopy(entry[1])
+
+            if entry:
+                del self.entries[(irn,v)]
+            self.misses += 1
+            return None
+
+
+    def set(self,irn,v,item,ttl):
+
+        expires = time.monotonic() + ttl
+        item = copy.deepcopy(item)
+        with self.lock:
+            self.entries[(irn,v)] = (expires, item)
+            if v == 'last' and 'version' in item:
+                self.entries[(irn,item['version'])] = (expires, item)
+
+
+    def invalidate(self,irn):
+
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == irn]:
+                del self.entries[key]
+            self.invalidations += 1
+
+
+    def stats(self):
+
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 3) if lookups else None,
+                'invalidations': self.invalidations
+            }
+
+
+
+BLUEPRINT_CACHE = BlueprintCache()
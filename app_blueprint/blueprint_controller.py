@@ -36,6 +36,11 @@ class BlueprintController:
         return self.BPM.get_blueprint(handle,name,v)
 
 
+    def get_cache_stats(self):
+
+        return self.BPM.cache_stats()
+
+
     def update_blueprint(self,handle,name):
         data = request.json
         data['handle'] = handle
@@ -44,6 +49,11 @@ class BlueprintController:
         return self.BPM.update_blueprint(data)
 
 
+    def set_index_flag(self,blueprint,flag,value):
+
+        return self.BPM.set_index_flag(blueprint,flag,value)
+
+
     def delete_blueprint(self,handle,name,v):
 
         return self.BPM.delete_blueprint(handle,name,v)
@@ -6,6 +6,7 @@ from datetime import datetime
 import uuid
 from decimal import Decimal
 from env_config import DYNAMODB_BLUEPRINT_TABLE
+from app_blueprint.blueprint_cache import BLUEPRINT_CACHE
 
 
 class BlueprintModel:
@@ -17,10 +18,23 @@ class BlueprintModel:
             
 
     
+    def irn(self,handle,name):
+        return 'irn:blueprint:' + handle +':'+ name
+
+
+    def invalidate(self,data):
+        # A new or changed version can change what 'last' resolves to
+        if 'handle' in data and 'name' in data:
+            BLUEPRINT_CACHE.invalidate(self.irn(data['handle'],data['name']))
+        if 'irn' in data:
+            BLUEPRINT_CACHE.invalidate(data['irn'])
+
+
     def put_blueprint(self,data):
 
         try:
             self.blueprints_table.put_item(Item=data)
+            self.invalidate(data)
             return jsonify({"message": "Document created", "document": data}), 201
         except ClientError as e:
             return jsonify({"error": e.response['Error']['Message']}), 500
@@ -28,10 +42,13 @@ class BlueprintModel:
 
     def get_blueprint(self,handle,name,v):
 
-        irn = 'irn:blueprint:' + handle +':'+ name
+        irn = self.irn(handle,name)
 
         current_app.logger.debug('Get Blueprint '+irn+' v:'+v)
         
+        item = BLUEPRINT_CACHE.get(irn,v)
+        if item:
+            return item
 
         try:
             if v == 'last':
@@ -51,29 +68,55 @@ class BlueprintModel:
                 item = response.get('Item')
 
             if item:
+                BLUEPRINT_CACHE.set(irn,v,item,current_app.config.get('BLUEPRINT_CACHE_TTL', 300))
                 return item
             else:
                 return {"success":False,"message": "Document not found"}
         except ClientError as e:
             return {"error": e.response['Error']['Message']}
+    
+
+    def cache_stats(self):
+
+        return BLUEPRINT_CACHE.stats()
         
 
     def update_blueprint(self,data):
 
         try:
             self.blueprints_table.put_item(Item=data)
+            self.invalidate(data)
             return jsonify({"message": "Document updated", "document": data})
         except ClientError as e:
             return jsonify({"error": e.response['Error']['Message']}), 500
         
     
+    def set_index_flag(self,blueprint,flag,value):
+        '''
+        Sets indexes.<flag> on a stored blueprint version (e.g. sort_ready after a backfill)
+        '''
+        try:
+            self.blueprints_table.update_item(
+                Key={'irn': blueprint['irn'], 'version': blueprint['version']},
+                UpdateExpression='SET #indexes.#flag = :value',
+                ConditionExpression='attribute_exists(#indexes)',
+                ExpressionAttributeNames={'#indexes': 'indexes', '#flag': flag},
+                ExpressionAttributeValues={':value': value}
+            )
+            self.invalidate(blueprint)
+            return {"success":True}
+        except ClientError as e:
+            return {"error": e.response['Error']['Message']}
+        
+    
     def delete_blueprint(self,handle,name,v):
         
-        pk = 'irn:blueprint:' + handle +':'+ name
+        pk = self.irn(handle,name)
         sk = v
         
         try:
             self.blueprints_table.delete_item(Key={'irn': pk, 'version': sk})
+            BLUEPRINT_CACHE.invalidate(pk)
             return jsonify({"message": "Document deleted"})
         except ClientError as e:
             return jsonify({"error": e.response['Error']['Message']}), 500
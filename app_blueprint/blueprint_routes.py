@@ -69,6 +69,13 @@ def branch_blueprint():
 
   
 
+@app_blueprint.route('/_cache', methods=['GET'])
+def get_cache_stats():
+
+    return jsonify(BPC.get_cache_stats())
+
+  
+
 @app_blueprint.route('/<string:handle>/<string:name>', methods=['GET'])
 def get_blueprint(handle,name):
     if request.args.get("v"):
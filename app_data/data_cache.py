@@ -0,0 +1,173 @@
+#data_cache.py
+import copy
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+
+class LocalSharedTier:
+    '''
+    In process stand-in for the shared tier (tests and local runs).
+
+    A shared tier is any object with get(key) -> bytes or None, set(key, value, ttl) and delete(key).
+    In production it wraps a store every container can reach (Redis, Memcached) and is set in
+    current_app.config['ITEM_CACHE_SHARED'].
+    '''
+
+    def __init__(self):
+
+        self.entries = {}
+        self.lock = threading.Lock()
+
+
+    def get(self,key):
+
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > now:
+                return entry[1]
+            if entry:
+                del self.entries[key]
+            return None
+
+
+    def set(self,key,value,ttl):
+
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+
+
+    def delete(self,key):
+
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+
+class ItemCache:
+    '''
+    Process wide LRU of ring documents (stored rows), keyed by portfolio/org/ring/_id.
+
+    Entries expire after a TTL and the least recently used ones are dropped past max_items.
+    Writes made through this process (put, delete) drop the entry here and in the shared tier.
+    Other containers only see a write once their local entry expires, so keep the TTL short.
+
+    A read that raced with a write must not put the old row back: callers take a ticket() before
+    reading the table and set() skips the local entry if anything was invalidated in between.
+    '''
+
+    def __init__(self):
+
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.skipped = 0
+
+
+    def key(self,portfolio,org,ring,idx):
+
+        return f'{portfolio}/{org}/{ring}/{idx}'
+
+
+    def get(self,key,ttl,max_items,shared=None):
+
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                # Callers are free to modify what they get back
+                return copy.deepcopy(entry[1])
+            if entry:
+                del self.entries[key]
+
+        if shared is not None:
+            try:
+                raw = shared.get(key)
+            except Exception:
+                raw = None
+            if raw is not None:
+                item = pickle.loads(raw)
+                with self.lock:
+                    self.shared_hits += 1
+                # Served locally from now on
+                self.set(key,item,ttl,max_items)
+                return item
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+
+    def ticket(self):
+
+        return self.invalidations
+
+
+    def set(self,key,item,ttl,max_items,shared=None,ticket=None):
+
+        if ttl <= 0:
+            return
+
+        item = copy.deepcopy(item)
+        with self.lock:
+            if ticket is not None and ticket != self.invalidations:
+                self.skipped += 1
+                return
+            self.entries[key] = (time.monotonic() + ttl, item)
+            self.entries.move_to_end(key)
+            while len(self.entries) > max_items:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+        if shared is not None:
+            try:
+                shared.set(key, pickle.dumps(item), ttl)
+            except Exception:
+                pass
+
+
+    def invalidate(self,key,shared=None):
+
+        with self.lock:
+            self.entries.pop(key, None)
+            self.invalidations += 1
+
+        if shared is not None:
+            try:
+                shared.delete(key)
+            except Exception:
+                pass
+
+
+    def clear(self):
+
+        with self.lock:
+            self.entries.clear()
+
+
+    def stats(self):
+
+        with self.lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'hit_ratio': round((self.hits + self.shared_hits) / lookups, 3) if lookups else None,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'skipped': self.skipped
+            }
+
+
+
+ITEM_CACHE = ItemCache()
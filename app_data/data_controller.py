@@ -7,212 +7,495 @@ from datetime import datetime
 import uuid
 import re
 import json, collections
+import base64
+import hashlib
+import hmac
 import boto3
 from decimal import Decimal
 
+from common import DecimalEncoder
 from app_data.data_model import DataModel
+from app_data.data_snapshot import DataSnapshot, SnapshotBuilder, LogBacklog, BuildBusy, project
+from app_data.data_cache import ITEM_CACHE
+from app_data.data_export import ColumnarExport
+from app_data import data_export
+from app_data.data_import import ImportBusy, ImportJob, detect_format
+from app_data import data_geo
+from app_data.data_validator import get_validator, to_timestamp, convert_js_to_json, convert_js_to_json_advanced, convert_js_to_json_robust, convert_js_to_json_simple
 from app_blueprint.blueprint_controller import BlueprintController
 from app_auth.auth_controller import AuthController
 
 
-# Add this custom JSON encoder class at the top level of your file
-class DecimalEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, Decimal):
-            return str(obj)
-        return super(DecimalEncoder, self).default(obj)
+# Operators accepted by get_a_b_query
+QUERY_OPERATORS = ('begins_with','chrono','greater_than','less_than','equal_to','between','time_window','near')
+FILTER_OPERATORS = ('greater_than','less_than','equal_to','between','begins_with')
+
+# Largest time that fits the 13 digits of the time_index
+TIME_INDEX_MAX = 10**13 - 1
+
+# Numbers outside this range share the sort position of the bound
+SORT_NUMBER_MAX = Decimal(10**15) - Decimal('0.000001')
+SORT_NUMBER_MIN = -Decimal(10**15)
+
 
+class DataController:
+
+    def __init__(self,tid=None,ip=None):
 
-def convert_js_to_json(js_string):
-    """
-    Convert JavaScript object syntax to proper JSON format.
-    Handles unquoted property names and single quotes.
-    """
-    if not isinstance(js_string, str):
-        return js_string
+        self.DAM = DataModel(tid=tid,ip=ip)
+        self.DSN = DataSnapshot()
+        self.DSB = SnapshotBuilder(self.DSN)
+        self.DEX = ColumnarExport(self.DSN)
+        self.DIM = ImportJob(self.DSN)
+        self.BPC = BlueprintController(tid=tid,ip=ip)
+        self.AUC = AuthController(tid=tid,ip=ip)
+        
+            
+        
+    def refresh_s3_cache(self,portfolio, org, ring, restart=False):
+        '''
+        Rebuilds the ring snapshot from scratch (full read of the ring, no size limit).
+        Only needed when there is no snapshot yet or when a refresh is forced.
+        Regular writes go through update_s3_cache instead.
+        
+        Large rings don't fit in one invocation. The build stops when its time budget runs out
+        and returns 202. Calling again continues from the checkpoint. 201 means it was published.
+        409 while another call is working on the build.
+        '''
+        
+        current_app.logger.debug(f'Refreshing s3 cache')
+        
+        try:
+            progress = self.DSB.run(
+                portfolio, org, ring,
+                read_pages=lambda cursor: self.read_a_b_pages(portfolio, org, ring, cursor),
+                format_row=self.format_item,
+                restart=restart
+            )
+        except BuildBusy as e:
+            result = {'success':False,'message':'Snapshot build in progress in another call, try again later'}
+            if e.progress:
+                result['progress'] = e.progress
+            return jsonify(result), 409
+        except Exception as e:
+            current_app.logger.error(f'Error in refresh_s3_cache: {str(e)}')
+            return jsonify({'success':False,'message':'Snapshot could not be built','error':str(e)}), 500
+        
+        result = {
+            'success': True,
+            'message': 'Snapshot published' if progress['complete'] else 'Snapshot build in progress, call again to continue',
+            'progress': progress
+        }
+        
+        return jsonify(result), 201 if progress['complete'] else 202
+    
     
-    print(f"Converting JS to JSON - Input: {js_string}")
     
-    # Replace single quotes with double quotes
-    js_string = js_string.replace("'", '"')
+    def export_columnar(self,portfolio, org, ring, full=False):
+        '''
+        Typed Parquet export of the ring next to its snapshot (see data_export.ColumnarExport).
+        Appends the changes since the last export when the snapshot log still covers them,
+        otherwise (or with full) the whole ring is written again. A full export of a large ring
+        takes several calls: 202 while it is in progress, call again to continue.
+        '''
+        if not data_export.available():
+            return {'success':False,'message':'Columnar exports need pyarrow installed'}, 501
+        
+        blueprint = self.BPC.get_blueprint('irma',ring,'last')
+        if 'fields' not in blueprint:
+            return {'success':False,'message':'Blueprint not found','error':blueprint}, 400
+        
+        def read_pages(cursor):
+            # Read from DynamoDB (not the snapshot) so a later call can resume at the cursor
+            for rows, cursor, consumed in self.read_a_b_pages(portfolio, org, ring, cursor):
+                yield [self.format_item(row) for row in rows], cursor
+        
+        current_mark = lambda: self.DSN.current_mark(portfolio, org, ring)
+        
+        try:
+            outcome = self.DEX.export(portfolio, org, ring, blueprint, read_pages, current_mark, full=full)
+        except data_export.ExportBusy as e:
+            return {'success':False,'message':'A full export of this ring is running in another call','error':str(e)}, 409
+        except Exception as e:
+            current_app.logger.error(f'Error in export_columnar: {str(e)}')
+            return {'success':False,'message':'Export could not be written','error':str(e)}, 500
+        
+        if not outcome['complete']:
+            result = {
+                'success':True,
+                'mode':outcome['mode'],
+                'message':'Full export in progress, call again to continue',
+                'written':outcome['written'],
+                'progress':outcome['progress']
+            }
+            return result, 202
+        
+        manifest = outcome['manifest']
+        result = {
+            'success':True,
+            'mode':outcome['mode'],
+            'written':outcome['written'],
+            'manifest':self.DEX.manifest_key(portfolio, org, ring),
+            'parts':[part['key'] for part in manifest['parts']],
+            'rows':manifest['rows'],
+            'bytes':manifest['bytes']
+        }
+        if outcome['progress']:
+            result['progress'] = outcome['progress']
+        
+        return result, 200
     
-    # More robust regex to handle nested objects and arrays
-    # This pattern matches property names that aren't already quoted
-    # and handles various whitespace scenarios
-    import re
     
-    # First, let's handle the most common case: simple property names
-    # This regex looks for word characters that are followed by a colon
-    # but not preceded by a quote
-    pattern = r'([{,])\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*:'
-    replacement = r'\1"\2":'
-    js_string = re.sub(pattern, replacement, js_string)
     
-    # Handle property names at the start of the string (for root objects)
-    pattern = r'^\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*:'
-    replacement = r'"\1":'
-    js_string = re.sub(pattern, replacement, js_string)
+    def export_csv(self,portfolio, org, ring):
+        '''
+        CSV of the whole ring, streamed as the DynamoDB pages arrive (see data_export.CsvExport)
+        
+        @OUT:
+          ok: ((generator of bytes), None, 200)
+          ko: (None, {(error)}, status)
+        '''
+        blueprint = self.BPC.get_blueprint('irma',ring,'last')
+        if 'fields' not in blueprint:
+            return None, {'success':False,'message':'Blueprint not found','error':blueprint}, 400
+        
+        pages = (
+            [self.format_item(row) for row in rows]
+            for rows, cursor, consumed in self.read_a_b_pages(portfolio, org, ring)
+        )
+        
+        return data_export.csv_stream(blueprint, pages), None, 200
     
-    print(f"Converting JS to JSON - Output: {js_string}")
     
-    return js_string
-
-
-def convert_js_to_json_advanced(js_string):
-    """
-    More advanced JavaScript to JSON converter that handles complex cases.
-    """
-    if not isinstance(js_string, str):
-        return js_string
     
-    print(f"Advanced JS to JSON - Input: {js_string}")
+    def import_a_b(self,portfolio, org, ring, upload=None, filename=None, key=None, fmt=None, job_id=None):
+        '''
+        Starts or continues a bulk import (see data_import.ImportJob)
+        
+        @IN:
+          upload = (file object) CSV or JSONL sent with the request, staged under _docs/ first
+          key = (string) S3 key of a file already under _docs/{portfolio}/{org}/
+          fmt = <csv|jsonl> Taken from the file extension if missing
+          job_id = (string) Continues this job
+          
+        @OUT:
+          (progress), 201 when the import is complete, 202 while it needs more calls,
+          409 while another call is working on the job
+        '''
+        blueprint = self.BPC.get_blueprint('irma',ring,'last')
+        if 'fields' not in blueprint:
+            return {'success':False,'message':'Blueprint not found','error':blueprint}, 400
+        
+        if blueprint.get('singleton') is True:
+            return {'success':False,'message':'Singleton rings hold one item, use POST instead'}, 400
+        
+        try:
+            if job_id:
+                job, etag = self.DIM.load(portfolio, org, ring, job_id) if self.is_uuid(job_id) else (None, None)
+                if job is None:
+                    return {'success':False,'message':'Import job not found'}, 404
+                if job['status'] == 'complete':
+                    return {'success':True,'message':'Import complete','progress':self.DIM.progress(job)}, 201
+            
+            else:
+                fmt = detect_format(filename or key, fmt)
+                if fmt is None:
+                    return {'success':False,'message':'Unknown file format, use csv or jsonl'}, 400
+                
+                if upload is not None:
+                    job_id, key = self.DIM.stage(portfolio, org, ring, upload, fmt)
+                elif not key or not key.startswith(f'_docs/{portfolio}/{org}/') or '..' in key:
+                    return {'success':False,'message':f'Expected a file upload or a key under _docs/{portfolio}/{org}/'}, 400
+                
+                job, etag = self.DIM.create(portfolio, org, ring, key, fmt, job_id)
+            
+            write_batch = lambda batch: self.write_import_batch(portfolio, org, ring, blueprint, batch)
+            progress = self.DIM.run(portfolio, org, ring, job, etag, blueprint, write_batch)
+            
+        except ImportBusy as e:
+            result = {'success':False,'message':'Import job in progress in another call, try again later'}
+            if e.progress:
+                result['progress'] = e.progress
+            return result, 409
+        except self.DSN.s3_client.exceptions.ClientError as e:
+            current_app.logger.error(f'Error in import_a_b: {str(e)}')
+            return {'success':False,'message':'Import file could not be read','error':str(e)}, 400
+        except Exception as e:
+            current_app.logger.error(f'Error in import_a_b: {str(e)}')
+            return {'success':False,'message':'Import failed, call again with the job to continue','error':str(e)}, 500
+        
+        result = {
+            'success':True,
+            'message':'Import complete' if progress['complete'] else 'Import in progress, call again with the job to continue',
+            'progress':progress
+        }
+        
+        return result, 201 if progress['complete'] else 202
     
-    # Replace single quotes with double quotes
-    js_string = js_string.replace("'", '"')
     
-    import re
+    def is_uuid(self,value):
+        
+        try:
+            uuid.UUID(str(value))
+            return True
+        except ValueError:
+            return False
     
-    # Handle property names in various contexts
-    # This is a more comprehensive approach
     
-    # Step 1: Handle property names after opening braces and commas
-    js_string = re.sub(r'([{,])\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*:', r'\1"\2":', js_string)
+    def write_import_batch(self,portfolio, org, ring, blueprint, batch):
+        '''
+        Validates and writes one batch of imported rows (same rules as POST)
+        
+        @IN:
+          batch = [((int) row number, (string) _id, (dict) payload)]
+          
+        @OUT:
+          [((int) row number, (string) error)] rows that were not written
+        '''
+        failures = []
+        items = []
+        row_numbers = {}
+        
+        for row_number, idx, entry in batch:
+            if isinstance(entry, ValueError):
+                failures.append((row_number, f'Invalid row: {str(entry)}'))
+                continue
+            if not isinstance(entry, dict):
+                failures.append((row_number, 'Invalid row: expected an object'))
+                continue
+            try:
+                item = self.construct_post_item(portfolio,org,ring,entry,blueprint=blueprint,idx=idx)
+            except Exception as e:
+                failures.append((row_number, f'Invalid item: {str(e)}'))
+                continue
+            items.append(item)
+            row_numbers[item['_id']] = row_number
+        
+        # A batch replayed after a killed run overwrites the rows it already wrote: the stats
+        # only count what the batch really changed, so the rows it replaces are read first
+        previous = {}
+        if items:
+            response = self.DAM.get_a_b_c_batch(portfolio,org,ring,[item['_id'] for item in items])
+            if 'error' in response or response['unprocessed']:
+                current_app.logger.warning('Import batch: previous rows not read, stats may overcount (POST /_stats recounts)')
+            previous = response.get('items', {})
+        
+        written = self.DAM.post_a_b_batch(portfolio,org,ring,items) if items else {}
+        
+        saved = []
+        replaced = []
+        for item in items:
+            outcome = written[item['_id']]
+            if outcome['success']:
+                saved.append(item)
+                if item['_id'] in previous:
+                    replaced.append(previous[item['_id']])
+            else:
+                failures.append((row_numbers[item['_id']], outcome['error']))
+        
+        for item in saved:
+            # A replayed row replaces what the item cache holds for its id
+            self.invalidate_item(portfolio,org,ring,item['_id'])
+        
+        if saved:
+            self.record_stats(portfolio,org,ring,added=saved,removed=replaced,blueprint=blueprint)
+            self.update_s3_cache(portfolio, org, ring, puts=saved)
+        
+        return sorted(failures)
     
-    # Step 2: Handle property names at the very beginning (for root objects)
-    js_string = re.sub(r'^\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*:', r'"\1":', js_string)
     
-    # Step 3: Handle property names after array elements
-    js_string = re.sub(r'([\]}])\s*,\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*:', r'\1,"\2":', js_string)
+    def import_status(self,portfolio, org, ring, job_id):
+        
+        job, etag = self.DIM.load(portfolio, org, ring, job_id) if self.is_uuid(job_id) else (None, None)
+        if job is None:
+            return {'success':False,'message':'Import job not found'}, 404
+        
+        return {'success':True,'progress':self.DIM.progress(job)}, 200
     
-    print(f"Advanced JS to JSON - Output: {js_string}")
     
-    return js_string
-
-
-def convert_js_to_json_robust(js_string):
-    """
-    Robust JavaScript to JSON converter that handles whitespace, newlines, and formatting issues.
-    """
-    if not isinstance(js_string, str):
-        return js_string
     
-    print(f"Robust JS to JSON - Input: {js_string}")
+    def snapshot_status(self,portfolio, org, ring):
+        '''
+        Progress and throughput of the current (or last) snapshot build
+        '''
+        progress = self.DSB.status(portfolio, org, ring)
+        if progress is None:
+            return {'success':False,'message':'This ring has no snapshot build'}, 404
+        
+        return {'success':True,'progress':progress}, 200
     
-    # Replace single quotes with double quotes
-    js_string = js_string.replace("'", '"')
     
-    import re
     
-    # Step 1: Handle property names in various contexts
-    js_string = re.sub(r'([{,])\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*:', r'\1"\2":', js_string)
-    js_string = re.sub(r'^\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*:', r'"\1":', js_string)
-    js_string = re.sub(r'([\]}])\s*,\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*:', r'\1,"\2":', js_string)
+    def stream_s3_cache(self,portfolio, org, ring, fmt='json', fields=None, if_none_match=None, accept_gzip=False):
+        '''
+        Returns a generator that streams the ring snapshot (base + pending deltas) in chunks.
+        On a miss, or when too many deltas are pending to merge them in one request, the ring is
+        streamed straight from DynamoDB and published as the new base.
+        
+        @IN:
+          fmt = <json|ndjson>
+          fields = [(attribute name)] Only send these attributes
+          if_none_match = (werkzeug ETags) of the request
+          accept_gzip = The client takes a gzip response
+          
+        @OUT:
+          ((etag) or None, (generator) or None when the client's copy is current, (Content-Encoding) or None)
+          A stream rebuilt from DynamoDB has no etag (its version is only known once it's published)
+        '''
+        base_etag = None
+        try:
+            opened = self.DSN.stream(portfolio, org, ring, fmt, fields, if_none_match, accept_gzip)
+            if opened is not None:
+                return opened
+            current_app.logger.debug('No snapshot in S3, streaming from DynamoDB')
+        except LogBacklog as e:
+            current_app.logger.info(f'Ring log backlog ({str(e)}), streaming from DynamoDB')
+            base_etag = e.base_etag
+        
+        started_mark = self.DSN.current_mark(portfolio, org, ring)
+        stream, encoding = self.DSN.stream_rebuild(portfolio, org, ring, self.iter_a_b(portfolio, org, ring), started_mark, fmt, fields, accept_gzip, base_etag)
+            
+        return None, stream, encoding
     
-    # Step 2: Clean up whitespace and formatting
-    # Remove trailing commas before closing braces/brackets
-    js_string = re.sub(r',(\s*[}\]])', r'\1', js_string)
     
-    # Clean up excessive whitespace and newlines, but preserve time formats
-    js_string = re.sub(r'\s+', ' ', js_string)
     
-    # Clean up commas and colons, but be careful with time strings
-    # Don't add spaces around colons in time strings (HH:MM:SS or HH:MM)
-    js_string = re.sub(r'\s*,\s*', ', ', js_string)
+    def read_a_b_pages(self,portfolio, org, ring, cursor=None):
+        '''
+        Full read of the ring using parallel segmented queries (see DataModel.get_a_b_segments)
+        
+        @IN:
+          cursor = Resume point returned with an earlier page, None to start from the beginning
+        
+        @OUT:
+          generator of ([(row)], cursor, consumed capacity)
+            cursor resumes the read right after that page. None after the last page.
+        '''
+        depth = current_app.config.get('RING_READ_SEGMENT_DEPTH', 1)
+        workers = current_app.config.get('RING_READ_WORKERS', 8)
+        
+        if cursor:
+            depth = cursor['depth']
+        else:
+            cursor = {'depth':depth,'segment':0,'lastkey':None}
+            
+        last_segment = 16 ** depth - 1
+        
+        pages = self.DAM.get_a_b_segments(
+            portfolio, org, ring,
+            depth=depth,
+            workers=workers,
+            start_segment=cursor['segment'],
+            startkey=cursor['lastkey']
+        )
+        
+        try:
+            for segment, rows, lastkey, consumed in pages:
+                if lastkey:
+                    cursor = {'depth':depth,'segment':segment,'lastkey':lastkey}
+                elif segment < last_segment:
+                    cursor = {'depth':depth,'segment':segment + 1,'lastkey':None}
+                else:
+                    cursor = None
+                    
+                yield rows, cursor, consumed
+        finally:
+            pages.close()
     
-    # Only add spaces around colons that are property separators, not time separators
-    # This regex looks for colons that are followed by a space or closing brace/bracket
-    js_string = re.sub(r'\s*:\s*(?=[^"]*["\d])', ': ', js_string)
     
-    # Step 3: Ensure proper array/object formatting
-    js_string = re.sub(r'\[\s*{', '[{', js_string)
-    js_string = re.sub(r'}\s*\]', '}]', js_string)
-    js_string = re.sub(r'}\s*,', '},', js_string)
     
-    print(f"Robust JS to JSON - Output: {js_string}")
+    def iter_a_b(self,portfolio, org, ring):
+        '''
+        Yields every item in the ring (FE shape) in sort key order
+        '''
+        for rows, cursor, consumed in self.read_a_b_pages(portfolio, org, ring):
+            for row in rows:
+                yield self.format_item(row)
     
-    return js_string
-
-
-def convert_js_to_json_simple(js_string):
-    """
-    Simple and reliable JavaScript to JSON converter.
-    """
-    if not isinstance(js_string, str):
-        return js_string
     
-    print(f"Simple JS to JSON - Input: {js_string}")
     
-    # Replace single quotes with double quotes
-    js_string = js_string.replace("'", '"')
+    def update_s3_cache(self,portfolio, org, ring, puts=None, deletes=None):
+        '''
+        Records a write (puts) or a delete (deletes) in the ring snapshot log.
+        The snapshot is not rebuilt. The delta is folded in by the next compaction.
+        Called by the write methods themselves so callers that skip the routes (schd, agents) are covered.
+        
+        @IN:
+          puts = [{(stored item)}]
+          deletes = [(_id)]
+        '''
+        
+        puts = [self.format_item(row) for row in puts or []]
+        response = self.DSN.append(portfolio, org, ring, puts=puts, deletes=deletes)
+        
+        if not response['success']:
+            # The write already happened. Drop the base so the next read rebuilds it
+            current_app.logger.error(f'Ring log append failed, snapshot will be rebuilt: {response["error"]}')
+            self.DSN.drop(portfolio, org, ring)
+        elif self.DSN.compaction_due(response['key']):
+            self.compact_s3_cache(portfolio, org, ring)
+            
+        return response
     
-    import re
     
-    # Step 1: Handle property names - only target property names, not values
-    # Look for word characters followed by colon that are not inside quotes
-    js_string = re.sub(r'([{,])\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*:', r'\1"\2":', js_string)
-    js_string = re.sub(r'^\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*:', r'"\1":', js_string)
     
-    # Step 2: Remove trailing commas
-    js_string = re.sub(r',(\s*[}\]])', r'\1', js_string)
+    def compact_s3_cache(self,portfolio, org, ring):
+        '''
+        Keeps the ring log short on rings that are written but not read: folds the pending deltas
+        into the base, or (no base yet) moves the snapshot build one budget forward.
+        A failure is logged, the write itself already happened.
+        '''
+        try:
+            if self.DSN.compact(portfolio, org, ring) is None:
+                self.DSB.run(
+                    portfolio, org, ring,
+                    read_pages=lambda cursor: self.read_a_b_pages(portfolio, org, ring, cursor),
+                    format_row=self.format_item,
+                    # A write waits for it, only a page or two per call
+                    budget=current_app.config.get('SNAPSHOT_COMPACT_BUILD_BUDGET', 2)
+                )
+        except BuildBusy:
+            pass
+        except Exception as e:
+            current_app.logger.error(f'Ring log not compacted: {str(e)}')
     
-    # Step 3: Clean up excessive whitespace but preserve formatting
-    js_string = re.sub(r'\s+', ' ', js_string)
     
-    print(f"Simple JS to JSON - Output: {js_string}")
     
-    return js_string
-
-
-class DataController:
-
-    def __init__(self,tid=None,ip=None):
-
-        self.DAM = DataModel(tid=tid,ip=ip)
-        self.BPC = BlueprintController(tid=tid,ip=ip)
-        self.AUC = AuthController(tid=tid,ip=ip)
-        
-            
+    def parse_fields(self,value):
+        '''
+        'a,b,c' (query string) or ['a','b','c'] (JSON body) to a list of attribute names
         
-    def refresh_s3_cache(self,portfolio, org, ring, sort=None):
-    
-        s3_client = boto3.client('s3')
-        bucket_name = current_app.config['S3_BUCKET_NAME']  
-        current_app.logger.debug(f'Refreshing s3 cache')
-        # Proceed to regenerate the document
-        response = []  # Initialize response
-        # Simulate regeneration logic
-        max_iterations = 50
-        limit = 249
-        iterations = 0
-        lastkey = None
+        @OUT:
+          ok: ([(string)] or None if no projection was asked for, None)
+          ko: (None, (error string))
+        '''
+        if not value:
+            return None, None
         
-        file_path = f'data/{portfolio}/{org}/{ring}'
+        if isinstance(value, str):
+            value = value.split(',')
+        if not isinstance(value, list) or not all(isinstance(field, str) for field in value):
+            return None, 'fields must be a list of attribute names'
         
-        while True:
-            iterations += 1
-            current_app.logger.debug("Iteration:" + str(iterations))
-            
-            partial_response = self.get_a_b(portfolio, org, ring, limit, lastkey, sort)
-            response.extend(partial_response['items'])
-            lastkey = partial_response.get('last_id')
-            
-            if lastkey is None or iterations >= max_iterations:
-                break
+        fields = list(dict.fromkeys(field.strip() for field in value if field.strip()))
         
-        result = {
-            "items": response,
-            "last_id": None,
-            "success": True
-        }
+        max_fields = current_app.config.get('PROJECTION_MAX_FIELDS', 100)
+        if len(fields) > max_fields:
+            return None, f'Too many fields (max {max_fields})'
         
-        # Upload to S3
-        s3_client.put_object(
-            Bucket=bucket_name,
-            Key=file_path,
-            Body=json.dumps(result, cls=DecimalEncoder)
-        )
+        return fields or None, None
+    
+    
+    def format_item(self,row):
+        '''
+        Converts a stored row into the shape returned to the FE
+        (attributes at the root + _id, _modified and _index)
+        '''
+        item = dict(row.get('attributes', {}))
+        item['_id'] = row['_id']
+        item['_modified'] = row.get('modified', '')
+        item['_index'] = row.get('path_index', '')
         
-        return jsonify(result), 201  # Return the created result with a 201 status code
+        return item
     
     
     
@@ -362,7 +645,7 @@ class DataController:
 
 
     #TANK-FE *
-    def construct_post_item(self,portfolio,org,ring,payload):
+    def construct_post_item(self,portfolio,org,ring,payload,blueprint=None,idx=None):
         '''
         Creates a new item following the blueprint fields and data submitted via the request.
 
@@ -372,6 +655,8 @@ class DataController:
           org = (string)
           ring= (string)
           payload = (dict)
+          blueprint = (dict) Optional, batch callers fetch it once for all the items
+          idx = (string) Optional _id, imports derive it from the source row so a replay overwrites itself
 
         @OUT:
           ok:(item_id)
@@ -385,107 +670,20 @@ class DataController:
 
         version = 'last'
 
-        blueprint = self.BPC.get_blueprint('irma',ring,version)
-        
-        item_values = {}
-        #rich_values = {}
-        #history_values = {}
-        #flag_values = {}
-        fields = blueprint['fields']
-
+        if blueprint is None:
+            blueprint = self.BPC.get_blueprint('irma',ring,version)
         
         current_app.logger.debug("post_a_b raw arguments from the Form fields:"+str(payload))
-
-
-        for field in fields:
-       
-            #DATA
-
-            current_app.logger.debug(field['name'])
-
-            #Verify submitted field exists in the blueprint
-            new_raw = ''
-            if payload.get(field['name']):  
-                new_raw = payload.get(field['name'])
-                current_app.logger.debug('Using: '+str(field['name'])+':'+str(new_raw))        
-            else:
-                current_app.logger.debug('Inserting default value for field '+str(field['name'])+': '+str(field['default']))
-                # Instead of skipping we put the field's default value
-                new_raw = field['default']
-                
-
-            if field['type'] == 'object':
-                try:
-                    if isinstance(new_raw, dict):
-                        item_values[field['name']] = new_raw
-                    else:
-                        item_values[field['name']] = json.loads(new_raw.strip())
-                except:
-                    if new_raw == '':
-                        item_values[field['name']] = {}
-                    else:
-                        item_values[field['name']] = str(new_raw).strip()
-                    
-            
-            elif field['type'] == 'array':
-                try:
-                    if isinstance(new_raw, list):
-                        item_values[field['name']] = new_raw
-                    else:
-                        item_values[field['name']] = json.loads(new_raw.strip())
-                except Exception as e:
-                    print('CPI > Blueprint : Type : array > Load json > Except > Load String ')
-                    print(f'CPI > Blueprint : Type : array > Error details: {str(e)}')
-                    print(f'CPI > Blueprint : Type : array > Error type: {type(e).__name__}')
-                    if new_raw == '':
-                        item_values[field['name']] = []
-                    else:
-                        item_values[field['name']] = str(new_raw).strip()
-                    
-                    
-            elif field['type'] == 'timestamp':
-                new_raw = new_raw.strip()
-                try:
-                    # Check if new_raw can be converted to a float first
-                    float_value = float(new_raw)
-                    # Convert to int and check if it's a valid timestamp
-                    timestamp_value = int(float_value)
-
-                    # Check if it's a valid timestamp (non-negative)
-                    if timestamp_value >= 0:
-                        # If the timestamp is in seconds, convert to milliseconds
-                        if timestamp_value < 1000000000:  # Less than 1 billion means it's in seconds
-                            timestamp_value *= 1000
-                        item_values[field['name']] = timestamp_value  # Assign the valid timestamp
-                    else:
-                        item_values[field['name']] = None  # Handle negative timestamp
-                except (ValueError, OverflowError):
-                    # If not a valid float or int, try to parse it as a date
-                    try:
-                        date_value = datetime.strptime(new_raw, '%Y-%m-%d')  # Adjusted format for "YYYY-MM-DD"
-                        item_values[field['name']] = int(date_value.timestamp() * 1000)  # Convert to milliseconds
-                    except ValueError:
-                        item_values[field['name']] = None  # Handle invalid date format
-            
-            elif field['type'] == 'string':
-                if new_raw:
-                    item_values[field['name']] = str(new_raw).strip()
-                else:
-                    item_values[field['name']] = ''
-                
-            else:
-                if new_raw:
-                    item_values[field['name']] = str(new_raw).strip()
-                else:
-                    item_values[field['name']] = None
-                    
-                    
-            item_values[field['name']] = self.sanitize(item_values[field['name']])
+        
+        # Fields are interpreted once per blueprint version, not once per item
+        item_values = get_validator(blueprint).coerce_post(payload)
 
 
         item = {}
+        
+        added = datetime.now()
 
-        item['added'] = datetime.now().isoformat()
+        item['added'] = added.isoformat()
         item['modified'] = datetime.now().isoformat()
         item['license'] = 'CC BY'
         item['public'] = False
@@ -494,11 +692,12 @@ class DataController:
         item['org'] = org
         item['ring'] = ring
         item['blueprint_version'] = blueprint['version']
+        item['version'] = 1
 
         if 'singleton' in blueprint and blueprint['singleton'] is True:
             item['_id'] = "00000000-0000-0000-0000-000000000000"
         else:   
-            item['_id'] = str(uuid.uuid4())
+            item['_id'] = idx or str(uuid.uuid4())
             
         item['attributes'] = item_values  
         
@@ -508,6 +707,14 @@ class DataController:
             item['path_index'] = index_string
         elif 'path_index' in item:
             del item['path_index']
+            
+        item['time_index'] = self.generate_time_index(blueprint,org,ring,item['_id'],item_values,added)
+        
+        geo_index = self.generate_geo_index(blueprint,org,ring,item['_id'],item_values)
+        if geo_index:
+            item['geo_index'] = geo_index
+            
+        item.update(self.generate_sort_index(blueprint,portfolio,org,ring,item['_id'],item_values))
         
 
         return item
@@ -516,9 +723,10 @@ class DataController:
     #TANK-FE *
     def construct_put_item(self,portfolio,org,ring,idx,payload):
         '''
-        Creates an updated item based on an existing item following the blueprint .
+        Creates a partial item following the blueprint.
         Notice that the payload contains only the fields that have been changed.
-        This function completes the rest of the item based on the existing document.
+        The existing document is not read: only the changed attributes are returned
+        and the model applies them in a single conditional update.
 
         @NOTES:
           - "request.url" are the arguments that come via url
@@ -534,153 +742,47 @@ class DataController:
           idx = (string)
 
         @OUT:
-          ok:(item_id)
-          ko:False
-
-        @COLLATERAL:
-          - Update document in DB
+          ok:{'_id':(item_id),'attributes':{(changed attributes)}}
+          ko:{'error':(string)}
 
         '''
 
-        #1. Pull the document that we need to update
-        updated_item = self.DAM.get_a_b_c(portfolio,org,ring,idx) 
-        #current_app.logger.debug('Item from DB:'+str(updated_item))
+        #1. Start from an empty document, only the changed attributes are sent to the DB
+        updated_item = {'_id':idx,'attributes':{}}
 
         #2. Pull the Blueprint listed in that document
   
         version = 'last'
 
         blueprint = self.BPC.get_blueprint('irma',ring,version)
-        fields = blueprint['fields']
 
-        #3. Convert incoming request payload to JSON
-   
-        #current_app.logger.debug('CPI Payload:'+str(payload))
-        #print(f"CPI TYPE:{type(payload).__name__}")
-        #current_app.logger.debug(blueprint['fields']) 
-
-        #4. Check that the payload follows the Blueprint
-        putNeeded = False
-
-        for field in fields:
-            current_app.logger.debug('>>:'+field['name']) 
-            if payload.get(field['name']): 
-                current_app.logger.debug('Found:'+field['name']) 
-                # Attribute exists in the blueprint
-                new_raw = payload.get(field['name'])
-
-               
-                if field['type'] == 'object':
-                    print('CPI > Blueprint : Type : object ')
-                    
-                    # Check if new_raw is already a dict
-                    if isinstance(new_raw, dict):
-                        #print('CPI > Blueprint : Type : object > Already dict, using as is')
-                        updated_item['attributes'][field['name']] = new_raw
-                        putNeeded = True
-                    else:
-                        try:
-                            #print('CPI > Blueprint : Type : object > Load json ')
-                            updated_item['attributes'][field['name']] = json.loads(new_raw.strip())
-                            putNeeded = True
-                        except:
-                            #print('CPI > Blueprint : Type : object > Load json > Except > Load String ')
-                            updated_item['attributes'][field['name']] = str(new_raw).strip()
-                            putNeeded = True
+        #3. Check that the payload follows the Blueprint
+        attributes, error = get_validator(blueprint).coerce_put(payload)
+        if error:
+            current_app.logger.debug(error)
+            return {'error':error}
+        
+        #4. Only the attributes sent in the request are updated
+        updated_item['attributes'] = attributes
+        
+        # The time_index follows the chrono field (if it is one of the changes)
+        chrono = (blueprint.get('indexes') or {}).get('chrono')
+        if chrono and chrono in attributes:
+            ms = to_timestamp(attributes[chrono])
+            if ms is not None:
+                updated_item['time_index'] = self.format_time_index(org,ring,idx,ms)
                 
-                elif field['type'] == 'array':
-                    print('CPI > Blueprint : Type : array ')
-                    
-                    # Check if new_raw is already a list
-                    if isinstance(new_raw, list):
-                        #print('CPI > Blueprint : Type : array > Already list, using as is')
-                        updated_item['attributes'][field['name']] = new_raw
-                        putNeeded = True
-                    else:
-                        try:
-                            #print('CPI > Blueprint : Type : array > Load json ')
-                            updated_item['attributes'][field['name']] = json.loads(new_raw.strip())  
-                            putNeeded = True
-                        except json.JSONDecodeError as e:
-                            print('CPI > Blueprint : Type : array > Load json > JSONDecodeError > Try converting JS syntax')
-                            print(f'CPI > Blueprint : Type : array > Error details: {str(e)}')
-                            # Try converting JavaScript syntax to JSON
-                            try:
-                                converted_json = convert_js_to_json(new_raw.strip())
-                                updated_item['attributes'][field['name']] = json.loads(converted_json)
-                                putNeeded = True
-                                print('CPI > Blueprint : Type : array > Successfully converted JS syntax to JSON')
-                            except Exception as conversion_error:
-                                print('CPI > Blueprint : Type : array > JS conversion failed, trying advanced converter')
-                                print(f'CPI > Blueprint : Type : array > Conversion error: {str(conversion_error)}')
-                                # Try the advanced converter
-                                try:
-                                    converted_json = convert_js_to_json_advanced(new_raw.strip())
-                                    updated_item['attributes'][field['name']] = json.loads(converted_json)
-                                    putNeeded = True
-                                    print('CPI > Blueprint : Type : array > Successfully converted JS syntax to JSON (advanced)')
-                                except Exception as advanced_error:
-                                    print('CPI > Blueprint : Type : array > Advanced conversion failed, trying robust converter')
-                                    print(f'CPI > Blueprint : Type : array > Advanced error: {str(advanced_error)}')
-                                    # Try the robust converter
-                                    try:
-                                        converted_json = convert_js_to_json_robust(new_raw.strip())
-                                        updated_item['attributes'][field['name']] = json.loads(converted_json)
-                                        putNeeded = True
-                                        print('CPI > Blueprint : Type : array > Successfully converted JS syntax to JSON (robust)')
-                                    except Exception as robust_error:
-                                        print('CPI > Blueprint : Type : array > Robust conversion failed, trying simple converter')
-                                        print(f'CPI > Blueprint : Type : array > Robust error: {str(robust_error)}')
-                                        # Try the simple converter
-                                        try:
-                                            converted_json = convert_js_to_json_simple(new_raw.strip())
-                                            updated_item['attributes'][field['name']] = json.loads(converted_json)
-                                            putNeeded = True
-                                            print('CPI > Blueprint : Type : array > Successfully converted JS syntax to JSON (simple)')
-                                        except Exception as simple_error:
-                                            print('CPI > Blueprint : Type : array > Simple conversion failed, falling back to string')
-                                            print(f'CPI > Blueprint : Type : array > Simple error: {str(simple_error)}')
-                                            updated_item['attributes'][field['name']] = str(new_raw).strip()
-                                            putNeeded = True
-                        except Exception as e:
-                            print('CPI > Blueprint : Type : array > Load json > Except > Load String ')
-                            print(f'CPI > Blueprint : Type : array > Error details: {str(e)}')
-                            print(f'CPI > Blueprint : Type : array > Error type: {type(e).__name__}')
-                            updated_item['attributes'][field['name']] = str(new_raw).strip()
-                            putNeeded = True
+        sort_field = self.sort_field(blueprint)
+        if sort_field and sort_field in attributes:
+            updated_item.update(self.generate_sort_index(blueprint,portfolio,org,ring,idx,attributes))
                 
-                else:
-                    
-                    '''
-                        len>0  |  field['required']  | AND   |  (len > 0) OR (AND)
-                        ---------------------------------------------
-                        True   |   False             | False |  True
-                        ---------------------------------------------
-                        True   |   True              | True  |  True
-                        ---------------------------------------------
-                        False  |   False             | True  |  -
-                        ---------------------------------------------
-                        False  |   True              | False |  False
-
-                    '''
-
-                    if len(str(new_raw)) > 0 or (len(str(new_raw)) and field['required']):
-
-                        current_app.logger.debug('Field OK:'+field['name']) 
-                        #Attribute complies with "Required" prerequisite
-
-                        #5.Update attributes based on what has been sent in the request
-                        updated_item['attributes'][field['name']] = new_raw
-                        putNeeded = True
-
-                        #break
-
-                    else:
-                        current_app.logger.debug('Attribute is required:'+field['name']) 
-                        return {'error':'Attribute is required'}
-                  
-        if not putNeeded:
-            return {'error':'Attributes not recognized'}
+        # With both coordinates in the payload the geo_index goes in the same update,
+        # otherwise put_a_b_c fixes it from the updated item
+        geo = self.geo_fields(blueprint)
+        if geo and geo[0] in attributes and geo[1] in attributes:
+            geo_index = self.generate_geo_index(blueprint,org,ring,idx,attributes)
+            if geo_index:
+                updated_item['geo_index'] = geo_index
         
         
         # DEPRECATED (Update the index string.)
@@ -694,13 +796,7 @@ class DataController:
             del updated_item['path_index']
         '''
 
-        #6. Return to save document to DB
-        #updated_item['modified'] = datetime.now().isoformat()
-        #print('CPI > OUTPUT:')
-        #print(updated_item)
-        
-        updated_item = self.sanitize(updated_item)
-
+        #5. Return to save document to DB (the validator already sanitized the values)
         return updated_item
     
     #DEPRECATED
@@ -827,27 +923,99 @@ class DataController:
             'portfolio':<portfolio_id>,
             'org':<org_id>,
             'ring':<ring_id>,
-            'operator':<begins_with|chrono|greater_than|less_than|equal_to>,
-            'value':<value>,
+            'operator':<begins_with|chrono|greater_than|less_than|equal_to|between|time_window|near>,
+            'value':<value>,  ([<from>,<to>] for between, {'from':<time>,'to':<time>} for time_window,
+                               {'lat':<lat>,'lon':<lon>,'radius':<meters>} for near)
             'filter':{
-                   'operator':<greater_than|less_than>,
+                   'operator':<greater_than|less_than|equal_to|between|begins_with>,
                    'field':<field_to_filter_on>,
                    'value':<value_filter_uses_on_the_field>
                 },
             'limit':<page_limit>,
             'lastkey':<page_lastkey>,
-            'sort': <asc|desc>
+            'sort': <asc|desc>,
+            'fields': 'a,b,c' or [<attribute>]  (optional, only return these attributes)
             }
+            
+        sort is the order of the index: 'asc' ascending, 'desc' descending. Index queries are
+        ascending by default, time_window is newest first unless sort is 'asc'.
+        Range operators compare the index as a string, numeric index values need a fixed width.
+        time_window uses the time_index: items in [from, to).
+        Times are epoch seconds/milliseconds or 'YYYY-MM-DD', either end can be left out.
+        near returns the items within radius of a point (blueprint indexes.geo), closest first,
+        with their '_distance' in meters. It is not paginated, 'limit' caps the results.
+        'filter' can also be a list of clauses (all must match). A clause without 'field' applies
+        to the part of the index after 'value' (only with begins_with and chrono).
+        
+        @OUT:
+          ok: {'success':True,'items':[{(item)}],'last_id':(cursor for the next page) or None}, 200
+          ko: {'success':False,'message':(string)}, 400
         '''
         
         
         #prefix = f'irn:h_index:{org}:{ring}:{index_tail}'
         
         if 'operator' not in query or not query['operator']:
-            return {'success':False,'message':'No query'}
+            return {'success':False,'message':'No query'}, 400
             
         operator = query['operator']
-        #portfolio_index = f'irn:data:{query["portfolio"]}'
+        
+        if operator not in QUERY_OPERATORS:
+            return {'success':False,'message':f'Unknown operator: {operator}'}, 400
+        
+        if operator in ('greater_than','less_than','equal_to') and query.get('value') in (None,''):
+            return {'success':False,'message':f'{operator} needs a value'}, 400
+        
+        if operator == 'between' and not self.is_pair(query.get('value')):
+            return {'success':False,'message':'between needs a value like [<from>,<to>]'}, 400
+        
+        query = dict(query)
+        
+        query['fields'], error = self.parse_fields(query.get('fields'))
+        if error:
+            return {'success':False,'message':error}, 400
+        
+        if operator == 'near':
+            return self.get_a_b_near(query)
+        
+        if operator == 'time_window':
+            window = self.parse_time_window(query.get('value'))
+            if not window:
+                return {'success':False,'message':"time_window needs a value like {'from':<time>,'to':<time>}"}, 400
+            query['window'] = window
+        
+        if query.get('lastkey'):
+            lastkey = self.decode_lastkey(query['lastkey'],query['portfolio'],query['org'],query['ring'])
+            if not lastkey:
+                return {'success':False,'message':'Invalid lastkey'}, 400
+            query['lastkey'] = lastkey
+        
+        # Filter clauses on attributes go to DynamoDB as a FilterExpression
+        query['filters'] = []
+        clauses = query.get('filter') or []
+        if isinstance(clauses, dict):
+            clauses = [clauses]
+            
+        for clause in clauses:
+            if not isinstance(clause, dict) or clause.get('operator') not in FILTER_OPERATORS:
+                return {'success':False,'message':'Invalid filter'}, 400
+            
+            if clause.get('field'):
+                normalized, error = self.normalize_filter(query['ring'],clause)
+                if error:
+                    return {'success':False,'message':error}, 400
+                query['filters'].append(normalized)
+                continue
+            
+            # No field: the clause is a range on the rest of the index
+            if operator not in ('begins_with','chrono') or clause['operator'] == 'begins_with':
+                return {'success':False,'message':'A filter without field needs begins_with or chrono and a range operator'}, 400
+            if clause['operator'] == 'between' and not self.is_pair(clause.get('value')):
+                return {'success':False,'message':'between needs a value like [<from>,<to>]'}, 400
+            
+            query['prefix'] = query.get('value')
+            query['value'] = clause.get('value')
+            operator = clause['operator']
            
         # SWITCH   
         # The index begins with ...         
@@ -856,28 +1024,37 @@ class DataController:
             response = self.DAM.get_a_b_beginswith(query)
             
         # The index is a timestamp, return results in chronological order
-        if operator=='chrono':
+        elif operator=='chrono':
             
             response = self.DAM.get_a_b_beginswith(query)
         
-        # The index is numeric, return anything greater than ...
-        if operator=='greater_than':
+        # Return anything greater than ...
+        elif operator=='greater_than':
             
             response = self.DAM.get_a_b_greaterthan(query)
         
-        # The index is numeric, return anything less than ...
-        if operator=='less_than':
+        # Return anything less than ...
+        elif operator=='less_than':
             
             response = self.DAM.get_a_b_lessthan(query)
         
         # The index is equal to ...
-        if operator=='equal_to':
+        elif operator=='equal_to':
             
             response = self.DAM.get_a_b_equalto(query)
             
+        # The index is between two values (both included)
+        elif operator=='between':
+            
+            response = self.DAM.get_a_b_between(query)
+            
+        # Created (or blueprint chrono field) in [from, to)
+        elif operator=='time_window':
+            
+            response = self.DAM.get_a_b_timewindow(query)
+            
             
         items = []
-        #response = self.DAM.get_a_b(portfolio,org,ring,limit=limit,lastkey=lastkey)
         result = {}
         if 'error' in response:
             current_app.logger.error(response['error'])
@@ -886,66 +1063,342 @@ class DataController:
             result['message'] = 'Items could not be retrieved'
             result['error'] = response['error']
             status = 400
-            return result
+            return result, status
 
-        i=0
+        # ExclusiveStartKey already skips the last item of the previous page
         for row in response['items']:
-
-            i += 1
-               
-            if query['lastkey'] and i==1:
-                #If lastkey was sent, ignore first item 
-                #as it was the last item in the last page
-                continue
-            
-            item = {}
-            item = row['attributes']
-            item['_id'] = row['_id']
-
-            if 'modified' in row:
-                item['_modified'] = row['modified']
-            else:
-                item['_modified'] = ''
-                
-            if 'path_index' in row:
-                item['_index'] = row['path_index']
-            else:
-                item['_index'] = ''
-
-            if item:
-                items.append(item)
-                
-        
-        last_id = response['lastkey']
+            items.append(self.format_item(row))
+                       
+        try:
+            last_id = self.encode_lastkey(response['lastkey']) if response['lastkey'] else None
+        except ValueError as e:
+            current_app.logger.error(str(e))
+            return {'success':False,'message':'Next page cursor could not be created','error':str(e)}, 500
                        
-        
         result['success'] = True
         result['items'] = items
         result['last_id'] = last_id
         
-        current_app.logger.debug('NUMBER OF ITEMS (QUERY):'+str(i))
+        current_app.logger.debug('NUMBER OF ITEMS (QUERY):'+str(len(items)))
+        
+        return result, 200
+    
+    
+    def get_a_b_near(self,query):
+        '''
+        Proximity search on the geo_index.
+        The cell of the point and its 8 neighbours are queried in parallel (keys only), candidates
+        whose cell is out of range are dropped, the rest are fetched in batch and ranked by distance.
+        '''
+        value = query.get('value')
+        if not isinstance(value, dict):
+            return {'success':False,'message':"near needs a value like {'lat':<lat>,'lon':<lon>,'radius':<meters>}"}, 400
+        
+        point = data_geo.to_coordinates(value.get('lat'), value.get('lon'))
+        if not point:
+            return {'success':False,'message':'Invalid lat/lon'}, 400
+        
+        max_radius = current_app.config.get('GEO_MAX_RADIUS', 50000)
+        try:
+            radius = float(value.get('radius'))
+        except (TypeError, ValueError):
+            return {'success':False,'message':'near needs a radius in meters'}, 400
+        if not 0 < radius <= max_radius:
+            return {'success':False,'message':f'radius must be between 0 and {max_radius} meters'}, 400
+        
+        if query.get('filter'):
+            return {'success':False,'message':'near does not support filters'}, 400
+        
+        blueprint = self.BPC.get_blueprint('irma',query['ring'],'last')
+        geo = self.geo_fields(blueprint)
+        if not geo:
+            return {'success':False,'message':'The blueprint has no geo index (indexes.geo)'}, 400
+        lat_field, lon_field = geo
+        
+        lat, lon = point
+        prefixes = data_geo.covering_prefixes(lat, lon, radius)
+        
+        response = self.DAM.get_a_b_geo_candidates(
+            query['portfolio'],query['org'],query['ring'],prefixes,
+            max_items=current_app.config.get('GEO_MAX_CANDIDATES', 5000)
+        )
+        if 'error' in response:
+            current_app.logger.error(response['error'])
+            return {'success':False,'message':'Items could not be retrieved','error':response['error']}, 400
+        
+        # A stored cell is ~5m wide, its center is never further than this from the item
+        margin = 10
+        ids = [
+            _id for _id, geohash in response['candidates']
+            if data_geo.distance(lat, lon, *data_geo.decode(geohash)) <= radius + margin
+        ]
+        
+        rows = self.DAM.get_a_b_c_batch(query['portfolio'],query['org'],query['ring'],ids) if ids else {'items':{},'unprocessed':[]}
+        if 'error' in rows:
+            current_app.logger.error(rows['error'])
+            return {'success':False,'message':'Items could not be retrieved','error':rows['error']}, 400
+        
+        ranked = []
+        for row in rows['items'].values():
+            attributes = row.get('attributes', {})
+            position = data_geo.to_coordinates(attributes.get(lat_field), attributes.get(lon_field))
+            if not position:
+                continue
+            meters = data_geo.distance(lat, lon, *position)
+            if meters <= radius:
+                ranked.append((meters, row))
+        
+        ranked.sort(key=lambda entry: entry[0])
+        
+        items = []
+        for meters, row in ranked[:query['limit']]:
+            item = self.format_item(row)
+            if query.get('fields'):
+                item = project(item, query['fields'])
+            item['_distance'] = round(meters, 1)
+            items.append(item)
+            
+        result = {
+            'success':True,
+            'items':items,
+            'last_id':None,
+            # Some candidates were not looked at, a smaller radius gives complete results
+            'truncated':response['truncated'] or bool(rows['unprocessed'])
+        }
+        
+        current_app.logger.debug('NUMBER OF ITEMS (NEAR):'+str(len(items)))
+        
+        return result, 200
+    
+    
+    def geo_fields(self,blueprint):
+        '''
+        @OUT:
+          ok: ((string) lat field, (string) lon field)
+          ko: None  The blueprint doesn't declare indexes.geo
+        '''
+        geo = (blueprint.get('indexes') or {}).get('geo')
+        if not isinstance(geo, dict) or not geo.get('lat') or not geo.get('lon'):
+            return None
+        return geo['lat'], geo['lon']
+    
+    
+    def generate_geo_index(self,blueprint,org,ring,_id,item_values):
+        '''
+        geo_index = <org>:<ring>:<geohash>:<_id>
+        None if the blueprint has no geo index or the item has no valid coordinates
+        '''
+        geo = self.geo_fields(blueprint)
+        if not geo:
+            return None
+        
+        point = data_geo.to_coordinates(item_values.get(geo[0]), item_values.get(geo[1]))
+        if not point:
+            return None
+        
+        return f'{org}:{ring}:{data_geo.encode(*point)}:{_id}'
+    
+    
+    def parse_time_window(self,value):
+        '''
+        @IN:
+          value = {'from':(time),'to':(time)} or [(time),(time)]  None leaves that end open
+          
+        @OUT:
+          ok: ((int) from ms, (int) to ms)
+          ko: None
+        '''
+        if isinstance(value, dict):
+            bounds = [value.get('from'), value.get('to')]
+        elif isinstance(value, list) and len(value) == 2:
+            bounds = value
+        elif value in (None,''):
+            bounds = [None, None]
+        else:
+            return None
+        
+        window = []
+        for bound, open_end in zip(bounds, (0, TIME_INDEX_MAX)):
+            if bound in (None,''):
+                window.append(open_end)
+                continue
+            ms = to_timestamp(bound)
+            if ms is None:
+                return None
+            window.append(min(ms, TIME_INDEX_MAX))
+        
+        if window[0] > window[1]:
+            return None
+        
+        return tuple(window)
+    
+    
+    def generate_time_index(self,blueprint,org,ring,_id,item_values,added):
+        '''
+        time_index = <org>:<ring>:<ms, 13 digits>:<_id> 
+        The time is the blueprint's indexes.chrono field (a timestamp field) or when the item was added
+        
+        @IN:
+          added = (datetime)
+        '''
+        ms = None
+        chrono = (blueprint.get('indexes') or {}).get('chrono')
+        if chrono:
+            ms = to_timestamp(item_values.get(chrono))
+        if ms is None:
+            ms = int(added.timestamp() * 1000)
+            
+        return self.format_time_index(org,ring,_id,ms)
+    
+    
+    def format_time_index(self,org,ring,_id,ms):
+        
+        # Fixed width so string order is time order
+        ms = max(0, min(int(ms), TIME_INDEX_MAX))
+        return f'{org}:{ring}:{ms:013d}:{_id}'
+    
+    
+    def is_pair(self,value):
+        
+        return isinstance(value, list) and len(value) == 2 and all(v not in (None,'') for v in value)
+    
+    
+    def normalize_filter(self,ring,clause):
+        '''
+        Filter values are converted to the type the field is stored with,
+        otherwise DynamoDB never matches them (a number is never equal to a string)
+        
+        @OUT:
+          ok: ({'field','operator','value'}, None)
+          ko: (None, (error string))
+        '''
+        blueprint = self.BPC.get_blueprint('irma',ring,'last')
+        kinds = {field['name']:field.get('type') for field in blueprint.get('fields',[])}
+        
+        field = clause['field']
+        if field not in kinds:
+            return None, f'Unknown filter field: {field}'
+        
+        kind = kinds[field]
+        if kind in ('object','array'):
+            return None, f'Can not filter on {kind} field: {field}'
+        
+        if clause['operator'] == 'between':
+            if not self.is_pair(clause.get('value')):
+                return None, 'between needs a value like [<from>,<to>]'
+            values = clause['value']
+        else:
+            if clause.get('value') in (None,''):
+                return None, f'Filter on {field} needs a value'
+            values = [clause['value']]
+        
+        converted = []
+        for value in values:
+            if kind == 'timestamp':
+                value = to_timestamp(value)
+                if value is None:
+                    return None, f'Invalid timestamp for {field}'
+            elif isinstance(value, bool):
+                pass
+            elif isinstance(value, (int, float)):
+                # Numbers sent as numbers are compared as numbers
+                value = Decimal(str(value))
+            else:
+                value = str(value).strip()
+            converted.append(value)
+            
+        normalized = {
+            'field':field,
+            'operator':clause['operator'],
+            'value':converted if clause['operator'] == 'between' else converted[0]
+        }
+        
+        return normalized, None
+    
+    
+    def cursor_signature(self,payload):
+        '''
+        HMAC of a cursor payload with CURSOR_SECRET (SECRET_KEY if it is not set).
+        Raises ValueError without a key: cursors signed with an empty one could be forged
+        '''
+        secret = current_app.config.get('CURSOR_SECRET') or current_app.config.get('SECRET_KEY')
+        if not secret:
+            raise ValueError('No CURSOR_SECRET configured, paginated reads are disabled')
+        
+        secret = str(secret).encode('utf-8')
+        digest = hmac.new(secret, payload.encode('ascii'), hashlib.sha256).digest()[:16]
+        return base64.urlsafe_b64encode(digest).decode('ascii').rstrip('=')
+    
+    
+    def encode_lastkey(self,lastkey):
+        '''
+        LastEvaluatedKey (base table, LSI or GSI, every key attribute kept) to an opaque cursor string,
+        signed (see cursor_signature) so clients can't point a query at keys they made up.
+        Raises ValueError if no key is configured
+        '''
+        raw = json.dumps(lastkey, separators=(',',':'), sort_keys=True, cls=DecimalEncoder)
+        payload = base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+        return payload + '.' + self.cursor_signature(payload)
+    
+    
+    def decode_lastkey(self,cursor,portfolio,org,ring):
+        '''
+        Cursor back to the ExclusiveStartKey. Only signed keys inside the ring being queried are accepted
+        
+        @OUT:
+          ok: {(key)}
+          ko: None
+        '''
+        if not isinstance(cursor, str):
+            return None
+        
+        payload, _, signature = cursor.partition('.')
+        try:
+            if not hmac.compare_digest(signature, self.cursor_signature(payload)):
+                return None
+        except ValueError as e:
+            current_app.logger.error(str(e))
+            return None
+        
+        try:
+            raw = base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4))
+            lastkey = json.loads(raw)
+        except (ValueError, TypeError):
+            return None
+        
+        if not isinstance(lastkey, dict) or not all(isinstance(v, str) for v in lastkey.values()):
+            return None
+        if lastkey.get('portfolio_index') != f'irn:data:{portfolio}':
+            return None
+        if not lastkey.get('doc_index','').startswith(f'{org}:{ring}:'):
+            return None
+        
+        return lastkey
         
-        return result
         
         
 
 
     #TANK-FE *
-    def get_a_b(self,portfolio,org,ring,limit=1000,lastkey=None,sort=None):
+    def get_a_b(self,portfolio,org,ring,limit=1000,lastkey=None,sort=None,fields=None):
         '''
         Get page of items
 
         @NOTES:
-          - The "human" parameter determines whether ids or labels are returned as keys
+          - "sort" is a field name, optionally followed by ':asc' or ':desc' (desc by default).
+            The blueprint's sort field (indexes.sort) is read in order from the sort_index once
+            the ring has been backfilled (see backfill_sort_index), pages continue each other.
+            Any other field only sorts the items of the page.
+            Items without a value come last in both directions.
 
         @IN:
           portfolio = (string)
           org = (string)
           ring = (string)
           limit = (integer)
-          lastkey = (string)
-          endkey = (string)
+          lastkey = (string) last_id of the previous page
           sort = (string)
+          fields = (string) 'a,b,c' Only return these attributes
 
         @OUT:
           [{(item)}]
@@ -953,12 +1406,29 @@ class DataController:
         '''
        
         items = []
-
-        response = self.DAM.get_a_b(portfolio,org,ring,limit=limit,lastkey=lastkey)
+        result = {}
+        
+        fields, error = self.parse_fields(fields)
+        if error:
+            return {'success':False,'message':error}
+        
+        field, descending = self.parse_sort(sort)
         
-        #current_app.logger.debug(f'RRR2: {result}')
+        if field and field == self.sort_ready(self.BPC.get_blueprint('irma',ring,'last')):
+            return self.get_a_b_sorted(portfolio,org,ring,field,limit,lastkey,descending,fields)
+        
+        read_fields = fields
+        if field and fields and field not in fields:
+            # The page is sorted after the read, the field is dropped again before returning
+            read_fields = fields + [field]
+            
+        if lastkey:
+            lastkey = self.page_lastkey(lastkey,portfolio,org,ring)
+            if not lastkey:
+                return {'success':False,'message':'Invalid lastkey'}
 
-        result = {}
+        response = self.DAM.get_a_b(portfolio,org,ring,limit=limit,lastkey=lastkey,fields=read_fields)
+        
         if 'error' in response:
             current_app.logger.error(response['error'])
             
@@ -968,53 +1438,250 @@ class DataController:
             status = 400
             return result
 
-        i=0
+        # ExclusiveStartKey already skips the last item of the previous page
         for row in response['items']:
-
-            i += 1
-               
-            if lastkey and i==1:
-                #If lastkey was sent, ignore first item 
-                #as it was the last item in the last page
-                continue
-            
-            item = {}
-            item = row['attributes']
-            item['_id'] = row['_id']
-
-            if 'modified' in row:
-                item['_modified'] = row['modified']
-            else:
-                item['_modified'] = ''
-                
-            if 'path_index' in row:
-                item['_index'] = row['path_index']
-            else:
-                item['_index'] = ''
-
-            if item:
-                items.append(item)
-                
-        '''result = {
-                'items': items,
-                'lastkey': endkey  # This will be passed as 'lastkey' in the next call if needed
-            }'''
+            items.append(self.format_item(row))
                     
-        last_id = response['last_id']
+        try:
+            last_id = self.encode_lastkey(response['lastkey']) if response['lastkey'] else None
+        except ValueError as e:
+            current_app.logger.error(str(e))
+            return {'success':False,'message':'Next page cursor could not be created','error':str(e)}
                       
-        if len(items)>1 and sort:
-            items = sorted(items, key=lambda item: item[sort], reverse=True)
+        if len(items)>1 and field:
+            # Items without the field go after the sorted ones whatever the direction
+            keyed = [(self.sortable(item.get(field)), item) for item in items]
+            items = [item for key, item in sorted((k for k in keyed if k[0] is not None), key=lambda k: k[0], reverse=descending)]
+            items += [item for key, item in keyed if key is None]
             
+        if read_fields is not fields:
+            items = [project(item,fields) for item in items]
         
         result['success'] = True
         result['items'] = items
         result['last_id'] = last_id
         
-        current_app.logger.debug('NUMBER OF ITEMS:'+str(i))
+        current_app.logger.debug('NUMBER OF ITEMS:'+str(len(items)))
         
         return result
     
+    
+    def page_lastkey(self,cursor,portfolio,org,ring):
+        '''
+        ExclusiveStartKey of a ring listing. Also takes the bare _id clients kept from before
+        cursors were signed (it can only point inside this ring)
+        '''
+        if '.' not in cursor and self.is_uuid(cursor):
+            return {'portfolio_index':f'irn:data:{portfolio}','doc_index':f'{org}:{ring}:{cursor}'}
+        return self.decode_lastkey(cursor,portfolio,org,ring)
+    
+    
+    def get_a_b_sorted(self,portfolio,org,ring,field,limit,lastkey,descending,fields=None):
+        '''
+        Page of the ring in the order of its sort field. last_id is an opaque keyset cursor.
+        The items with a value are read first (in the requested direction), then the ones without it.
+        '''
+        result = {}
+        
+        values_partition = self.sort_partition(portfolio,org,ring,field)
+        empty_partition = self.sort_partition(portfolio,org,ring,field,empty=True)
+        partition = values_partition
+        
+        if lastkey:
+            lastkey = self.decode_lastkey(lastkey,portfolio,org,ring)
+            if not lastkey or lastkey.get('sort_partition') not in (values_partition, empty_partition):
+                return {'success':False,'message':'Invalid lastkey'}
+            partition = lastkey['sort_partition']
+        
+        read_fields = fields
+        if fields and field not in fields:
+            # The cursor of the last value is rebuilt from it, the field is dropped again before returning
+            read_fields = fields + [field]
+        
+        rows = []
+        while True:
+            response = self.DAM.get_a_b_sorted(partition,limit=limit-len(rows),lastkey=lastkey,
+                                               descending=descending and partition == values_partition,fields=read_fields)
+            
+            if 'error' in response:
+                current_app.logger.error(response['error'])
+                
+                result['success'] = False
+                result['message'] = 'Items could not be retrieved'
+                result['error'] = response['error']
+                return result
+            
+            rows += response['items']
+            lastkey = response['lastkey']
+            if lastkey or partition == empty_partition or len(rows) >= limit:
+                break
+            # Values are exhausted, the page goes on with the items without one
+            partition = empty_partition
+        
+        if not lastkey and partition == values_partition and rows:
+            # The page ended right at the last value: the cursor points there so the next page
+            # finds no more values and goes on with the empty partition
+            lastkey = {
+                'portfolio_index':f'irn:data:{portfolio}',
+                'doc_index':f'{org}:{ring}:{rows[-1]["_id"]}',
+                'sort_partition':values_partition,
+                'sort_index':self.sortable(rows[-1].get('attributes',{}).get(field))
+            }
+        
+        try:
+            last_id = self.encode_lastkey(lastkey) if lastkey else None
+        except ValueError as e:
+            current_app.logger.error(str(e))
+            return {'success':False,'message':'Next page cursor could not be created','error':str(e)}
+        
+        result['success'] = True
+        result['items'] = [self.format_item(row) for row in rows]
+        if read_fields is not fields:
+            result['items'] = [project(item,fields) for item in result['items']]
+        result['last_id'] = last_id
+        
+        current_app.logger.debug('NUMBER OF ITEMS (SORTED):'+str(len(result['items'])))
+        
+        return result
+    
+    
+    def parse_sort(self,sort):
+        '''
+        'field', 'field:asc' or 'field:desc'
+        
+        @OUT:
+          ((string) field or None, (bool) descending)
+        '''
+        if not sort:
+            return None, True
+        
+        field, _, direction = sort.partition(':')
+        return field, direction != 'asc'
+    
+    
+    def sort_field(self,blueprint):
+        '''
+        Field declared in indexes.sort (one per ring, it is materialized in the sort_index)
+        '''
+        field = (blueprint.get('indexes') or {}).get('sort')
+        if isinstance(field, list):
+            field = field[0] if field else None
+        return field or None
+    
+    
+    def sort_ready(self,blueprint):
+        '''
+        Sort field whose sort_index can be read: the blueprint flags it in indexes.sort_ready
+        once backfill_sort_index went through the items written before the field was declared
+        '''
+        field = self.sort_field(blueprint)
+        if field and (blueprint.get('indexes') or {}).get('sort_ready') == field:
+            return field
+        return None
+    
+    
+    def sort_partition(self,portfolio,org,ring,field,empty=False):
+        '''
+        sort_partition of the items with a value for the field, or of the ones without it (empty)
+        '''
+        partition = f'{portfolio}:{org}:{ring}:{field}'
+        return partition + ':_empty' if empty else partition
+    
+    
+    def sortable(self,value):
+        '''
+        String whose order is the order of the values: numbers (fixed point, 6 decimals) < strings.
+        Numbers sent as strings (most field types are stored as strings) sort as numbers.
+        None for empty/missing values, they are kept apart so they come last in both directions.
+        '''
+        if value is None or value == '' or isinstance(value, (dict, list)):
+            return None
+        
+        if not isinstance(value, bool):
+            try:
+                number = Decimal(str(value).strip())
+                if number.is_finite():
+                    number = min(max(number, SORT_NUMBER_MIN), SORT_NUMBER_MAX)
+                    # Shifted so every number is positive and has the same width
+                    return 'n' + format((number - SORT_NUMBER_MIN).quantize(Decimal('0.000001')), '023.6f')
+            except ArithmeticError:
+                pass
+            
+        # GSI sort keys are limited to 1024 bytes
+        return 's' + str(value)[:256]
+    
+    
+    def generate_sort_index(self,blueprint,portfolio,org,ring,idx,item_values):
+        '''
+        sort_partition = <portfolio>:<org>:<ring>:<field>, sort_index = sortable value.
+        Items without a value go to <portfolio>:<org>:<ring>:<field>:_empty, sort_index = _id
+        
+        @OUT:
+          ok: {'sort_partition':(string),'sort_index':(string)}
+          ko: {} The blueprint has no sort field
+        '''
+        field = self.sort_field(blueprint)
+        if not field:
+            return {}
+        
+        sort_index = self.sortable(item_values.get(field))
+        if sort_index is None:
+            return {'sort_partition': self.sort_partition(portfolio,org,ring,field,empty=True), 'sort_index': idx}
+        
+        return {'sort_partition': self.sort_partition(portfolio,org,ring,field), 'sort_index': sort_index}
+
+
+    def backfill_sort_index(self,portfolio,org,ring):
+        '''
+        Writes the sort keys of the items saved before the blueprint declared its sort field
+        (or with an older sort_index format). When the whole ring went through, the blueprint is
+        flagged indexes.sort_ready and get_a_b starts reading from the sort_index.
+        Items written while it runs already carry their keys and are skipped. Safe to run again.
+        '''
+        blueprint = self.BPC.get_blueprint('irma',ring,'last')
+        field = self.sort_field(blueprint)
+        if not field:
+            return {'success':False,'message':'The blueprint has no sort field'}, 400
+
+        checked = 0
+        updated = 0
+        failed = 0
+        try:
+            for rows, cursor, consumed in self.read_a_b_pages(portfolio,org,ring):
+                for row in rows:
+                    checked += 1
+                    keys = self.generate_sort_index(blueprint,portfolio,org,ring,row['_id'],row.get('attributes',{}))
+                    if row.get('sort_partition') == keys['sort_partition'] and row.get('sort_index') == keys['sort_index']:
+                        continue
+
+                    response = self.DAM.set_sort_index(portfolio,org,ring,row['_id'],keys['sort_partition'],keys['sort_index'],row.get('modified'))
+                    if 'error' not in response:
+                        updated += 1
+                    elif not response.get('skipped'):
+                        current_app.logger.error(response['error'])
+                        failed += 1
+        except Exception as e:
+            current_app.logger.error(str(e))
+            return {'success':False,'message':'Ring could not be read','error':str(e)}, 400
+
+        result = {'field':field,'checked':checked,'updated':updated,'failed':failed}
+        if failed:
+            result['success'] = False
+            result['message'] = 'Some items could not be indexed, the sort_index stays off'
+            return result, 400
+
+        response = self.BPC.set_index_flag(blueprint,'sort_ready',field)
+        if 'error' in response:
+            current_app.logger.error(response['error'])
+            result['success'] = False
+            result['message'] = 'Items indexed but the blueprint could not be flagged'
+            result['error'] = response['error']
+            return result, 400
 
+        result['success'] = True
+        result['message'] = 'Sort index ready'
+        return result, 200
+    
 
     #TANK-FE *
     def post_a_b(self,portfolio,org,ring,payload):
@@ -1028,6 +1695,8 @@ class DataController:
             current_app.logger.debug('Prepared Item:'+str(item))
 
             response = self.DAM.post_a_b(portfolio,org,ring,item)
+            # Singletons reuse the same _id
+            self.invalidate_item(portfolio,org,ring,item['_id'])
 
             result = {}
             status = 0
@@ -1038,6 +1707,10 @@ class DataController:
                 result['path'] = str(portfolio+'/'+org+'/'+ring+'/'+item['_id'])
                 result['item'] = item
                 status = 200
+                # A singleton overwrites the previous document instead of adding one
+                previous = [response['previous']] if response.get('previous') else []
+                self.record_stats(portfolio,org,ring,added=[item],removed=previous)
+                self.update_s3_cache(portfolio,org,ring,puts=[item])
 
             else:
                 result['success'] = False
@@ -1060,17 +1733,112 @@ class DataController:
             return result, status
 
 
+
+    def post_a_b_batch(self,portfolio,org,ring,payload):
+        '''
+        Creates many items in one call.
+        The blueprint is fetched once and the items are written with BatchWriteItem (25 per call).
+        
+        @IN:
+          payload = [{(item)}] or {'items':[{(item)}]}
+          
+        @OUT:
+          {
+            'success':(bool), 'message':(string), 'saved':(int), 'failed':(int),
+            'results':[{'index':(position in payload),'success':(bool),'path'|'error':(string),'item':{(item)}}]
+          }
+          status: 200 all saved, 207 some saved, 400 none saved
+        '''
+        
+        if isinstance(payload, dict):
+            payload = payload.get('items')
+            
+        if not isinstance(payload, list) or not payload:
+            return {'success':False,'message':'Expected a non empty list of items'}, 400
+        
+        max_items = current_app.config.get('BATCH_WRITE_MAX_ITEMS', 5000)
+        if len(payload) > max_items:
+            return {'success':False,'message':f'Too many items in one batch (max {max_items})'}, 413
+        
+        blueprint = self.BPC.get_blueprint('irma',ring,'last')
+        if 'fields' not in blueprint:
+            return {'success':False,'message':'Blueprint not found','error':blueprint}, 400
+        
+        if blueprint.get('singleton') is True:
+            return {'success':False,'message':'Singleton rings hold one item, use POST instead'}, 400
+        
+        results = []
+        items = []
+        
+        for index, entry in enumerate(payload):
+            try:
+                if not isinstance(entry, dict):
+                    raise ValueError('Item must be an object')
+                item = self.construct_post_item(portfolio,org,ring,entry,blueprint=blueprint)
+                items.append(item)
+                results.append({'index':index,'_id':item['_id']})
+            except Exception as e:
+                results.append({'index':index,'success':False,'error':f'Invalid item: {str(e)}'})
+        
+        written = self.DAM.post_a_b_batch(portfolio,org,ring,items)
+        by_id = {item['_id']:item for item in items}
+        
+        saved = 0
+        for result in results:
+            if 'success' in result:
+                continue
+            
+            idx = result.pop('_id')
+            outcome = written[idx]
+            if outcome['success']:
+                result['success'] = True
+                result['path'] = str(portfolio+'/'+org+'/'+ring+'/'+idx)
+                result['item'] = by_id[idx]
+                saved += 1
+            else:
+                result['success'] = False
+                result['error'] = outcome['error']
+                
+        failed = len(results) - saved
+        current_app.logger.debug(f'Batch POST {portfolio}/{org}/{ring}: {saved} saved, {failed} failed')
+        
+        if saved:
+            # One stats update and one log delta for the whole batch
+            saved_items = [result['item'] for result in results if result['success']]
+            self.record_stats(portfolio,org,ring,added=saved_items,blueprint=blueprint)
+            self.update_s3_cache(portfolio,org,ring,puts=saved_items)
+        
+        if not failed:
+            return {'success':True,'message':'Items saved (BATCH)','saved':saved,'failed':0,'results':results}, 200
+        
+        status = 207 if saved else 400
+        return {'success':bool(saved),'message':'Some items could not be saved' if saved else 'Items could not be saved','saved':saved,'failed':failed,'results':results}, status
+
+    
     
     #TANK-FE *
     def get_a_b_c(self,portfolio,org,ring,idx):
         '''
         Gets an existing item
         '''   
+        result, version = self.get_a_b_c_versioned(portfolio,org,ring,idx)
+        return result
+    
+    
+    def get_a_b_c_versioned(self,portfolio,org,ring,idx):
+        '''
+        Same as get_a_b_c plus the stored version, which is only sent as the ETag header
+        (the body keeps the shape callers round-trip into PUTs)
+        
+        @OUT:
+          ({(item)}, (int) version or None if the item could not be read)
+        '''
         current_app.logger.debug('IDX:'+str(idx))
         
-        response = self.DAM.get_a_b_c(portfolio,org,ring,idx)
+        response = self.get_stored_item(portfolio,org,ring,idx)
 
         result = {}
+        version = None
 
         if 'error' in response:                    
             result['success'] = False
@@ -1098,29 +1866,136 @@ class DataController:
             else:
                 result['_index'] = ''
             
-            
-            if 'modified' in response:
-                result['_modified'] = response['modified']
-            else:
-                result['_modified'] = ''
+            version = int(response.get('version', 0))
         
         
 
         current_app.logger.debug('Returned object:'+str(result))
         
-        return result
+        return result, version
     
 
 
+    def item_cache_settings(self):
+        '''
+        @OUT:
+          ((int) ttl in seconds, 0 disables the cache, (int) max items, shared tier or None)
+        '''
+        return (
+            current_app.config.get('ITEM_CACHE_TTL', 30),
+            current_app.config.get('ITEM_CACHE_MAX_ITEMS', 1000),
+            current_app.config.get('ITEM_CACHE_SHARED')
+        )
+    
+    
+    def get_stored_item(self,portfolio,org,ring,idx):
+        '''
+        Stored row of a document, served from the item cache when it is warm (see data_cache.ItemCache)
+        '''
+        ttl, max_items, shared = self.item_cache_settings()
+        if ttl <= 0:
+            return self.DAM.get_a_b_c(portfolio,org,ring,idx)
+        
+        key = ITEM_CACHE.key(portfolio,org,ring,idx)
+        item = ITEM_CACHE.get(key,ttl,max_items,shared=shared)
+        if item is not None:
+            return item
+        
+        ticket = ITEM_CACHE.ticket()
+        response = self.DAM.get_a_b_c(portfolio,org,ring,idx)
+        if 'error' not in response:
+            ITEM_CACHE.set(key,response,ttl,max_items,shared=shared,ticket=ticket)
+        
+        return response
+    
+    
+    def invalidate_item(self,portfolio,org,ring,idx):
+        '''
+        Drops a document from the item cache (this process and the shared tier) after a write
+        '''
+        ttl, max_items, shared = self.item_cache_settings()
+        ITEM_CACHE.invalidate(ITEM_CACHE.key(portfolio,org,ring,idx),shared=shared)
+    
+    
+    def get_cache_stats(self):
+        
+        return ITEM_CACHE.stats()
+    
+    
+    
+    def get_a_b_c_batch(self,portfolio,org,ring,payload):
+        '''
+        Gets many existing items in one call
+        
+        @IN:
+          payload = {'ids':[(_id)]} or [(_id)]
+          
+        @OUT:
+          {
+            'success':True,
+            'items':[{(item)}]  Same shape as get_a_b_c, in the order the ids were requested
+            'missing':[(_id)]   Ids that don't exist
+            'unprocessed':[(_id)]  Ids DynamoDB kept throttling (retry them)
+          }
+        '''
+        
+        ids = payload.get('ids') if isinstance(payload, dict) else payload
+        
+        if not isinstance(ids, list) or not all(isinstance(idx, str) and idx for idx in ids):
+            return {'success':False,'message':'Expected a list of ids'}, 400
+        
+        max_ids = current_app.config.get('BATCH_GET_MAX_IDS', 1000)
+        if len(ids) > max_ids:
+            return {'success':False,'message':f'Too many ids in one call (max {max_ids})'}, 413
+        
+        # BatchGetItem rejects duplicated keys
+        unique_ids = list(dict.fromkeys(ids))
+        
+        response = self.DAM.get_a_b_c_batch(portfolio,org,ring,unique_ids)
+        
+        if 'error' in response:
+            current_app.logger.error(response['error'])
+            return {'success':False,'message':'Items could not be retrieved','error':response['error']}, 400
+        
+        unprocessed = set(response['unprocessed'])
+        items = []
+        missing = []
+        for idx in unique_ids:
+            if idx in response['items']:
+                items.append(self.format_item(response['items'][idx]))
+            elif idx not in unprocessed:
+                missing.append(idx)
+        
+        result = {
+            'success':True,
+            'items':items,
+            'missing':missing,
+            'unprocessed':response['unprocessed']
+        }
+        
+        return result, 200
+    
+    
+    
     #TANK-FE *
-    def put_a_b_c(self,portfolio,org,ring,idx,payload):
+    def put_a_b_c(self,portfolio,org,ring,idx,payload,if_match=None):
         '''
         Partial updates to an existing document. 
         FE only needs to send the field to be updated. No need to send the entire document.
+        
+        @IN:
+          if_match = (string) Value of the If-Match header. The update is rejected with 409
+                     if the document has been updated since that version was read.
         '''
         #1. 
 
         result = {}
+        
+        expected_version = None
+        if if_match:
+            expected_version = self.parse_etag(if_match)
+            if expected_version is False:
+                return {'success':False,'message':'Invalid If-Match header'}, 400
 
         #current_app.logger.debug('Icoming put object:'+str(payload))
         item = self.construct_put_item(portfolio,org,ring,idx,payload)
@@ -1131,10 +2006,11 @@ class DataController:
             result['message'] = 'Item could not be saved'
             result['error'] = item['error']
             status = 400
-            return result
+            return result,status
     
         current_app.logger.debug('Updating Item:'+str(item))
-        response = self.DAM.put_a_b_c(portfolio,org,ring,idx,item)
+        response = self.DAM.put_a_b_c(portfolio,org,ring,idx,item,expected_version=expected_version)
+        self.invalidate_item(portfolio,org,ring,idx)
         
         #current_app.logger.debug('Update response:'+str(response))
 
@@ -1143,19 +2019,269 @@ class DataController:
             result['success'] = True
             result['message'] = 'Item saved (PUT)'
             result['path'] = str(portfolio+'/'+org+'/'+ring+'/'+idx)
+            result['version'] = response['version']
+            # Full document after the update (feeds the snapshot delta)
+            result['item'] = response['item']
+            self.sync_geo_index(portfolio,org,ring,idx,item,response['item'])
+            self.record_stats(portfolio,org,ring,added=[response['item']],removed=[response['previous']])
+            self.update_s3_cache(portfolio,org,ring,puts=[response['item']])
             status = 200
             current_app.logger.debug('Returned object:'+str(result)) ## COMMENT OUT
 
             return result,status
+        
+        elif response.get('conflict'):
+            result['success'] = False
+            result['message'] = 'Item was modified by someone else'
+            result['error'] = response['error']
+            result['version'] = response['version']
+            status = 409
+            
+        elif response.get('not_found'):
+            result['success'] = False
+            result['message'] = 'Item could not be saved'
+            result['error'] = response['error']
+            status = 404
 
         else:
             result['success'] = False
             result['message'] = 'Item could not be saved'
             result['error'] = response['error']
             status = 500
-            current_app.logger.debug('Returned object:'+str(result))
+            
+        current_app.logger.debug('Returned object:'+str(result))
 
-            return result,status
+        return result,status
+    
+    
+    
+    def sync_geo_index(self,portfolio,org,ring,idx,item,row):
+        '''
+        After an update that touched only one coordinate (or made them invalid)
+        the geo_index is recomputed from the updated document
+        '''
+        if 'geo_index' in item:
+            return
+        
+        blueprint = self.BPC.get_blueprint('irma',ring,'last')
+        geo = self.geo_fields(blueprint)
+        if not geo or not (geo[0] in item['attributes'] or geo[1] in item['attributes']):
+            return
+        
+        attributes = row.get('attributes', {})
+        geo_index = self.generate_geo_index(blueprint,org,ring,idx,attributes)
+        if geo_index == row.get('geo_index'):
+            return
+        
+        coordinates = {field:attributes.get(field) for field in geo}
+        response = self.DAM.set_geo_index(portfolio,org,ring,idx,geo_index,coordinates)
+        if 'error' in response:
+            current_app.logger.error('geo_index not updated:'+response['error'])
+            return
+        
+        if geo_index:
+            row['geo_index'] = geo_index
+        else:
+            row.pop('geo_index', None)
+    
+    
+    def aggregate_fields(self,blueprint):
+        '''
+        Numeric fields declared in the blueprint's 'aggregates' list (count, sum, min and max are kept)
+        '''
+        fields = blueprint.get('aggregates') or []
+        return [field for field in fields if isinstance(field, str) and field]
+    
+    
+    def numeric(self,value):
+        '''
+        Stored value as a Decimal (most field types are stored as strings). None if it isn't a number
+        '''
+        if value is None or isinstance(value, (bool, dict, list)):
+            return None
+        try:
+            number = Decimal(str(value).strip())
+        except ArithmeticError:
+            return None
+        return number if number.is_finite() else None
+    
+    
+    def stats_change(self,fields,added,removed):
+        '''
+        What some rows coming in and going out do to the ring stats
+        
+        @IN:
+          added, removed = [{(row)}] Stored rows (with 'attributes')
+          
+        @OUT:
+          {(field):{'count','sum','low','high','removed_low','removed_high'}} only fields that changed
+        '''
+        changes = {}
+        for field in fields:
+            new = [self.numeric(row.get('attributes', {}).get(field)) for row in added]
+            old = [self.numeric(row.get('attributes', {}).get(field)) for row in removed]
+            new = [value for value in new if value is not None]
+            old = [value for value in old if value is not None]
+            
+            # Same value before and after an update: nothing to do
+            if sorted(new) == sorted(old):
+                continue
+            
+            changes[field] = {
+                'count': len(new) - len(old),
+                'sum': sum(new, Decimal(0)) - sum(old, Decimal(0)),
+                'low': min(new) if new else None,
+                'high': max(new) if new else None,
+                'removed_low': min(old) if old else None,
+                'removed_high': max(old) if old else None
+            }
+        
+        return changes
+    
+    
+    def record_stats(self,portfolio,org,ring,added=(),removed=(),blueprint=None):
+        '''
+        Keeps the ring stats in line after a write. A failure is logged, the write itself already happened
+        (POST /_stats recounts the ring)
+        '''
+        try:
+            if blueprint is None:
+                blueprint = self.BPC.get_blueprint('irma',ring,'last')
+            fields = self.stats_change(self.aggregate_fields(blueprint),added,removed)
+            count = len(added) - len(removed)
+            
+            if not count and not fields:
+                return
+            
+            response = self.DAM.update_stats(portfolio,org,ring,count,fields)
+            if 'error' in response:
+                current_app.logger.error('Ring stats not updated:'+response['error'])
+        except Exception as e:
+            current_app.logger.error('Ring stats not updated:'+str(e))
+    
+    
+    def record_tombstone(self,portfolio,org,ring,idx):
+        '''
+        Leaves a tombstone for incremental backups. A failure is logged, the item is already gone
+        (the next full backup won't have it either)
+        '''
+        try:
+            response = self.DAM.put_tombstone(portfolio,org,ring,idx,current_app.config.get('TOMBSTONE_TTL_DAYS', 35))
+            if 'error' in response:
+                current_app.logger.error('Tombstone not saved:'+response['error'])
+        except Exception as e:
+            current_app.logger.error('Tombstone not saved:'+str(e))
+    
+    
+    def get_stats(self,portfolio,org,ring):
+        '''
+        Item count and aggregates of a ring (one read)
+        
+        @OUT:
+          {
+            'success':True,
+            'count':(int),
+            'fields':{(field):{'count','sum','avg','min','max','exact'}},  exact is False when a bound 
+                                                                             may be outdated (POST /_stats fixes it)
+            'updated':(string)
+          }
+        '''
+        response = self.DAM.get_stats(portfolio,org,ring)
+        if 'error' in response:
+            current_app.logger.error(response['error'])
+            return {'success':False,'message':'Stats could not be retrieved','error':response['error']}, 400
+        
+        stats = response['stats']
+        if not stats:
+            return {'success':False,'message':'This ring has no stats yet. POST to /_stats to count it'}, 404
+        
+        blueprint = self.BPC.get_blueprint('irma',ring,'last')
+        
+        fields = {}
+        for field in self.aggregate_fields(blueprint):
+            count = int(stats.get(f'count_{field}', 0))
+            total = stats.get(f'sum_{field}', Decimal(0))
+            fields[field] = {
+                'count':count,
+                'sum':total,
+                'avg':(total / count) if count else None,
+                'min':stats.get(f'min_{field}'),
+                'max':stats.get(f'max_{field}'),
+                'exact':not stats.get(f'stale_{field}', False)
+            }
+        
+        result = {
+            'success':True,
+            'count':int(stats.get('item_count', 0)),
+            'fields':fields,
+            'updated':stats.get('updated')
+        }
+        
+        return result, 200
+    
+    
+    def recount_stats(self,portfolio,org,ring):
+        '''
+        Rebuilds the ring stats from a full read (rings written before stats existed, outdated bounds).
+        Writes made while it runs may be counted twice or not at all.
+        '''
+        blueprint = self.BPC.get_blueprint('irma',ring,'last')
+        fields = self.aggregate_fields(blueprint)
+        
+        count = 0
+        values = {field:[] for field in fields}
+        try:
+            for rows, cursor, consumed in self.read_a_b_pages(portfolio,org,ring):
+                for row in rows:
+                    count += 1
+                    for field in fields:
+                        number = self.numeric(row.get('attributes', {}).get(field))
+                        if number is not None:
+                            values[field].append(number)
+        except Exception as e:
+            current_app.logger.error(str(e))
+            return {'success':False,'message':'Ring could not be read','error':str(e)}, 400
+        
+        stats = {'item_count':count, 'updated':datetime.now().isoformat()}
+        for field, numbers in values.items():
+            stats[f'count_{field}'] = len(numbers)
+            stats[f'sum_{field}'] = sum(numbers, Decimal(0))
+            if numbers:
+                stats[f'min_{field}'] = min(numbers)
+                stats[f'max_{field}'] = max(numbers)
+        
+        response = self.DAM.put_stats(portfolio,org,ring,stats)
+        if 'error' in response:
+            current_app.logger.error(response['error'])
+            return {'success':False,'message':'Stats could not be saved','error':response['error']}, 400
+        
+        return self.get_stats(portfolio,org,ring)
+    
+    
+    def make_etag(self,version):
+        '''
+        ETag for a document version. Items written before versioning existed are version 0
+        '''
+        return f'"{int(version)}"'
+    
+    
+    def parse_etag(self,if_match):
+        '''
+        Version number in an If-Match header. "*" means any version.
+        
+        @OUT:
+          ok: (int) or None for "*"
+          ko: False
+        '''
+        value = if_match.strip()
+        if value == '*':
+            return None
+        if value.startswith('W/'):
+            value = value[2:]
+        value = value.strip('"')
+        if not value.isdigit():
+            return False
+        return int(value)
         
         
     
@@ -1168,6 +2294,7 @@ class DataController:
         current_app.logger.debug('Item to delete:'+str(idx))
 
         response = self.DAM.delete_a_b_c(portfolio,org,ring,idx)
+        self.invalidate_item(portfolio,org,ring,idx)
 
         result = {}
 
@@ -1176,6 +2303,10 @@ class DataController:
             result['message'] = 'Item deleted'
             result['path'] = str(portfolio+'/'+org+'/'+ring+'/'+idx)
             status = 200
+            if response.get('previous'):
+                self.record_stats(portfolio,org,ring,removed=[response['previous']])
+                self.record_tombstone(portfolio,org,ring,idx)
+            self.update_s3_cache(portfolio,org,ring,deletes=[idx])
             current_app.logger.debug('Returned object:'+str(result))
 
             return result,status
@@ -0,0 +1,729 @@
+#data_export.py
+from flask import current_app
+import csv
+import io
+import itertools
+import json
+import time
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from common import DecimalEncoder
+from app_data.data_validator import to_timestamp
+from app_data.data_snapshot import SnapshotWriter
+
+# Listed in requirements.txt, only needed for columnar exports. A deployment without it
+# (e.g. a Lambda package trimmed for size) still runs, the columnar export answers 501.
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# Rows converted and written per row group (memory stays flat on large rings)
+ROW_GROUP_SIZE = 50000
+
+# Columns every export has, before the blueprint fields
+META_COLUMNS = ('_id', '_modified', '_index', '_deleted')
+
+
+def available():
+    return pyarrow is not None
+
+
+def to_number(value):
+    if value is None or isinstance(value, bool) or value == '':
+        return None
+    try:
+        return float(Decimal(str(value).strip()))
+    except (InvalidOperation, ValueError):
+        return None
+
+
+def to_boolean(value):
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in ('true', '1', 'yes'):
+        return True
+    if text in ('false', '0', 'no'):
+        return False
+    return None
+
+
+def to_json(value):
+    if value is None or isinstance(value, str):
+        return value or None
+    return json.dumps(value, cls=DecimalEncoder)
+
+
+def to_text(value):
+    if value is None:
+        return None
+    return value if isinstance(value, str) else str(value)
+
+
+def to_milliseconds(value):
+    if value is None or value == '':
+        return None
+    # Stored as epoch milliseconds, snapshots carry them as strings
+    return to_timestamp(str(value))
+
+
+def column_types():
+    '''
+    Blueprint field type to (arrow type, converter). Anything else is stored as a string
+    '''
+    return {
+        'number': (pyarrow.float64(), to_number),
+        'integer': (pyarrow.float64(), to_number),
+        'float': (pyarrow.float64(), to_number),
+        'boolean': (pyarrow.bool_(), to_boolean),
+        'timestamp': (pyarrow.timestamp('ms'), to_milliseconds),
+        'object': (pyarrow.string(), to_json),
+        'array': (pyarrow.string(), to_json)
+    }
+
+
+
+class ExportBusy(Exception):
+    '''
+    Another invocation moved the ring's full export forward in the meantime
+    '''
+
+    def __init__(self):
+        super().__init__('Full export in progress elsewhere')
+
+
+
+class ParquetSink:
+    '''
+    File object pyarrow writes a Parquet file into. Bytes go to an S3 multipart upload
+    (SnapshotWriter), so at most one 8MB part is held in memory whatever the size of the file
+    '''
+
+    def __init__(self,upload):
+
+        self.upload = upload
+        self.size = 0
+        self.closed = False
+
+
+    def write(self,data):
+
+        data = bytes(data)
+        self.upload.write(data)
+        self.size += len(data)
+        return len(data)
+
+
+    def tell(self):
+        return self.size
+
+
+    def writable(self):
+        return True
+
+
+    def flush(self):
+        # Parts are uploaded when they are full, S3 rejects parts under 5MB (except the last one)
+        pass
+
+
+    def close(self):
+        # The upload is completed (or aborted) by ParquetPart
+        self.closed = True
+
+
+
+class ParquetPart:
+    '''
+    One Parquet object written row group by row group (ROW_GROUP_SIZE rows) straight to S3.
+    Nothing is visible until close() completes the upload
+    '''
+
+    def __init__(self,s3_client,bucket,key,arrow_schema,converters,names):
+
+        self.key = key
+        self.arrow_schema = arrow_schema
+        self.converters = converters
+        self.names = names
+        self.upload = SnapshotWriter(s3_client, bucket, key, None, content_type='application/vnd.apache.parquet')
+        self.sink = ParquetSink(self.upload)
+        self.writer = pyarrow.parquet.ParquetWriter(self.sink, arrow_schema, compression='zstd')
+        self.batch = []
+        self.rows = 0
+
+
+    def add(self,row):
+
+        self.batch.append(row)
+        if len(self.batch) >= ROW_GROUP_SIZE:
+            self.write_group()
+
+
+    def write_group(self):
+
+        self.writer.write_table(to_table(self.batch, self.names, self.converters, self.arrow_schema))
+        self.rows += len(self.batch)
+        self.batch = []
+
+
+    def close(self):
+        '''
+        @OUT:
+          {'key','rows','bytes'}
+        '''
+        if self.batch or not self.rows:
+            self.write_group()
+        self.writer.close()
+        self.upload.close()
+
+        return {'key':self.key, 'rows':self.rows, 'bytes':self.sink.size}
+
+
+    def abort(self):
+
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+        self.upload.abort()
+
+
+
+def to_table(batch,names,converters,arrow_schema):
+
+    columns = []
+    for name, converter in zip(names, converters):
+        if name == '_deleted':
+            columns.append([bool(row.get('_deleted')) for row in batch])
+            continue
+        values = []
+        for row in batch:
+            value = row.get(name)
+            values.append(None if value is None else converter(value))
+        columns.append(values)
+
+    return pyarrow.Table.from_arrays(
+        [pyarrow.array(values, type=field.type) for values, field in zip(columns, arrow_schema)],
+        schema=arrow_schema
+    )
+
+
+
+class ColumnarExport:
+    '''
+    Ring exports as typed Parquet files, next to the JSON snapshot:
+
+        data/{portfolio}/{org}/{ring}/_export/columnar/manifest.json
+        data/{portfolio}/{org}/{ring}/_export/columnar/part-00000.parquet  full export
+        data/{portfolio}/{org}/{ring}/_export/columnar/part-00001.parquet  full export (next invocation)
+        data/{portfolio}/{org}/{ring}/_export/columnar/part-00002.parquet  appended changes
+        ...
+
+    One column per blueprint field, typed from fields[].type. Appended parts only hold the items that
+    changed since the previous part (read from the snapshot log) plus tombstones (_deleted) for deletes.
+    Readers concatenate the parts in manifest order and keep the last row of each _id (see load()).
+
+    A full export is a job that can take several invocations. Each one streams the ring from the cursor
+    saved in data/{portfolio}/{org}/{ring}/_export/columnar/full.json into a new part until its time budget
+    (EXPORT_BUDGET seconds) runs out. The manifest only switches to the new parts once the ring has been
+    read to the end, until then readers keep the previous export.
+    '''
+
+    def __init__(self,snapshot):
+
+        self.DSN = snapshot
+        self.s3_client = snapshot.s3_client
+
+
+    def prefix(self,portfolio,org,ring):
+        return f'data/{portfolio}/{org}/{ring}/_export/columnar/'
+
+
+    def manifest_key(self,portfolio,org,ring):
+        return self.prefix(portfolio,org,ring) + 'manifest.json'
+
+
+    def part_key(self,portfolio,org,ring,number):
+        return self.prefix(portfolio,org,ring) + f'part-{number:05d}.parquet'
+
+
+    def job_key(self,portfolio,org,ring):
+        return self.prefix(portfolio,org,ring) + 'full.json'
+
+
+    def part_number(self,part):
+        return int(part['key'].rsplit('-', 1)[1].split('.')[0])
+
+
+
+    def schema(self,blueprint):
+        '''
+        @OUT:
+          [{'name':(column),'type':(blueprint field type)}] in column order
+        '''
+        columns = [{'name':name, 'type':'meta'} for name in META_COLUMNS]
+        for field in blueprint.get('fields', []):
+            if field['name'] not in META_COLUMNS:
+                columns.append({'name':field['name'], 'type':field.get('type', 'string')})
+        return columns
+
+
+
+    def arrow_schema(self,schema):
+
+        types = column_types()
+        arrow_fields = []
+        converters = []
+        for column in schema:
+            if column['name'] == '_deleted':
+                arrow_type, converter = pyarrow.bool_(), bool
+            elif column['type'] == 'meta':
+                arrow_type, converter = pyarrow.string(), to_text
+            else:
+                arrow_type, converter = types.get(column['type'], (pyarrow.string(), to_text))
+            arrow_fields.append(pyarrow.field(column['name'], arrow_type))
+            converters.append(converter)
+
+        return pyarrow.schema(arrow_fields), converters
+
+
+
+    def open_part(self,key,schema):
+
+        arrow_schema, converters = self.arrow_schema(schema)
+        names = [column['name'] for column in schema]
+        return ParquetPart(self.s3_client, self.DSN.bucket(), key, arrow_schema, converters, names)
+
+
+
+    def write_part(self,key,schema,rows):
+        '''
+        Converts rows (FE items, deleted ones as {'_id','_deleted':True}) into a Parquet object
+
+        @OUT:
+          {'key','rows','bytes'}
+        '''
+        part = self.open_part(key, schema)
+        try:
+            for row in rows:
+                part.add(row)
+            return part.close()
+        except Exception:
+            part.abort()
+            raise
+
+
+
+    def load_manifest(self,portfolio,org,ring):
+
+        try:
+            response = self.s3_client.get_object(Bucket=self.DSN.bucket(), Key=self.manifest_key(portfolio,org,ring))
+        except self.s3_client.exceptions.NoSuchKey:
+            return None
+
+        return json.loads(response['Body'].read())
+
+
+
+    def save_manifest(self,portfolio,org,ring,manifest):
+
+        manifest['updated'] = datetime.now().isoformat()
+        manifest['rows'] = sum(part['rows'] for part in manifest['parts'])
+        manifest['bytes'] = sum(part['bytes'] for part in manifest['parts'])
+        self.s3_client.put_object(
+            Bucket=self.DSN.bucket(),
+            Key=self.manifest_key(portfolio,org,ring),
+            Body=json.dumps(manifest),
+            ContentType='application/json'
+        )
+
+
+
+    def load_job(self,portfolio,org,ring):
+        '''
+        @OUT:
+          ((job document) or None, (ETag) or None)
+        '''
+        try:
+            response = self.s3_client.get_object(Bucket=self.DSN.bucket(), Key=self.job_key(portfolio,org,ring))
+        except self.s3_client.exceptions.NoSuchKey:
+            return None, None
+
+        return json.loads(response['Body'].read()), response['ETag']
+
+
+
+    def save_job(self,portfolio,org,ring,job,clock=None,etag=None):
+        '''
+        Writes the job over the version with that ETag (None: only if there is none yet)
+
+        @OUT:
+          (ETag) of the new version
+          Raises ExportBusy if the job was written by someone else in between
+        '''
+        if clock is not None:
+            job['elapsed'] += time.monotonic() - clock
+        job['updated'] = datetime.now().isoformat()
+
+        condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        try:
+            response = self.s3_client.put_object(
+                Bucket=self.DSN.bucket(),
+                Key=self.job_key(portfolio,org,ring),
+                Body=json.dumps(job, cls=DecimalEncoder),
+                ContentType='application/json',
+                **condition
+            )
+        except self.s3_client.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise ExportBusy()
+            raise
+
+        return response['ETag']
+
+
+
+    def delete_parts(self,keys):
+
+        keys = list(keys)
+        for i in range(0, len(keys), 1000):
+            self.s3_client.delete_objects(
+                Bucket=self.DSN.bucket(),
+                Delete={'Objects':[{'Key':key} for key in keys[i:i+1000]],'Quiet':True}
+            )
+
+
+
+    def progress(self,job):
+
+        elapsed = job['elapsed']
+        return {
+            'status': job['status'],
+            'complete': job['status'] == 'complete',
+            'rows': job['rows'],
+            'parts': len(job['parts']),
+            'invocations': job['invocations'],
+            'elapsed': round(elapsed, 3),
+            'rows_per_second': round(job['rows'] / elapsed, 1) if elapsed else None,
+            'started': job['started'],
+            'updated': job['updated']
+        }
+
+
+
+    def export(self,portfolio,org,ring,blueprint,read_pages,current_mark,full=False):
+        '''
+        Appends the changes since the last export, or starts/continues a full export.
+
+        @IN:
+          read_pages = callable(cursor) -> generator of ([FE items], cursor after them or None after the last page)
+                       cursor None starts from the beginning of the ring
+          current_mark = callable() -> (mark) of the snapshot log, taken before a full export starts reading
+          full = Rewrite everything even if an append is possible
+
+        @OUT:
+          {'mode':<full|append|unchanged>,'complete':(bool),'written':{'key','rows','bytes'} or None,
+           'manifest':{(manifest)} or None,'progress':{(full export progress)} or None}
+        '''
+        schema = self.schema(blueprint)
+        job, etag = self.load_job(portfolio,org,ring)
+
+        if job is not None and job['status'] == 'running' and job['schema'] != schema:
+            # The blueprint changed under the export, its parts are useless
+            self.delete_parts(part['key'] for part in job['parts'])
+            job = None
+
+        if job is None or job['status'] != 'running':
+            manifest = self.load_manifest(portfolio,org,ring)
+            max_parts = current_app.config.get('EXPORT_MAX_PARTS', 50)
+
+            changes = None
+            if not full and manifest and manifest['schema'] == schema and len(manifest['parts']) - manifest.get('full_parts', 1) < max_parts:
+                changes = self.DSN.changes_since(portfolio,org,ring,manifest['mark'])
+
+            if changes is not None:
+                return self.append(portfolio,org,ring,schema,manifest,changes)
+
+            now = datetime.now().isoformat()
+            job = {
+                'status': 'running',
+                'blueprint_version': blueprint.get('version'),
+                'schema': schema,
+                # Changes logged from here on are appended by the next export (last row per _id wins)
+                'mark': current_mark(),
+                'cursor': None,
+                'next_part': self.part_number(manifest['parts'][-1]) + 1 if manifest else 0,
+                'parts': [],
+                'rows': 0,
+                'invocations': 0,
+                'elapsed': 0.0,
+                'started': now,
+                'updated': now
+            }
+
+        return self.run_full(portfolio,org,ring,job,etag,read_pages)
+
+
+
+    def append(self,portfolio,org,ring,schema,manifest,changes):
+
+        ops, mark = changes
+        if not ops:
+            return {'mode':'unchanged', 'complete':True, 'written':None, 'manifest':manifest, 'progress':None}
+
+        # Last operation on each item wins
+        latest = {}
+        for op in ops:
+            if op['op'] == 'put':
+                latest[op['item']['_id']] = op['item']
+            elif op['op'] == 'delete':
+                latest[op['_id']] = {'_id':op['_id'], '_deleted':True}
+
+        number = self.part_number(manifest['parts'][-1]) + 1
+        written = self.write_part(self.part_key(portfolio,org,ring,number), schema, latest.values())
+        written['mark'] = mark
+        manifest['parts'].append(written)
+        manifest['mark'] = mark
+        self.save_manifest(portfolio,org,ring,manifest)
+        return {'mode':'append', 'complete':True, 'written':written, 'manifest':manifest, 'progress':None}
+
+
+
+    def run_full(self,portfolio,org,ring,job,etag,read_pages):
+        '''
+        Streams the ring into one more part, from the saved cursor until the pages end or the time
+        budget runs out. Publishes the manifest when the ring has been read to the end.
+        '''
+        budget = current_app.config.get('EXPORT_BUDGET', 20)
+        clock = time.monotonic()
+        job['invocations'] += 1
+
+        part = self.open_part(self.part_key(portfolio,org,ring,job['next_part']), job['schema'])
+        cursor = job['cursor']
+        try:
+            pages = read_pages(cursor)
+            for rows, cursor in pages:
+                for row in rows:
+                    part.add(row)
+                if cursor is not None and time.monotonic() - clock >= budget:
+                    # Out of time, the next invocation continues from this cursor
+                    pages.close()
+                    break
+            else:
+                cursor = None
+            written = part.close()
+        except Exception:
+            # The saved cursor stays valid, the next invocation writes this part again
+            part.abort()
+            current_app.logger.error(f'Full export of {portfolio}/{org}/{ring} failed after {job["rows"]} rows')
+            raise
+
+        written['mark'] = job['mark']
+        job['parts'].append(written)
+        job['next_part'] += 1
+        job['rows'] += written['rows']
+        job['cursor'] = cursor
+
+        if cursor is not None:
+            self.save_job(portfolio,org,ring,job,clock,etag)
+            return {'mode':'full', 'complete':False, 'written':written, 'manifest':None, 'progress':self.progress(job)}
+
+        # Claims the completion first, a concurrent invocation can't publish the same parts twice
+        job['status'] = 'complete'
+        self.save_job(portfolio,org,ring,job,clock,etag)
+
+        old = self.load_manifest(portfolio,org,ring)
+        manifest = {
+            'format': 'parquet',
+            'blueprint_version': job['blueprint_version'],
+            'schema': job['schema'],
+            'parts': job['parts'],
+            'full_parts': len(job['parts']),
+            'mark': job['mark']
+        }
+        self.save_manifest(portfolio,org,ring,manifest)
+
+        current = {part['key'] for part in job['parts']}
+        stale = [part['key'] for part in old['parts'] if part['key'] not in current] if old else []
+        if stale:
+            self.delete_parts(stale)
+
+        return {'mode':'full', 'complete':True, 'written':written, 'manifest':manifest, 'progress':self.progress(job)}
+
+
+
+    def load(self,portfolio,org,ring,columns=None):
+        '''
+        Current rows of an export as one Arrow table (only the requested columns are read).
+        Keeps the last row of each _id and drops deleted ones. table.to_pandas() for a DataFrame.
+        '''
+        manifest = self.load_manifest(portfolio,org,ring)
+        if not manifest:
+            return None
+
+        read = None if columns is None else list(dict.fromkeys(['_id', '_deleted'] + list(columns)))
+        tables = []
+        for part in manifest['parts']:
+            response = self.s3_client.get_object(Bucket=self.DSN.bucket(), Key=part['key'])
+            tables.append(pyarrow.parquet.read_table(io.BytesIO(response['Body'].read()), columns=read))
+
+        table = pyarrow.concat_tables(tables)
+        if len(tables) > 1:
+            table = table.append_column('_row', pyarrow.array(range(table.num_rows), type=pyarrow.int64()))
+            last = table.group_by('_id').aggregate([('_row', 'max')])
+            table = table.filter(pyarrow.compute.is_in(table['_row'], value_set=last['_row_max'])).drop_columns(['_row'])
+
+        table = table.filter(pyarrow.compute.invert(table['_deleted']))
+        if columns is not None:
+            table = table.select(list(dict.fromkeys(['_id'] + list(columns))))
+        return table
+
+
+
+# CSV EXPORT
+# Rows are written as DynamoDB pages arrive. Only the current page is held in memory.
+
+CSV_META_COLUMNS = ('_id', '_modified', '_index')
+
+# Spreadsheets run cells starting with these as formulas
+CSV_FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+def flatten(value,prefix='',out=None):
+    '''
+    Nested object to {(dotted path):(value)}. Lists are kept as they are
+    '''
+    if out is None:
+        out = {}
+    for key, inner in value.items():
+        name = f'{prefix}.{key}' if prefix else str(key)
+        if isinstance(inner, dict) and inner:
+            flatten(inner, name, out)
+        else:
+            out[name] = inner
+    return out
+
+
+def csv_cell(value):
+
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (dict, list)):
+        text = json.dumps(value, cls=DecimalEncoder)
+    else:
+        text = str(value)
+
+    if formula_like(text):
+        text = "'" + text
+    return text
+
+
+def formula_like(text):
+    '''
+    Text a spreadsheet would run as a formula, also behind quotes: a value that already starts
+    with "'=" gets another quote, so csv_unguard gives it back as it was
+    '''
+    core = text.lstrip("'")
+    return core.startswith(CSV_FORMULA_PREFIXES) and to_number(core) is None
+
+
+def csv_unguard(text):
+    '''
+    Cell text without the quote csv_cell put in front of it (the CSV import reads exports back)
+    '''
+    if text.startswith("'") and formula_like(text):
+        return text[1:]
+    return text
+
+
+
+class CsvExport:
+    '''
+    Column layout of a ring CSV: _id, _modified, _index and then the blueprint fields in order.
+    Object fields are flattened into one column per dotted path seen in the first page
+    ('address.city'), followed by a column with the field name holding any other keys as JSON.
+    '''
+
+    def __init__(self,blueprint,sample):
+
+        self.layout = []
+        self.header = list(CSV_META_COLUMNS)
+
+        for field in blueprint.get('fields', []):
+            name = field['name']
+            if name in CSV_META_COLUMNS:
+                continue
+
+            paths = []
+            if field.get('type') == 'object':
+                for item in sample:
+                    value = item.get(name)
+                    if isinstance(value, dict):
+                        for path in flatten(value):
+                            if path not in paths:
+                                paths.append(path)
+
+            self.layout.append((name, paths))
+            self.header.extend(f'{name}.{path}' for path in paths)
+            self.header.append(name)
+
+
+    def row(self,item):
+
+        cells = [csv_cell(item.get(column)) for column in CSV_META_COLUMNS]
+
+        for name, paths in self.layout:
+            value = item.get(name)
+            if paths:
+                rest = flatten(value) if isinstance(value, dict) else {}
+                cells.extend(csv_cell(rest.pop(path, None)) for path in paths)
+                if isinstance(value, dict):
+                    value = rest or None
+            cells.append(csv_cell(value))
+
+        return cells
+
+
+    def stream(self,pages):
+        '''
+        @IN:
+          pages = iterable of [(FE item)], the first one already used for the layout
+
+        @OUT:
+          generator of utf-8 bytes (with a BOM so spreadsheets pick the encoding), one chunk per page
+        '''
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        buffer.write('\ufeff')
+        writer.writerow(self.header)
+
+        for page in pages:
+            for item in page:
+                writer.writerow(self.row(item))
+            data = buffer.getvalue()
+            if data:
+                yield data.encode('utf-8')
+                buffer.seek(0)
+                buffer.truncate(0)
+
+        data = buffer.getvalue()
+        if data:
+            yield data.encode('utf-8')
+
+
+def csv_stream(blueprint,pages):
+    '''
+    CSV of a ring read page by page. The first page with items sets the flattened columns
+    '''
+    pages = iter(pages)
+    first = []
+    for first in pages:
+        if first:
+            break
+    return CsvExport(blueprint, first).stream(itertools.chain([first], pages))
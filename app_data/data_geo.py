@@ -0,0 +1,153 @@
+#data_geo.py
+import math
+
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+BASE32_INDEX = {c: i for i, c in enumerate(BASE32)}
+
+# Precision stored in the geo_index (cells of about 5m x 5m)
+GEOHASH_PRECISION = 9
+
+EARTH_RADIUS = 6371008.8  # meters
+METERS_PER_DEGREE = 111320.0
+
+
+def encode(lat, lon, precision=GEOHASH_PRECISION):
+    '''
+    Geohash of a point
+    '''
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+
+    while len(chars) < precision:
+        if even:
+            mid = (lon_range[0] + lon_range[1]) / 2
+            if lon >= mid:
+                value = (value << 1) | 1
+                lon_range[0] = mid
+            else:
+                value = value << 1
+                lon_range[1] = mid
+        else:
+            mid = (lat_range[0] + lat_range[1]) / 2
+            if lat >= mid:
+                value = (value << 1) | 1
+                lat_range[0] = mid
+            else:
+                value = value << 1
+                lat_range[1] = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[value])
+            bits = 0
+            value = 0
+
+    return ''.join(chars)
+
+
+def decode(geohash):
+    '''
+    Center of a geohash cell
+
+    @OUT:
+      ((float) lat, (float) lon)
+    '''
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    even = True
+
+    for c in geohash:
+        value = BASE32_INDEX[c]
+        for shift in range(4, -1, -1):
+            bit = (value >> shift) & 1
+            target = lon_range if even else lat_range
+            mid = (target[0] + target[1]) / 2
+            if bit:
+                target[0] = mid
+            else:
+                target[1] = mid
+            even = not even
+
+    return (lat_range[0] + lat_range[1]) / 2, (lon_range[0] + lon_range[1]) / 2
+
+
+def cell_size(precision):
+    '''
+    Size of a cell in degrees
+
+    @OUT:
+      ((float) height in degrees of latitude, (float) width in degrees of longitude)
+    '''
+    total = 5 * precision
+    lon_bits = (total + 1) // 2
+    lat_bits = total // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lon_bits)
+
+
+def precision_for_radius(lat, radius):
+    '''
+    Longest precision whose cells are at least "radius" meters high and wide at that latitude,
+    so the cell of the center plus its 8 neighbours cover the whole circle
+    '''
+    shrink = max(math.cos(math.radians(lat)), 0.01)
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        height, width = cell_size(precision)
+        if height * METERS_PER_DEGREE >= radius and width * METERS_PER_DEGREE * shrink >= radius:
+            return precision
+    return 1
+
+
+def covering_prefixes(lat, lon, radius):
+    '''
+    Geohash prefixes (up to 9) whose cells cover the circle
+    '''
+    precision = precision_for_radius(lat, radius)
+    height, width = cell_size(precision)
+    center_lat, center_lon = decode(encode(lat, lon, precision))
+
+    prefixes = set()
+    for dlat in (-height, 0, height):
+        for dlon in (-width, 0, width):
+            cell_lat = center_lat + dlat
+            if cell_lat > 90 or cell_lat < -90:
+                continue
+            cell_lon = (center_lon + dlon + 180) % 360 - 180
+            prefixes.add(encode(cell_lat, cell_lon, precision))
+
+    return sorted(prefixes)
+
+
+def distance(lat1, lon1, lat2, lon2):
+    '''
+    Haversine distance in meters
+    '''
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def to_coordinates(lat, lon):
+    '''
+    Stored values (strings for most blueprint field types) to a valid point
+
+    @OUT:
+      ok: ((float) lat, (float) lon)
+      ko: None
+    '''
+    try:
+        lat = float(lat)
+        lon = float(lon)
+    except (TypeError, ValueError):
+        return None
+
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+    return lat, lon
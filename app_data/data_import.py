@@ -0,0 +1,427 @@
+#data_import.py
+from flask import current_app
+import csv
+import io
+import json
+import time
+import uuid
+from datetime import datetime
+from app_data.data_export import CSV_META_COLUMNS, csv_unguard
+
+# Bytes requested per read of the staged file
+READ_CHUNK = 1024 * 1024
+
+# Errors kept in the job document (the counters keep going)
+MAX_ERRORS = 100
+
+IMPORT_FORMATS = ('csv', 'jsonl')
+
+
+def detect_format(filename, fmt=None):
+    '''
+    csv or jsonl from an explicit format or the file extension. None if unknown
+    '''
+    if fmt:
+        fmt = fmt.lower()
+    elif filename and '.' in filename:
+        fmt = filename.rsplit('.', 1)[1].lower()
+    if fmt in ('ndjson', 'json'):
+        fmt = 'jsonl'
+    return fmt if fmt in IMPORT_FORMATS else None
+
+
+def iter_records(chunks, fmt, offset):
+    '''
+    Splits a byte stream into records, keeping track of where each one ends.
+    CSV records may span lines (quoted line breaks), they end when the quotes are balanced.
+
+    @OUT:
+      generator of ((bytes) record, (int) offset right after it)
+    '''
+    pending = b''
+    record = b''
+    quotes = 0
+
+    for chunk in chunks:
+        pending += chunk
+        start = 0
+        while True:
+            end = pending.find(b'\n', start)
+            if end < 0:
+                break
+            line = pending[start:end + 1]
+            start = end + 1
+            offset += len(line)
+
+            if fmt == 'csv':
+                record += line
+                quotes += line.count(b'"')
+                if quotes % 2:
+                    continue
+                line = record
+                record = b''
+                quotes = 0
+            yield line, offset
+        pending = pending[start:]
+
+    if record or pending:
+        yield record + pending, offset + len(pending)
+
+
+
+class ColumnMap:
+    '''
+    CSV header to blueprint fields. Matches exact names first, then ignoring case.
+    Dotted columns of object fields ('address.city', as written by the CSV export) are nested back.
+    '''
+
+    def __init__(self,header,blueprint):
+
+        fields = {field['name']:field for field in blueprint.get('fields', [])}
+        lower = {name.lower():name for name in fields}
+
+        self.columns = []
+        self.ignored = []
+
+        for position, column in enumerate(header):
+            name = column.strip()
+            if name in CSV_META_COLUMNS:
+                continue
+
+            field = name if name in fields else lower.get(name.lower())
+            path = None
+            if field is None and '.' in name:
+                head, rest = name.split('.', 1)
+                head = head if head in fields else lower.get(head.lower())
+                if head and fields[head].get('type') == 'object':
+                    field, path = head, rest.split('.')
+
+            if field is None:
+                self.ignored.append(name)
+                continue
+            self.columns.append((position, field, path))
+
+
+    def entry(self,row):
+        '''
+        Payload for construct_post_item. Empty cells are left out so blueprint defaults apply.
+        Cells the CSV export guarded against formula injection ("'=...") lose the quote again
+        '''
+        entry = {}
+        for position, field, path in self.columns:
+            if position >= len(row) or row[position] == '':
+                continue
+            value = csv_unguard(row[position])
+            if path is None:
+                entry[field] = value
+                continue
+
+            target = entry.get(field)
+            if not isinstance(target, dict):
+                target = entry[field] = {}
+            for key in path[:-1]:
+                target = target.setdefault(key, {})
+            target[path[-1]] = value
+
+        return entry
+
+
+
+class ImportBusy(Exception):
+    '''
+    Another invocation holds the lease on the import job (or took it over)
+    '''
+
+    def __init__(self,progress=None):
+        super().__init__('Import job in progress elsewhere')
+        self.progress = progress
+
+
+
+class ImportJob:
+    '''
+    Resumable bulk import of a staged file (under _docs/) into a ring.
+
+    The job document lives next to the ring snapshot:
+
+        data/{portfolio}/{org}/{ring}/_import/{job_id}
+
+    It holds the byte offset of the first record not written yet. Each run reads the file from that
+    offset (ranged GET), writes batches until its time budget (IMPORT_BUDGET seconds) runs out and
+    saves the offset after every batch, so a run that gets killed loses at most one batch. Item ids
+    are derived from the job and the record offset: a batch replayed after a kill overwrites itself.
+
+    One invocation at a time works on a job (e.g. a client retrying after a gateway timeout while the
+    first call is still running). It takes a lease in the job document (expiring after IMPORT_LEASE
+    seconds) and every save is conditional on the ETag of the previous one, like SnapshotBuilder.
+    Whoever loses gets ImportBusy. The lease is handed back when a run stops.
+    '''
+
+    def __init__(self,snapshot):
+
+        self.DSN = snapshot
+        self.s3_client = snapshot.s3_client
+
+
+    def job_key(self,portfolio,org,ring,job_id):
+        return f'data/{portfolio}/{org}/{ring}/_import/{job_id}'
+
+
+    def staged_key(self,portfolio,org,ring,job_id,fmt):
+        return f'_docs/{portfolio}/{org}/{ring}/_import/{job_id}.{fmt}'
+
+
+
+    def create(self,portfolio,org,ring,source,fmt,job_id=None):
+        '''
+        @IN:
+          source = S3 key of the staged file
+
+        @OUT:
+          ((job document), (ETag))
+        '''
+        response = self.s3_client.head_object(Bucket=self.DSN.bucket(), Key=source)
+        now = datetime.now().isoformat()
+        job = {
+            'job_id': job_id or str(uuid.uuid4()),
+            'status': 'running',
+            'source': source,
+            'format': fmt,
+            'size': response['ContentLength'],
+            'offset': 0,
+            'header': None,
+            'ignored_columns': [],
+            'lease': None,
+            'rows': 0,
+            'saved': 0,
+            'failed': 0,
+            'errors': [],
+            'invocations': 0,
+            'elapsed': 0.0,
+            'started': now,
+            'updated': now
+        }
+        return job, self.save(portfolio,org,ring,job)
+
+
+    def stage(self,portfolio,org,ring,upload,fmt):
+        '''
+        Streams an uploaded file to S3 so it can be read again by later runs
+
+        @OUT:
+          (job_id, staged key)
+        '''
+        job_id = str(uuid.uuid4())
+        key = self.staged_key(portfolio,org,ring,job_id,fmt)
+        self.s3_client.upload_fileobj(upload, self.DSN.bucket(), key)
+        return job_id, key
+
+
+
+    def load(self,portfolio,org,ring,job_id):
+        '''
+        @OUT:
+          ((job document) or None, (ETag) or None)
+        '''
+        try:
+            response = self.s3_client.get_object(Bucket=self.DSN.bucket(), Key=self.job_key(portfolio,org,ring,job_id))
+        except self.s3_client.exceptions.NoSuchKey:
+            return None, None
+
+        return json.loads(response['Body'].read()), response['ETag']
+
+
+
+    def acquire(self,portfolio,org,ring,job,etag):
+        '''
+        Takes the lease on the job (see the class docstring)
+
+        @OUT:
+          (ETag) of the job document now holding the lease
+          Raises ImportBusy if someone else holds it
+        '''
+        lease = job.get('lease')
+        if lease and lease['expires'] > time.time():
+            raise ImportBusy(self.progress(job))
+
+        budget = current_app.config.get('IMPORT_BUDGET', 20)
+        job['lease'] = {
+            'id': uuid.uuid4().hex,
+            'expires': time.time() + current_app.config.get('IMPORT_LEASE', budget + 60)
+        }
+        return self.save(portfolio,org,ring,job,etag=etag)
+
+
+
+    def save(self,portfolio,org,ring,job,clock=None,etag=None):
+        '''
+        Writes the job over the version with that ETag (None: only if there is none yet)
+
+        @OUT:
+          (ETag) of the new version
+          Raises ImportBusy if the job was written by someone else in between
+        '''
+        if clock is not None:
+            job['elapsed'] += time.monotonic() - clock
+        job['updated'] = datetime.now().isoformat()
+
+        condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        try:
+            response = self.s3_client.put_object(
+                Bucket=self.DSN.bucket(),
+                Key=self.job_key(portfolio,org,ring,job['job_id']),
+                Body=json.dumps(job),
+                ContentType='application/json',
+                **condition
+            )
+        except self.s3_client.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise ImportBusy()
+            raise
+
+        return response['ETag']
+
+
+
+    def progress(self,job):
+
+        elapsed = job['elapsed']
+        return {
+            'job_id': job['job_id'],
+            'status': job['status'],
+            'complete': job['status'] == 'complete',
+            'format': job['format'],
+            'source': job['source'],
+            'bytes': job['size'],
+            'bytes_done': job['offset'],
+            'percent': round(100.0 * job['offset'] / job['size'], 1) if job['size'] else 100.0,
+            'rows': job['rows'],
+            'saved': job['saved'],
+            'failed': job['failed'],
+            'errors': job['errors'],
+            'ignored_columns': job['ignored_columns'],
+            'invocations': job['invocations'],
+            'elapsed': round(elapsed, 3),
+            'rows_per_second': round(job['rows'] / elapsed, 1) if elapsed else None,
+            'started': job['started'],
+            'updated': job['updated']
+        }
+
+
+
+    def read(self,job):
+        '''
+        Records of the staged file from the job offset
+
+        @OUT:
+          generator of ((bytes) record, (int) offset right after it)
+        '''
+        if job['offset'] >= job['size']:
+            return iter(())
+
+        response = self.s3_client.get_object(
+            Bucket=self.DSN.bucket(),
+            Key=job['source'],
+            Range=f'bytes={job["offset"]}-'
+        )
+        return iter_records(response['Body'].iter_chunks(READ_CHUNK), job['format'], job['offset'])
+
+
+
+    def run(self,portfolio,org,ring,job,etag,blueprint,write_batch):
+        '''
+        Continues a job until the file ends or the time budget runs out.
+
+        @IN:
+          etag = ETag of the job document as it was loaded (or created)
+          write_batch = callable([(row number, _id, payload)]) -> [(row number, error)] rows that failed
+
+        @OUT:
+          (progress) see progress()
+          Raises ImportBusy if another invocation holds the job
+        '''
+        budget = current_app.config.get('IMPORT_BUDGET', 20)
+        batch_size = current_app.config.get('IMPORT_BATCH_SIZE', 500)
+        clock = time.monotonic()
+        namespace = uuid.UUID(job['job_id'])
+
+        etag = self.acquire(portfolio,org,ring,job,etag)
+
+        job['invocations'] += 1
+        records = self.read(job)
+
+        columns = None
+        if job['format'] == 'csv' and job['header'] is not None:
+            columns = ColumnMap(job['header'], blueprint)
+
+        batch = []
+        batch_end = job['offset']
+
+        def flush(release=False):
+            nonlocal etag
+            failures = write_batch(batch)
+            job['rows'] += len(batch)
+            job['failed'] += len(failures)
+            job['saved'] += len(batch) - len(failures)
+            for row_number, error in failures:
+                if len(job['errors']) < MAX_ERRORS:
+                    job['errors'].append({'row':row_number, 'error':error})
+            job['offset'] = batch_end
+            batch.clear()
+            if release:
+                job['lease'] = None
+            etag = self.save(portfolio,org,ring,job,clock,etag)
+
+        try:
+            for record, end in records:
+                record_start = batch_end
+                batch_end = end
+                row_number = job['rows'] + len(batch) + 1
+
+                text = record.decode('utf-8-sig' if record_start == 0 else 'utf-8').strip()
+                if not text:
+                    continue
+
+                if job['format'] == 'csv':
+                    row = next(csv.reader(io.StringIO(text)))
+                    if columns is None:
+                        job['header'] = row
+                        columns = ColumnMap(row, blueprint)
+                        job['ignored_columns'] = columns.ignored
+                        continue
+                    entry = columns.entry(row)
+                else:
+                    try:
+                        entry = json.loads(text)
+                    except json.JSONDecodeError as e:
+                        entry = e
+
+                idx = str(uuid.uuid5(namespace, str(record_start)))
+                batch.append((row_number, idx, entry))
+
+                if len(batch) >= batch_size:
+                    out_of_time = time.monotonic() - clock >= budget
+                    flush(release=out_of_time)
+                    if out_of_time:
+                        # Out of time, the next run continues from the saved offset
+                        records.close()
+                        return self.progress(job)
+
+            if batch:
+                flush()
+
+        except ImportBusy:
+            current_app.logger.error(f'Import {job["job_id"]} into {portfolio}/{org}/{ring} was taken over at row {job["rows"]}')
+            raise
+        except Exception:
+            # The saved offset stays valid, the next run continues from it
+            current_app.logger.error(f'Import {job["job_id"]} into {portfolio}/{org}/{ring} failed at row {job["rows"]}')
+            raise
+
+        job['offset'] = job['size']
+        job['status'] = 'complete'
+        job['lease'] = None
+        self.save(portfolio,org,ring,job,clock,etag)
+        current_app.logger.debug(f'Import {job["job_id"]} into {portfolio}/{org}/{ring} complete: {self.progress(job)}')
+
+        return self.progress(job)
@@ -1,7 +1,13 @@
 #data_model.py
 
 import boto3
-from boto3.dynamodb.conditions import Key
+import copy
+import itertools
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from boto3.dynamodb.conditions import Key, Attr
 from botocore.exceptions import BotoCoreError, ClientError
 from datetime import datetime
 from flask import current_app, jsonify
@@ -10,6 +16,12 @@ from app_blueprint.blueprint_controller import BlueprintController
 from env_config import DYNAMODB_RINGDATA_TABLE
 
 
+HEX_DIGITS = '0123456789abcdef'
+
+# Retried with backoff instead of failing the call
+THROTTLE_ERRORS = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded')
+
+
 class DataModel:
 
     def __init__(self,tid=False,ip=False):
@@ -19,6 +31,7 @@ class DataModel:
 
         self.dynamodb = boto3.resource('dynamodb', region_name='us-east-1')  # Adjust region if needed
         self.data_table = self.dynamodb.Table(DYNAMODB_RINGDATA_TABLE)  
+        self.local = threading.local()
             
     
    
@@ -31,16 +44,119 @@ class DataModel:
         item['doc_index'] = org+':'+ring+':'+item['_id'] # _id was generated in the controller
         
         try:
-            self.data_table.put_item(Item=item)
-            #self.increase_item_count(handle,ring)  #TO-DO: Implement increase_item_count!
-            return {"message": "Item created", "document": item}
+            # ALL_OLD tells an overwrite (singletons) apart from a new item for the ring stats
+            response = self.data_table.put_item(Item=item, ReturnValues='ALL_OLD')
+            return {"message": "Item created", "document": item, "previous": response.get('Attributes')}
         except ClientError as e:
             return {"error": e.response['Error']['Message']}
         
 
       
     
-    def get_a_b(self, portfolio, org, ring, limit=10000, lastkey=None):
+    def post_a_b_batch(self,portfolio,org,ring,items):
+        '''
+        Writes items with BatchWriteItem, 25 per call.
+        UnprocessedItems are retried with exponential backoff. A chunk rejected as a whole
+        (e.g. one invalid item) is retried item by item so only the bad ones fail.
+
+        @OUT:
+          {(_id):{'success':(bool),'error':(string)}}
+        '''
+        results = {}
+
+        for item in items:
+            item['portfolio_index'] = 'irn:data:'+portfolio
+            item['doc_index'] = org+':'+ring+':'+item['_id']
+
+        for i in range(0, len(items), 25):
+            chunk = items[i:i+25]
+            try:
+                unprocessed = self.batch_write(chunk)
+                for item in chunk:
+                    results[item['_id']] = {'success':True}
+                for item in unprocessed:
+                    results[item['_id']] = {'success':False,'error':'Throttled, item was not written'}
+
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ValidationException':
+                    for item in chunk:
+                        results[item['_id']] = {'success':False,'error':e.response['Error']['Message']}
+                    continue
+
+                for item in chunk:
+                    try:
+                        self.data_table.put_item(Item=item)
+                        results[item['_id']] = {'success':True}
+                    except ClientError as item_error:
+                        results[item['_id']] = {'success':False,'error':item_error.response['Error']['Message']}
+
+        return results
+
+
+
+    def batch_write(self,items,max_attempts=8):
+        '''
+        One BatchWriteItem call (<= 25 items) with retries for UnprocessedItems.
+        Same backoff as installer/backup/dynamo_backup_restore.py
+
+        @OUT:
+          [(items still unprocessed after max_attempts)]
+        '''
+        request_items = {DYNAMODB_RINGDATA_TABLE: [{'PutRequest': {'Item': item}} for item in items]}
+
+        backoff = 0.05
+        max_backoff = 4
+        for attempt in range(max_attempts):
+            try:
+                response = self.dynamodb.batch_write_item(RequestItems=request_items)
+            except ClientError as e:
+                if e.response['Error']['Code'] not in THROTTLE_ERRORS:
+                    raise
+                response = {'UnprocessedItems': request_items}
+
+            unprocessed = response.get('UnprocessedItems', {}).get(DYNAMODB_RINGDATA_TABLE, [])
+            if not unprocessed:
+                return []
+
+            time.sleep(backoff)
+            backoff = min(max_backoff, backoff * 2)
+            request_items = {DYNAMODB_RINGDATA_TABLE: unprocessed}
+
+        return [request['PutRequest']['Item'] for request in request_items[DYNAMODB_RINGDATA_TABLE]]
+      
+    
+    
+    def projection(self, fields):
+        '''
+        ProjectionExpression for the FE item shape restricted to some attributes
+        (_id, modified and path_index are always read)
+        
+        @IN:
+          fields = [(attribute name)]
+          
+        @OUT:
+          {'ProjectionExpression':(string),'ExpressionAttributeNames':{}} to merge into the query parameters
+        '''
+        names = {'#p_id': '_id', '#pmodified': 'modified', '#ppath': 'path_index', '#pattr': 'attributes'}
+        parts = ['#p_id', '#pmodified', '#ppath']
+        for n, field in enumerate(fields):
+            names[f'#pf{n}'] = field
+            parts.append(f'#pattr.#pf{n}')
+            
+        return {'ProjectionExpression': ', '.join(parts), 'ExpressionAttributeNames': names}
+    
+    
+    def get_a_b(self, portfolio, org, ring, limit=10000, lastkey=None, fields=None):
+        '''
+        One page of the ring in doc_index order (a single Query)
+        
+        @IN:
+          lastkey = LastEvaluatedKey of the previous page
+          
+        @OUT:
+          ok: {'items':[{(row)}],'lastkey':(LastEvaluatedKey) or None}
+          ko: {'error':(string)}
+        '''
         # Construct the partition key and sort key prefix
         portfolio_index = f'irn:data:{portfolio}'  # This will be used as the partition key (PK)
         
@@ -54,36 +170,59 @@ class DataModel:
                 'KeyConditionExpression': Key('portfolio_index').eq(portfolio_index) & Key('doc_index').begins_with(prefix_doc_index),
                 'Limit': limit
             }
+            
+            # Only the requested attributes (smaller responses)
+            if fields:
+                query_params.update(self.projection(fields))
 
             # Add the ExclusiveStartKey to the query parameters if provided (for pagination)
             if lastkey:                  
-                query_params['ExclusiveStartKey'] = {
-                        'doc_index': f'{org}:{ring}:{lastkey}',
-                        'portfolio_index': f'irn:data:{portfolio}'
-                    }
+                query_params['ExclusiveStartKey'] = lastkey
  
             # Query DynamoDB to get items with matching PK and SK prefix
             response = self.data_table.query(**query_params)
             
-            # Extract items and pagination key
-            items = response.get('Items', [])
-            endkey = response.get('LastEvaluatedKey')  # Pagination key for next query
-            
-            # Build the result
-            result ={}
-            result['items'] = items
-            if endkey:
-                result['last_id'] = endkey['doc_index'].split(':')[-1]
-            else:
-                result['last_id'] = None
-
-            return result
+            # Full pagination key, the controller turns it into a cursor
+            return {'items': response.get('Items', []), 'lastkey': response.get('LastEvaluatedKey')}
 
         except (BotoCoreError, ClientError) as e:
             return {"error": str(e)}   
         
         
         
+    def get_a_b_sorted(self, partition, limit=1000, lastkey=None, descending=True, fields=None):
+        '''
+        Page of a sort partition in the order of its sort_index (sort_index GSI)
+        
+        @IN:
+          partition = (string) sort_partition, see DataController.generate_sort_index
+          lastkey = LastEvaluatedKey of the previous page
+          
+        @OUT:
+          ok: {'items':[{(row)}],'lastkey':(LastEvaluatedKey) or None}
+          ko: {'error':(string)}
+        '''
+        try:
+            query_params = {
+                'IndexName': 'sort_index',
+                'KeyConditionExpression': Key('sort_partition').eq(partition),
+                'ScanIndexForward': not descending,
+                'Limit': limit
+            }
+            if lastkey:
+                query_params['ExclusiveStartKey'] = lastkey
+            if fields:
+                query_params.update(self.projection(fields))
+                
+            response = self.data_table.query(**query_params)
+            
+            return {'items': response.get('Items', []), 'lastkey': response.get('LastEvaluatedKey')}
+        
+        except (BotoCoreError, ClientError) as e:
+            return {"error": str(e)}
+        
+        
+        
     def get_a_b_batch(self, portfolio, org, ring, limit=10000, lastkey=None):
         # Construct the partition key and sort key prefix
         portfolio_index = f'irn:data:{portfolio}'  # This will be used as the partition key (PK)
@@ -131,6 +270,114 @@ class DataModel:
 
         
         
+    def segment_bounds(self, org, ring, depth=1):
+        '''
+        Splits the sort key space of a ring into 16**depth disjoint ranges using the first
+        characters of the _id (uuid4 hex). Every possible _id falls in exactly one range:
+        the first one starts at the ring prefix and the last one ends right after it (';' follows ':').
+
+        @OUT:
+          [(lower, upper)]  lower is inclusive, upper is exclusive
+        '''
+        prefix = f'{org}:{ring}:'
+        cuts = [''.join(chars) for chars in itertools.product(HEX_DIGITS, repeat=depth)][1:]
+        bounds = [prefix] + [prefix + cut for cut in cuts] + [f'{org}:{ring};']
+        
+        return list(zip(bounds[:-1], bounds[1:]))
+    
+    
+    
+    def segment_table(self):
+        # boto3 resources are not thread safe, each reader thread gets its own
+        if not hasattr(self.local, 'table'):
+            session = boto3.session.Session()
+            self.local.table = session.resource('dynamodb', region_name='us-east-1').Table(DYNAMODB_RINGDATA_TABLE)
+        return self.local.table
+    
+    
+    
+    def get_a_b_segments(self, portfolio, org, ring, depth=1, workers=8, prefetch=4, start_segment=0, startkey=None):
+        '''
+        Parallel full read of a ring.
+
+        The ring is split with segment_bounds() and up to "workers" segments are queried concurrently.
+        Pages are yielded in sort key order (same order as a sequential read). Segments ahead of the one
+        being consumed keep at most "prefetch" pages buffered, so memory doesn't grow with the ring.
+
+        @IN:
+          start_segment, startkey = Resume point (startkey is the LastEvaluatedKey within start_segment)
+
+        @OUT:
+          generator of (segment, items, lastkey, consumed)
+            lastkey is the LastEvaluatedKey after this page within its segment (None when the segment is done)
+        '''
+        portfolio_index = f'irn:data:{portfolio}'
+        bounds = self.segment_bounds(org, ring, depth)
+        stop = threading.Event()
+        queues = {}
+        
+        def put(q, entry):
+            # Gives up if the consumer went away
+            while not stop.is_set():
+                try:
+                    q.put(entry, timeout=0.5)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        
+        def fetch(segment, q):
+            lower, upper = bounds[segment]
+            lastkey = startkey if segment == start_segment else None
+            try:
+                while True:
+                    query_params = {
+                        'KeyConditionExpression': Key('portfolio_index').eq(portfolio_index) & Key('doc_index').between(lower, upper),
+                        'ReturnConsumedCapacity': 'TOTAL'
+                    }
+                    if lastkey:
+                        query_params['ExclusiveStartKey'] = lastkey
+                        
+                    response = self.segment_table().query(**query_params)
+                    # between() is inclusive, the upper bound belongs to the next segment
+                    items = [item for item in response.get('Items', []) if item['doc_index'] != upper]
+                    lastkey = response.get('LastEvaluatedKey')
+                    consumed = response.get('ConsumedCapacity', {}).get('CapacityUnits', 0)
+                    
+                    if not put(q, ('page', items, lastkey, consumed)) or not lastkey:
+                        return
+            except Exception as e:
+                put(q, ('error', e, None, 0))
+        
+        pool = ThreadPoolExecutor(max_workers=workers)
+        
+        def submit(segment):
+            if segment < len(bounds):
+                queues[segment] = queue.Queue(maxsize=prefetch)
+                pool.submit(fetch, segment, queues[segment])
+        
+        try:
+            for segment in range(start_segment, start_segment + workers):
+                submit(segment)
+                
+            for segment in range(start_segment, len(bounds)):
+                while True:
+                    kind, items, lastkey, consumed = queues[segment].get()
+                    if kind == 'error':
+                        raise items
+                    yield segment, items, lastkey, consumed
+                    if not lastkey:
+                        break
+                    
+                del queues[segment]
+                submit(segment + workers)
+                
+        finally:
+            stop.set()
+            pool.shutdown(wait=False)
+        
+    
+
     #Deprecated
     def get_a_index(self, portfolio, prefix_path, lastkey=None):
         # Construct the partition key and sort key prefix
@@ -229,64 +476,207 @@ class DataModel:
         
     
         
-    def put_a_b_c(self, portfolio, org, ring, idx, item):
-        # Construct the new primary key (partition key) and sort key
-                                                                                                                                             
-        # Set the partition and sort keys in the item
+    def set_geo_index(self,portfolio,org,ring,idx,geo_index,coordinates):
+        '''
+        Moves (or removes, if geo_index is None) the geo_index of an item.
+        Only if the coordinate fields still hold the values it was computed from.
+        
+        @IN:
+          coordinates = {(field name):(stored value)} the lat and lon fields
+        '''
+        names = {}
+        values = {}
+        conditions = []
+        for n, (field, value) in enumerate(coordinates.items()):
+            names[f'#c{n}'] = field
+            values[f':c{n}'] = value
+            conditions.append(f'attributes.#c{n} = :c{n}')
+        
+        params = {
+            'Key': {'portfolio_index': 'irn:data:'+portfolio, 'doc_index': org+':'+ring+':'+idx},
+            'ConditionExpression': ' AND '.join(conditions),
+            'ExpressionAttributeNames': names
+        }
+        if geo_index:
+            params['UpdateExpression'] = "SET geo_index = :geo_index"
+            values[':geo_index'] = geo_index
+        else:
+            params['UpdateExpression'] = "REMOVE geo_index"
+        params['ExpressionAttributeValues'] = values
+        
+        try:
+            self.data_table.update_item(**params)
+            return {'message': 'Index updated'}
+        except ClientError as e:
+            return {'error': str(e)}
+        
+    
+    def get_a_b_c_batch(self,portfolio,org,ring,ids,max_attempts=8):
+        '''
+        Fetches many items by id with BatchGetItem (100 keys per call).
+        UnprocessedKeys and throttled calls are retried with exponential backoff (same as batch_write).
+
+        @OUT:
+          ok: {'items':{(_id):{(row)}},'unprocessed':[(_id)]}  ids that don't exist are simply absent
+          ko: {'error':(string)}
+        '''
         portfolio_index = 'irn:data:'+portfolio
-        doc_index = org+':'+ring+':'+item['_id']
+        prefix = org+':'+ring+':'
+        found = {}
+        unprocessed_ids = []
+
+        try:
+            for i in range(0, len(ids), 100):
+                keys = [{'portfolio_index':portfolio_index,'doc_index':prefix+idx} for idx in ids[i:i+100]]
+                request_items = {DYNAMODB_RINGDATA_TABLE: {'Keys': keys}}
+
+                backoff = 0.05
+                max_backoff = 4
+                for attempt in range(max_attempts):
+                    try:
+                        response = self.dynamodb.batch_get_item(RequestItems=request_items)
+                    except ClientError as e:
+                        if e.response['Error']['Code'] not in THROTTLE_ERRORS:
+                            raise
+                        response = {'UnprocessedKeys': request_items}
+                    for row in response.get('Responses', {}).get(DYNAMODB_RINGDATA_TABLE, []):
+                        found[row['_id']] = row
+
+                    request_items = response.get('UnprocessedKeys') or {}
+                    if not request_items.get(DYNAMODB_RINGDATA_TABLE):
+                        break
+
+                    time.sleep(backoff)
+                    backoff = min(max_backoff, backoff * 2)
+                else:
+                    for key in request_items[DYNAMODB_RINGDATA_TABLE]['Keys']:
+                        unprocessed_ids.append(key['doc_index'][len(prefix):])
+
+            return {'items':found,'unprocessed':unprocessed_ids}
+
+        except ClientError as e:
+            return {'error': e.response['Error']['Message']}
+
+
+
+    def set_sort_index(self, portfolio, org, ring, idx, sort_partition, sort_index, modified):
+        '''
+        Writes the sort keys of an existing item (sort_index backfill).
+        Only if the item has not been written since it was read, a newer write already set its own keys.
+
+        @OUT:
+          ok: {'message':'Sort index set'}
+          ko: {'error':(string)} 'skipped':True if the item changed or is gone
+        '''
+        values = {':partition': sort_partition, ':index': sort_index}
+        if modified:
+            condition = "attribute_exists(doc_index) AND #modified = :modified"
+            values[':modified'] = modified
+        else:
+            condition = "attribute_exists(doc_index) AND attribute_not_exists(#modified)"
+            
+        try:
+            self.data_table.update_item(
+                Key={'portfolio_index': f'irn:data:{portfolio}', 'doc_index': f'{org}:{ring}:{idx}'},
+                UpdateExpression="SET sort_partition = :partition, sort_index = :index",
+                ConditionExpression=condition,
+                ExpressionAttributeNames={'#modified': 'modified'},
+                ExpressionAttributeValues=values
+            )
+            return {'message': 'Sort index set'}
+
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return {'error': 'Item changed', 'skipped': True}
+            return {'error': str(e)}
+
+
+
+    def put_a_b_c(self, portfolio, org, ring, idx, item, expected_version=None):
+        '''
+        Partial update in a single round trip.
+        Only the attributes sent are written, "version" is incremented on every update.
         
+        @IN:
+          item = {'attributes':{(changed attributes)},'time_index','geo_index','sort_partition','sort_index'} (indexes are optional)
+          expected_version = (int) The update only goes through if the stored version matches.
+                             0 matches items written before versioning existed.
+                             None skips the check.
         
-        new_item = item.get('attributes', {})  # Retrieve the new attributes to update
+        @OUT:
+          ok: {'message':'Item updated','item':{(row after the update)},'previous':{(row before the update)},'modified':(string),'version':(int)}
+          ko: {'error':(string)} 
+              'not_found':True if there is no such item
+              'conflict':True, 'version':(int) if the stored version is a different one
+        '''
+        
+        portfolio_index = 'irn:data:'+portfolio
+        doc_index = org+':'+ring+':'+idx
+        
+        new_item = item.get('attributes', {})  # Attributes to update
 
-        if not all([portfolio_index, doc_index, new_item]):
-            return {'error': 'Missing portfolio_index, doc_index, or items'}
+        if not new_item:
+            return {'error': 'Missing attributes'}
+        
+        timestamp = datetime.now().isoformat()
+        
+        # Placeholders are positional so any attribute name is safe in the expression
+        updates = []
+        expression_attribute_names = {'#version': 'version'}
+        expression_attribute_values = {':modified': timestamp, ':one': 1}
+        for n, (key, value) in enumerate(new_item.items()):
+            updates.append(f"attributes.#k{n} = :v{n}")
+            expression_attribute_names[f"#k{n}"] = key
+            expression_attribute_values[f":v{n}"] = value
+        updates.append("modified = :modified")
+        
+        for index in ('time_index', 'geo_index', 'sort_partition', 'sort_index'):
+            if item.get(index):
+                updates.append(f"{index} = :{index}")
+                expression_attribute_values[f':{index}'] = item[index]
+        
+        update_expression = "SET " + ", ".join(updates) + " ADD #version :one"
+        
+        condition_expression = "attribute_exists(doc_index)"
+        if expected_version is not None:
+            expression_attribute_values[':expected'] = expected_version
+            if expected_version == 0:
+                condition_expression += " AND (attribute_not_exists(#version) OR #version = :expected)"
+            else:
+                condition_expression += " AND #version = :expected"
 
         try:
-            # Fetch the current item based on the new partition key and sort key
-            response_1 = self.data_table.get_item(Key={'portfolio_index': portfolio_index, 'doc_index': doc_index})
-            if 'Item' not in response_1:
-                return {'error': 'Item not found'}
-
-            current_items = response_1['Item'].get('attributes', {})  # Retrieve the current attributes
-
-            # Build the update expression for attributes
-            update_expression = "set "  # This will hold the DynamoDB update expression
-            expression_attribute_values = {}
-            expression_attribute_names = {}
-            updates = []
-
-            # Compare new values with current values and build update expression
-            for key, new_value in new_item.items():
-                current_value = current_items.get(key)
-                if new_value != current_value:
-                    updates.append(f"attributes.#key{key} = :value{key}")
-                    expression_attribute_values[f":value{key}"] = new_value
-                    expression_attribute_names[f"#key{key}"] = key
-
-            if not updates:
-                return {'message': 'No changes detected'}
-
-            # Add a timestamp for the "modified" field
-            timestamp = datetime.now().isoformat()
-            updates.append("modified = :modified")
-            expression_attribute_values[":modified"] = timestamp
-
-            # Combine the updates into a single update expression
-            update_expression += ", ".join(updates)
-
-            # Update the item in DynamoDB
-            response_2 = self.data_table.update_item(
-                Key={'portfolio_index': portfolio_index, 'doc_index': doc_index},  # New partition and sort keys
+            response = self.data_table.update_item(
+                Key={'portfolio_index': portfolio_index, 'doc_index': doc_index},
                 UpdateExpression=update_expression,
+                ConditionExpression=condition_expression,
                 ExpressionAttributeValues=expression_attribute_values,
                 ExpressionAttributeNames=expression_attribute_names,
-                ReturnValues="UPDATED_NEW"
+                ReturnValues="ALL_OLD",
+                ReturnValuesOnConditionCheckFailure="ALL_OLD"
             )
-
-            return {'message': 'Item updated', 'response': str(response_2['Attributes'])}
+            
+            # The item after the update is the old one plus the changes (the update is atomic,
+            # nothing else can have changed it in between)
+            previous = response['Attributes']
+            row = copy.deepcopy(previous)
+            row.setdefault('attributes', {}).update(new_item)
+            row['modified'] = timestamp
+            for index in ('time_index', 'geo_index', 'sort_partition', 'sort_index'):
+                if item.get(index):
+                    row[index] = item[index]
+            row['version'] = int(previous.get('version', 0)) + 1
+            
+            return {'message': 'Item updated', 'item': row, 'previous': previous, 'modified': timestamp, 'version': row['version']}
         
         except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                current = e.response.get('Item')
+                if not current:
+                    return {'error': 'Item not found', 'not_found': True}
+                # The item exists, so it was the version check that failed
+                current_version = current.get('version', {}).get('N', 0)
+                return {'error': 'Version conflict', 'conflict': True, 'version': int(current_version)}
             return {'error': str(e)}
                                                                                                                                         
 
@@ -299,8 +689,148 @@ class DataModel:
         
 
         try: 
-            response = self.data_table.delete_item(Key={'portfolio_index': portfolio_index, 'doc_index': doc_index})
-            return {'message':'Item deleted', 'response':str(response)}
+            response = self.data_table.delete_item(Key={'portfolio_index': portfolio_index, 'doc_index': doc_index}, ReturnValues='ALL_OLD')
+            # 'previous' is None if there was nothing to delete
+            return {'message':'Item deleted', 'response':str(response), 'previous':response.get('Attributes')}
+        except ClientError as e:
+            return {'error': str(e)}
+        
+        
+    
+    #TOMBSTONES
+    # A deleted item leaves doc_index = _tomb:<org>:<ring>:<_id> (outside the ring's range, no index attributes)
+    # so incremental backups, which only see rows by their 'modified' stamp, can carry deletes.
+    #   tombstone_of   key of the deleted item
+    #   modified       when it was deleted
+    #   expires        epoch seconds, DynamoDB TTL removes the tombstone once every backup chain has it
+    
+    def put_tombstone(self,portfolio,org,ring,idx,ttl_days=35):
+        
+        portfolio_index = 'irn:data:'+portfolio
+        try:
+            self.data_table.put_item(Item={
+                'portfolio_index': portfolio_index,
+                'doc_index': f'_tomb:{org}:{ring}:{idx}',
+                'tombstone_of': {'portfolio_index': portfolio_index, 'doc_index': org+':'+ring+':'+idx},
+                'modified': datetime.now().isoformat(),
+                'expires': int(time.time()) + ttl_days * 86400
+            })
+            return {'message': 'Tombstone saved'}
+        except ClientError as e:
+            return {'error': str(e)}
+    
+    
+    
+    #RING STATS
+    # One document per ring next to its items: doc_index = _stats:<org>:<ring> (outside the ring's range)
+    #   item_count
+    #   count_<field>, sum_<field>   numeric values seen in the field and their sum
+    #   min_<field>, max_<field>     bounds, 'stale_<field>' is set when a deleted value may have been one of them
+    
+    def stats_key(self,portfolio,org,ring):
+        
+        return {'portfolio_index': 'irn:data:'+portfolio, 'doc_index': f'_stats:{org}:{ring}'}
+    
+    
+    def get_stats(self,portfolio,org,ring):
+        '''
+        @OUT:
+          ok: {(stats document)} or None if the ring has none yet
+          ko: {'error':(string)}
+        '''
+        try:
+            response = self.data_table.get_item(Key=self.stats_key(portfolio,org,ring), ConsistentRead=True)
+            return {'stats': response.get('Item')}
+        except ClientError as e:
+            return {'error': str(e)}
+        
+        
+    def put_stats(self,portfolio,org,ring,stats):
+        '''
+        Replaces the stats document (full recount)
+        '''
+        try:
+            self.data_table.put_item(Item={**self.stats_key(portfolio,org,ring), **stats})
+            return {'message': 'Stats saved'}
+        except ClientError as e:
+            return {'error': str(e)}
+    
+    
+    def update_stats(self,portfolio,org,ring,count,fields):
+        '''
+        Applies a change to the ring stats. Counters and sums use ADD so concurrent writers never
+        lose updates. Bounds are moved with conditional updates (only when the new value is beyond them).
+        
+        @IN:
+          count = (int) items added minus items removed
+          fields = {(field):{'count':(int),'sum':(Decimal),'low','high' (bounds of the added values),
+                             'removed_low','removed_high' (bounds of the removed values)}}
+        '''
+        key = self.stats_key(portfolio,org,ring)
+        
+        names = {'#count': 'item_count', '#updated': 'updated'}
+        values = {':count': count, ':updated': datetime.now().isoformat()}
+        adds = ['#count :count']
+        for n, (field, change) in enumerate(fields.items()):
+            names[f'#c{n}'] = f'count_{field}'
+            names[f'#s{n}'] = f'sum_{field}'
+            values[f':c{n}'] = change['count']
+            values[f':s{n}'] = change['sum']
+            adds.append(f'#c{n} :c{n}')
+            adds.append(f'#s{n} :s{n}')
+        
+        try:
+            response = self.data_table.update_item(
+                Key=key,
+                UpdateExpression='ADD ' + ', '.join(adds) + ' SET #updated = :updated',
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values,
+                ReturnValues='ALL_NEW'
+            )
+            stats = response['Attributes']
+            
+            for field, change in fields.items():
+                if stats.get(f'count_{field}', 0) <= 0:
+                    # No values left, the bounds mean nothing
+                    self.data_table.update_item(
+                        Key=key,
+                        UpdateExpression='REMOVE #min, #max, #stale',
+                        ExpressionAttributeNames={'#min': f'min_{field}', '#max': f'max_{field}', '#stale': f'stale_{field}'}
+                    )
+                    continue
+                
+                for bound, value, beyond in (('min', change.get('low'), '>'), ('max', change.get('high'), '<')):
+                    if value is None:
+                        continue
+                    try:
+                        self.data_table.update_item(
+                            Key=key,
+                            UpdateExpression='SET #bound = :value',
+                            ConditionExpression=f'attribute_not_exists(#bound) OR #bound {beyond} :value',
+                            ExpressionAttributeNames={'#bound': f'{bound}_{field}'},
+                            ExpressionAttributeValues={':value': value}
+                        )
+                        stats[f'{bound}_{field}'] = value
+                    except ClientError as e:
+                        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                            raise
+                
+                # A removed value on a bound means the bound may not exist anymore
+                low = stats.get(f'min_{field}')
+                high = stats.get(f'max_{field}')
+                removed_low = change.get('removed_low')
+                removed_high = change.get('removed_high')
+                if (removed_low is not None and low is not None and removed_low <= low) or \
+                   (removed_high is not None and high is not None and removed_high >= high):
+                    self.data_table.update_item(
+                        Key=key,
+                        UpdateExpression='SET #stale = :stale',
+                        ExpressionAttributeNames={'#stale': f'stale_{field}'},
+                        ExpressionAttributeValues={':stale': True}
+                    )
+                    
+            return {'message': 'Stats updated'}
+        
         except ClientError as e:
             return {'error': str(e)}
         
@@ -318,75 +848,237 @@ class DataModel:
             'ring':<ring_id>,
             'operator':'begins_with',
             'value':<value>,
-            'filter':{
-                   'operator':<greater_than|less_than>,
-                   'field':<field_to_filter_on>,
-                   'value':<value_filter_uses_on_the_field>
-                },
+            'filters':[{'field':<field>,'operator':<operator>,'value':<value>}],
             'limit':<page_limit>,
-            'lastkey':<page_lastkey>,
+            'lastkey':<LastEvaluatedKey of the previous page>,
             'sort': <asc|desc>
             }
         '''
         
+        path_index = self.path_index_head(query)
+        if query.get('value'):
+            path_index += f':{query["value"]}'
+            
+        return self.query_index(query, Key('path_index').begins_with(path_index))
+    
+    
+    def get_a_b_greaterthan(self,query):
+        '''
+        Items whose index is greater than <head>:<value> (string order)
+        '''
+        bound = f'{self.path_index_head(query)}:{query["value"]}'
         
-        portfolio_index = f'irn:data:{query["portfolio"]}'  # This will be used as the partition key (PK)
-        path_index_head = f'irn:h_index:{query["org"]}:{query["ring"]}'
-        if 'value' not in query or not query['value']:
-            path_index_tail = ''
-        else:
-            path_index_tail = f':{query["value"]}'
-        path_index = path_index_head + path_index_tail
+        # ';' sorts right after ':' so it closes the range of this ring (and prefix)
+        upper = self.path_index_head(query) + ';'
+        
+        # The key condition is inclusive, the bound itself is dropped from the results
+        return self.query_index(query, Key('path_index').between(bound, upper), drop=bound)
+    
+    
+    def get_a_b_lessthan(self,query):
+        '''
+        Items whose index is less than <head>:<value> (string order)
+        '''
+        bound = f'{self.path_index_head(query)}:{query["value"]}'
+        lower = self.path_index_head(query) + ':'
+        
+        return self.query_index(query, Key('path_index').between(lower, bound), drop=bound)
+    
+    
+    def get_a_b_equalto(self,query):
+        '''
+        Items whose index is exactly <head>:<value>
+        '''
+        path_index = f'{self.path_index_head(query)}:{query["value"]}'
+        
+        return self.query_index(query, Key('path_index').eq(path_index))
+    
+    
+    def get_a_b_between(self,query):
+        '''
+        Items whose index is between <head>:<value[0]> and <head>:<value[1]> (both included)
+        '''
+        head = self.path_index_head(query)
+        low, high = query['value']
+        
+        return self.query_index(query, Key('path_index').between(f'{head}:{low}', f'{head}:{high}'))
+    
+    
+    def get_a_b_timewindow(self,query):
+        '''
+        Items whose time_index falls in [from, to). Newest first unless sort is 'asc'
+        
+        @IN:
+          query['window'] = ((int) from ms,(int) to ms)
+        '''
+        start, end = query['window']
+        prefix = f'{query["org"]}:{query["ring"]}'
+        
+        # time_index is <prefix>:<13 digits>:<_id>, so '<prefix>:<to>' sorts after every id at to - 1 
+        # and before every id at 'to' (upper end excluded)
+        key_condition = Key('time_index').between(f'{prefix}:{start:013d}', f'{prefix}:{end:013d}')
+        
+        return self.query_index(query, key_condition, index='time_index', forward=query.get('sort') == 'asc')
+    
+    
+    def get_a_b_geo_candidates(self,portfolio,org,ring,prefixes,max_items=5000,workers=9):
+        '''
+        Keys of the items under each geohash prefix (geo_index is KEYS_ONLY).
+        One query per prefix, all of them in parallel.
         
+        @OUT:
+          ok: {'candidates':[((_id),(geohash))],'truncated':(bool)}
+          ko: {'error':(string)}
+        '''
+        portfolio_index = f'irn:data:{portfolio}'
+        head = f'{org}:{ring}:'
+        
+        def fetch(prefix):
+            table = self.segment_table()
+            query_params = {
+                'IndexName': 'geo_index',
+                'KeyConditionExpression': Key('portfolio_index').eq(portfolio_index) & Key('geo_index').begins_with(head + prefix)
+            }
+            found = []
+            while True:
+                response = table.query(**query_params)
+                for row in response.get('Items', []):
+                    # geo_index = <org>:<ring>:<geohash>:<_id>
+                    geohash, _id = row['geo_index'][len(head):].split(':', 1)
+                    found.append((_id, geohash))
+                endkey = response.get('LastEvaluatedKey')
+                if not endkey or len(found) >= max_items:
+                    return found, bool(endkey)
+                query_params['ExclusiveStartKey'] = endkey
+        
+        try:
+            with ThreadPoolExecutor(max_workers=min(workers, len(prefixes)) or 1) as pool:
+                results = list(pool.map(fetch, prefixes))
+        except (BotoCoreError, ClientError) as e:
+            return {'error': str(e)}
+        
+        candidates = []
+        truncated = False
+        for found, more in results:
+            candidates.extend(found)
+            truncated = truncated or more
+            
+        if len(candidates) > max_items:
+            candidates = candidates[:max_items]
+            truncated = True
+            
+        return {'candidates': candidates, 'truncated': truncated}
+    
+    
+    def path_index_head(self,query):
+        '''
+        Every path_index of a ring starts with this. 'prefix' narrows it down further (used when
+        a range is applied to the part of the index that comes after a begins_with value)
+        '''
+        head = f'irn:h_index:{query["org"]}:{query["ring"]}'
+        if query.get('prefix'):
+            head += f':{query["prefix"]}'
+        return head
+    
+    
+    def build_filter(self,filters):
+        '''
+        FilterExpression on the item attributes. Clauses are joined with AND
+        
+        @IN:
+          filters = [{'field':(string),'operator':<greater_than|less_than|equal_to|between|begins_with>,'value':(value)}]
+        '''
+        expression = None
+        for clause in filters:
+            attribute = Attr(f'attributes.{clause["field"]}')
+            operator = clause['operator']
+            value = clause['value']
+            
+            if operator == 'greater_than':
+                condition = attribute.gt(value)
+            elif operator == 'less_than':
+                condition = attribute.lt(value)
+            elif operator == 'equal_to':
+                condition = attribute.eq(value)
+            elif operator == 'between':
+                condition = attribute.between(value[0], value[1])
+            elif operator == 'begins_with':
+                condition = attribute.begins_with(value)
+            else:
+                raise ValueError(f'Unknown filter operator: {operator}')
+            
+            expression = condition if expression is None else expression & condition
+            
+        return expression
+    
+    
+    def query_index(self,query,key_condition,index='path_index',forward=None,drop=None,max_calls=10):
+        '''
+        Runs a query on one of the LSIs. Filters are applied by DynamoDB, so a page can come
+        back short; more calls are made (up to max_calls) until the page is full or the range ends.
+        
+        @IN:
+          index = (string) path_index or time_index. time_index only projects the keys and path_index,
+                  the rest of the item is fetched from the table by DynamoDB (ALL_ATTRIBUTES)
+          forward = (bool) ScanIndexForward, by default it comes from query['sort']:
+                    'asc' or no sort is index order, 'desc' the reverse
+          drop = (string) path_index excluded from the results (strict bounds of a between)
+        
+        @OUT:
+          ok: {'items':[{(row)}],'lastkey':(LastEvaluatedKey) or None}
+          ko: {'error':(string)}
+        '''
+        
+        portfolio_index = f'irn:data:{query["portfolio"]}'  # This will be used as the partition key (PK)
+        limit = query['limit']
         
         try:
             # Build the query parameters with KeyConditionExpression
+            if forward is None:
+                forward = query.get('sort') != 'desc'
+                
             query_params = {
-                'TableName': DYNAMODB_RINGDATA_TABLE,  # Make sure this references the correct DynamoDB table
-                'IndexName': 'path_index',  # Specify the name of your secondary index
-                'KeyConditionExpression': Key('portfolio_index').eq(portfolio_index) & Key('path_index').begins_with(path_index),  # Include both keys
-                'Limit': query['limit'],
-                "ScanIndexForward": False if query['sort'] == 'asc' else True
+                'IndexName': index,
+                'KeyConditionExpression': Key('portfolio_index').eq(portfolio_index) & key_condition,
+                'Select': 'ALL_ATTRIBUTES',
+                "ScanIndexForward": forward
             }
             
-            print(f'portfolio_index >>> {portfolio_index}')
-            print(f'path_index >>> {path_index}')
-            print(f'QUERY PARAMS >>> {query_params}')
-
+            if query.get('filters'):
+                query_params['FilterExpression'] = self.build_filter(query['filters'])
+                
+            if query.get('fields'):
+                # Replaces ALL_ATTRIBUTES (still fetched from the table for time_index)
+                del query_params['Select']
+                query_params.update(self.projection(query['fields']))
+            
             # Add the ExclusiveStartKey to the query parameters if provided (for pagination)
-            if query['lastkey']:
-                query_params['ExclusiveStartKey'] = query['lastkey'] 
-
-            # Query DynamoDB to get items with matching PK and SK prefix
-            response = self.data_table.query(**query_params)
+            endkey = query.get('lastkey')
+            items = []
+            calls = 0
             
-            # Extract items and pagination key
-            items = response.get('Items', [])
-            endkey = response.get('LastEvaluatedKey')  # Pagination key for next query
-
-            # Build the result
-            result = {
-                'items': items,
-                'lastkey': endkey  # This will be passed as 'lastkey' in the next call if needed
-            }
+            while True:
+                if endkey:
+                    query_params['ExclusiveStartKey'] = endkey
+                # Never read past what the page can hold so the cursor stays exact
+                query_params['Limit'] = limit - len(items)
+                
+                response = self.data_table.query(**query_params)
+                calls += 1
+                
+                for row in response.get('Items', []):
+                    if drop is None or row.get('path_index') != drop:
+                        items.append(row)
+                        
+                endkey = response.get('LastEvaluatedKey')
+                if not endkey or len(items) >= limit or calls >= max_calls:
+                    break
 
-            return result
+            return {'items': items, 'lastkey': endkey}
 
         except (BotoCoreError, ClientError) as e:
             return {"error": str(e)}   
-    
-    
-    def get_a_b_greaterthan(self,portfolio_index,path_index):
-        
-        return {'message': 'This feature is not implemented yet'}
-    
-    def get_a_b_lessthan(self,portfolio_index,path_index):
-        
-        return {'message': 'This feature is not implemented yet'}
-    
-    def get_a_b_equalto(self,portfolio_index,path_index):
-        
-        return {'message': 'This feature is not implemented yet'}
+
     
     
     
\ No newline at end of file
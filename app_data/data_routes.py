@@ -1,11 +1,13 @@
 #app_data.py
-from flask import Blueprint,request,redirect,url_for, jsonify, current_app, session, render_template, make_response
+from flask import Blueprint,request,redirect,url_for, jsonify, current_app, session, render_template, make_response, Response, stream_with_context
 from app_auth.login_required import login_required
 from app_auth.auth_controller import AuthController
 from app_data.data_controller import DataController
 from flask_cognito import cognito_auth_required, current_user, current_cognito_jwt
 
 import time,json,csv
+import gzip
+from common import gzip_chunks
 import io
 import urllib.parse
 import boto3
@@ -17,6 +19,37 @@ app_data = Blueprint('app_data', __name__, template_folder='templates',url_prefi
 AUC = AuthController()
 DAC = DataController()
 
+
+def accepts_gzip():
+
+    return request.accept_encodings['gzip'] > 0
+
+
+@app_data.after_request
+def compress_response(response):
+    '''
+    Gzips JSON responses when the client takes it (streamed responses compress themselves)
+    '''
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers or response.mimetype != 'application/json'):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    if not accepts_gzip():
+        return response
+
+    data = response.get_data()
+    if len(data) < current_app.config.get('COMPRESS_MIN_SIZE', 1024):
+        return response
+
+    response.set_data(gzip.compress(data, 6))
+    response.headers['Content-Encoding'] = 'gzip'
+    # Not the same bytes as the identity version any more
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
 # Set the route and accepted methods
 
 
@@ -36,6 +69,13 @@ def t1():
     return jsonify(message="t1")
     
 
+@app_data.route('/_cache', methods=['GET'])
+@cognito_auth_required
+def get_cache_stats():
+
+    return jsonify(DAC.get_cache_stats())
+
+
 #TANK-FE *
 @app_data.route('/<string:portfolio>/<string:org>/<string:ring>', methods=['GET'])
 @cognito_auth_required
@@ -50,30 +90,141 @@ def route_a_b_get(portfolio, org, ring):
     response = []
     
     if all or refresh:  # Check if 'all' or 'refresh' is present
-        s3_client = boto3.client('s3')
-        bucket_name = current_app.config['S3_BUCKET_NAME']  
-        file_path = f'data/{portfolio}/{org}/{ring}'
+        if refresh:
+            current_app.logger.debug('Refresh is set. Regenerating document.')
+            return DAC.refresh_s3_cache(portfolio, org, ring)
         
-        try:
-            # Check if this document already exists in S3
-            s3_client.head_object(Bucket=bucket_name, Key=file_path)
-            # If it exists and refresh is set, raise an exception to trigger regeneration
-            if refresh:
-                current_app.logger.debug('Document exists, but refresh is set. Raising exception to regenerate document.')
-                raise Exception("Force regeneration due to refresh flag.")
-            else:
-                response = s3_client.get_object(Bucket=bucket_name, Key=file_path)
-                document = json.loads(response['Body'].read())
-                current_app.logger.debug('Document already exists, retrieving from S3')
-                return jsonify(document), 200
-        except (s3_client.exceptions.ClientError, Exception) as e:
-            # If it does not exist or if we raised an exception, call DAC.get_a_b()
-            DAC.refresh_s3_cache(portfolio, org, ring, sort)
+        # Snapshot base + pending deltas, streamed in chunks (rebuilt from DynamoDB if it doesn't exist)
+        fmt = request.args.get('format', 'json')
+        mimetype = 'application/x-ndjson' if fmt == 'ndjson' else 'application/json'
+        fields, error = DAC.parse_fields(request.args.get('fields'))
+        if error:
+            return {'success':False,'message':error}, 400
+        etag, stream, encoding = DAC.stream_s3_cache(portfolio, org, ring, fmt, fields, request.if_none_match, accepts_gzip())
+        if stream is None:
+            # The client already has this version of the snapshot
+            response = Response(status=304)
+        else:
+            response = Response(stream_with_context(stream), mimetype=mimetype)
+            if encoding:
+                response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        if etag:
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'no-cache'
+        return response
         
     else:
-        response = DAC.get_a_b(portfolio, org, ring, limit, lastkey, sort)
-        return jsonify(response), 200  # Ensure a consistent JSON response
+        response = DAC.get_a_b(portfolio, org, ring, limit, lastkey, sort, request.args.get('fields'))
+        # Pages come from DynamoDB, the ETag only saves the download
+        response = jsonify(response)  # Ensure a consistent JSON response
+        response.add_etag()
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
+    
+
+@app_data.route('/<string:portfolio>/<string:org>/<string:ring>/_snapshot', methods=['GET'])
+@cognito_auth_required
+def route_a_b_snapshot_get(portfolio, org, ring):
+    
+    response, status = DAC.snapshot_status(portfolio, org, ring)
+    return response, status
+
+
+@app_data.route('/<string:portfolio>/<string:org>/<string:ring>/_snapshot', methods=['POST'])
+@cognito_auth_required
+def route_a_b_snapshot_post(portfolio, org, ring):
+    
+    # Starts a snapshot build or continues the one in progress (restart=1 starts over)
+    restart = request.args.get('restart')
+    return DAC.refresh_s3_cache(portfolio, org, ring, restart=bool(restart))
+
+
+@app_data.route('/<string:portfolio>/<string:org>/<string:ring>/_sortindex', methods=['POST'])
+@cognito_auth_required
+def route_a_b_sortindex_post(portfolio, org, ring):
+
+    # Indexes the items written before the sort field was declared, then turns the sorted read on
+    response, status = DAC.backfill_sort_index(portfolio, org, ring)
+    return response, status
+
+
+#TANK-FE *
+@app_data.route('/<string:portfolio>/<string:org>/<string:ring>/_export', methods=['GET'])
+@cognito_auth_required
+def route_a_b_export(portfolio, org, ring):
+    '''
+    Parquet export of the ring, written to S3 (full=1 writes the whole ring again, see DataController.export_columnar).
+    Needs pyarrow (requirements.txt), answers 501 where it is not installed.
+    '''
+    fmt = request.args.get('format', 'columnar')
+    if fmt != 'columnar':
+        return {'success':False,'message':'Unknown export format'}, 400
+    
+    response, status = DAC.export_columnar(portfolio, org, ring, full=bool(request.args.get('full')))
+    return response, status
+
+
+@app_data.route('/<string:portfolio>/<string:org>/<string:ring>/_export.csv', methods=['GET'])
+@cognito_auth_required
+def route_a_b_export_csv(portfolio, org, ring):
     
+    stream, error, status = DAC.export_csv(portfolio, org, ring)
+    if error:
+        return error, status
+    
+    encoding = None
+    if accepts_gzip():
+        stream = gzip_chunks(stream)
+        encoding = 'gzip'
+    
+    response = Response(stream_with_context(stream), mimetype='text/csv')
+    response.headers['Content-Disposition'] = f'attachment; filename="{ring}.csv"'
+    response.vary.add('Accept-Encoding')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+
+@app_data.route('/<string:portfolio>/<string:org>/<string:ring>/_import', methods=['POST'])
+@cognito_auth_required
+def route_a_b_import(portfolio, org, ring):
+    
+    # A file upload (up_file), or JSON {'key':'_docs/...'} to import a stored file, or {'job':(job_id)} to continue
+    up_file = request.files.get('up_file')
+    if up_file:
+        response, status = DAC.import_a_b(portfolio, org, ring, upload=up_file.stream, filename=up_file.filename, fmt=request.form.get('format'))
+        return response, status
+    
+    payload = request.get_json(silent=True) or {}
+    response, status = DAC.import_a_b(portfolio, org, ring, key=payload.get('key'), fmt=payload.get('format'), job_id=payload.get('job'))
+    return response, status
+
+
+@app_data.route('/<string:portfolio>/<string:org>/<string:ring>/_import/<string:job_id>', methods=['GET'])
+@cognito_auth_required
+def route_a_b_import_status(portfolio, org, ring, job_id):
+    
+    response, status = DAC.import_status(portfolio, org, ring, job_id)
+    return response, status
+
+
+@app_data.route('/<string:portfolio>/<string:org>/<string:ring>/_stats', methods=['GET'])
+@cognito_auth_required
+def route_a_b_stats_get(portfolio, org, ring):
+    
+    response, status = DAC.get_stats(portfolio, org, ring)
+    return response, status
+
+
+@app_data.route('/<string:portfolio>/<string:org>/<string:ring>/_stats', methods=['POST'])
+@cognito_auth_required
+def route_a_b_stats_post(portfolio, org, ring):
+    
+    # Full recount, the GET is served from the counters kept on every write
+    response, status = DAC.recount_stats(portfolio, org, ring)
+    return response, status
+
 
 #TANK-FE *
 @app_data.route('/<string:portfolio>/_all/<string:ring>', methods=['POST'])
@@ -82,7 +233,6 @@ def route_a_all_post(portfolio,ring):
     
     payload = request.get_json()
     response, status = DAC.post_a_b(portfolio,'_all',ring,payload)
-    DAC.refresh_s3_cache(portfolio, '_all', ring, None)
     return response, status
     
 
@@ -93,7 +243,26 @@ def route_a_b_post(portfolio,org,ring):
     
     payload = request.get_json()
     response, status = DAC.post_a_b(portfolio,org,ring,payload)
-    DAC.refresh_s3_cache(portfolio, org, ring, None)
+    return response, status
+
+
+
+@app_data.route('/<string:portfolio>/<string:org>/<string:ring>/_batch', methods=['POST'])
+@cognito_auth_required
+def route_a_b_batch_post(portfolio,org,ring):
+    
+    payload = request.get_json()
+    response, status = DAC.post_a_b_batch(portfolio,org,ring,payload)
+    return response, status
+
+
+
+@app_data.route('/<string:portfolio>/<string:org>/<string:ring>/_mget', methods=['POST'])
+@cognito_auth_required
+def route_a_b_mget(portfolio,org,ring):
+    
+    payload = request.get_json()
+    response, status = DAC.get_a_b_c_batch(portfolio,org,ring,payload)
     return response, status
 
 
@@ -126,7 +295,7 @@ def route_a_b_query(portfolio, org, ring):
     This is a special case where the index is a timestamp  portfolio:org:ring:<timestamp> 
     In the background it is a 'begins_with' with an empty sufix
     Value is always empty. 
-    Returns a list of items ordered chronologically. 
+    Returns a list of items ordered chronologically, oldest first ('sort':'asc', the default) or newest first ('sort':'desc'). 
     The filter is optional but recommended to shorten the response size
     {
         'operator':'chrono',
@@ -146,12 +315,13 @@ def route_a_b_query(portfolio, org, ring):
         'value':payload.get('value', None),
         'filter':payload.get('filter',{}),
         'limit':limit,
-        'lastkey':lastkey,
-        'sort': payload.get('sort', sort)
+        'lastkey':payload.get('lastkey', lastkey),
+        'sort': payload.get('sort', sort),
+        'fields': payload.get('fields', request.args.get('fields'))
     }
        
-    response = DAC.get_a_b_query(query)
-    return response, 200
+    response, status = DAC.get_a_b_query(query)
+    return response, status
 
 
 
@@ -160,7 +330,11 @@ def route_a_b_query(portfolio, org, ring):
 @cognito_auth_required
 def route_a_b_c_get(portfolio,org,ring,idx):
 
-    return DAC.get_a_b_c(portfolio,org,ring,idx)
+    response, version = DAC.get_a_b_c_versioned(portfolio,org,ring,idx)
+    if version is not None:
+        # Send it back as If-Match to make the next PUT conditional
+        return response, 200, {'ETag': DAC.make_etag(version)}
+    return response
 
     
 #TANK-FE *
@@ -169,8 +343,9 @@ def route_a_b_c_get(portfolio,org,ring,idx):
 def route_a_b_c_put(portfolio,org,ring,idx):
     
     payload = request.get_json()
-    response, status = DAC.put_a_b_c(portfolio,org,ring,idx,payload)
-    DAC.refresh_s3_cache(portfolio, org, ring, None)
+    response, status = DAC.put_a_b_c(portfolio,org,ring,idx,payload,if_match=request.headers.get('If-Match'))
+    if status == 200:
+        return response, status, {'ETag': DAC.make_etag(response['version'])}
     return response, status
 
 
@@ -180,7 +355,6 @@ def route_a_b_c_put(portfolio,org,ring,idx):
 def route_a_b_c_delete(portfolio,org,ring,idx):
 
     response, status = DAC.delete_a_b_c(portfolio,org,ring,idx)
-    DAC.refresh_s3_cache(portfolio, org, ring, None)
     return response, status
 
 
@@ -0,0 +1,1159 @@
+#data_snapshot.py
+from flask import current_app
+import boto3
+import hashlib
+import itertools
+import json
+import struct
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from common import DecimalEncoder, gzip_chunks, gunzip_chunks
+from env_config import DYNAMODB_RINGDATA_TABLE
+
+
+# Base objects are written one item per line so they can be streamed without parsing the whole document
+BASE_HEAD = b'{"items":[\n'
+BASE_SEP = b',\n'
+BASE_FOOT = b'\n],"last_id":null,"success":true}\n'
+
+# Size of the chunks yielded to the client and of the multipart upload parts
+STREAM_CHUNK = 64 * 1024
+PART_SIZE = 8 * 1024 * 1024
+
+# Gzip member header written by hand (no name, no mtime) so a build can span invocations, see SnapshotWriter
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+GZIP_LEVEL = 6
+
+
+# Times a read starts over when a compaction removes log entries under it
+READ_ATTEMPTS = 3
+
+
+# Keys of the FE item shape that are always sent
+ITEM_META = ('_id', '_modified', '_index')
+
+
+def project(item,fields):
+    '''
+    FE item restricted to some attributes (plus _id, _modified and _index)
+    '''
+    return {key:item[key] for key in itertools.chain(ITEM_META, fields) if key in item}
+
+
+
+class LogBacklog(Exception):
+    '''
+    More deltas are pending than one read merges (SNAPSHOT_MAX_PENDING). The caller streams the ring
+    from DynamoDB instead, publishing over the base it came from (base_etag)
+    '''
+
+    def __init__(self,base_etag,pending):
+        super().__init__(f'{pending} pending deltas')
+        self.base_etag = base_etag
+
+
+
+class LogCompacted(Exception):
+    '''
+    A pending log entry disappeared while it was being read: another reader compacted it into a newer base
+    '''
+
+
+
+class BuildBusy(Exception):
+    '''
+    Another invocation holds the lease on the ring's snapshot build (or took it over)
+    '''
+
+    def __init__(self,progress=None):
+        super().__init__('Snapshot build in progress elsewhere')
+        self.progress = progress
+
+
+
+class SnapshotWriter:
+    '''
+    Writes a base object with an S3 multipart upload so memory stays flat (one part buffered at most).
+    Nothing is visible to readers until close() completes the upload. With if_match (the ETag of the
+    base it was derived from) close() fails if that base has been replaced in the meantime, with
+    if_none_match if any base has been published in the meantime.
+
+    With encoding='gzip' the object is stored compressed (Content-Encoding: gzip). The deflate stream is
+    framed by hand: a compressor can't be saved between invocations, so suspend() byte-aligns the stream
+    (sync flush) and returns the running CRC and size. The next invocation carries on with a fresh
+    compressor and the object is still a single gzip member.
+    '''
+
+    def __init__(self,s3_client,bucket,key,log_mark,upload_id=None,parts=None,buffer=b'',encoding=None,gzip_state=None,if_match=None,content_type='application/json',if_none_match=False):
+
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.if_match = if_match
+        self.if_none_match = if_none_match
+        self.buffer = bytearray(buffer)
+        self.parts = parts or []
+        self.encoding = encoding
+        self.compressor = None
+
+        if encoding == 'gzip':
+            self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, -15)
+            state = gzip_state or {'crc':0,'size':0}
+            self.crc = state['crc']
+            self.size = state['size']
+
+        if upload_id:
+            # Resuming an upload started by an earlier invocation
+            self.upload_id = upload_id
+            return
+
+        params = {
+            'Bucket':bucket,
+            'Key':key,
+            'ContentType':content_type,
+            'Metadata':{'log-mark': log_mark or ''}
+        }
+        if encoding:
+            params['ContentEncoding'] = encoding
+            self.buffer.extend(GZIP_HEADER)
+
+        response = self.s3_client.create_multipart_upload(**params)
+        self.upload_id = response['UploadId']
+
+
+    def write(self,data):
+
+        if self.compressor:
+            self.crc = zlib.crc32(data, self.crc)
+            self.size += len(data)
+            data = self.compressor.compress(data)
+
+        self.buffer.extend(data)
+        if len(self.buffer) >= PART_SIZE:
+            self.flush()
+
+
+    def suspend(self):
+        '''
+        Called before the buffer is saved for a later invocation
+
+        @OUT:
+          gzip_state to pass to the next writer (None if not compressed)
+        '''
+        if not self.compressor:
+            return None
+
+        self.buffer.extend(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        return {'crc':self.crc,'size':self.size}
+
+
+    def flush(self):
+
+        if not self.buffer:
+            return
+        part_number = len(self.parts) + 1
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=bytes(self.buffer)
+        )
+        self.parts.append({'PartNumber':part_number,'ETag':response['ETag']})
+        self.buffer = bytearray()
+
+
+    def close(self):
+
+        if self.compressor:
+            self.buffer.extend(self.compressor.flush())
+            self.buffer.extend(struct.pack('<II', self.crc & 0xffffffff, self.size & 0xffffffff))
+
+        # The last part is allowed to be smaller than the 5MB minimum
+        self.flush()
+        params = {}
+        if self.if_match:
+            params['IfMatch'] = self.if_match
+        elif self.if_none_match:
+            params['IfNoneMatch'] = '*'
+        self.s3_client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={'Parts':self.parts},
+            **params
+        )
+
+
+    def abort(self):
+
+        try:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        except Exception as e:
+            current_app.logger.error(f'Could not abort snapshot upload {self.key}: {str(e)}')
+
+
+
+class DataSnapshot:
+    '''
+    Ring snapshots stored in S3.
+
+    The base object lives in data/{portfolio}/{org}/{ring} (same key the ?all=1 view has always used).
+    Writes, edits and deletes are not folded into the base right away. Each one is stored as a small
+    delta object in the append-only log next to it:
+
+        data/{portfolio}/{org}/{ring}/_log/s{seq}
+
+    seq comes from a per ring counter in DynamoDB (doc_index = _logseq:<org>:<ring>, atomic ADD), so log
+    keys sort in the order the writes were sequenced whatever the clocks of the containers say.
+    The base records (in its S3 metadata) the last log key already folded into it ("log mark").
+    Readers apply every log entry after the mark on top of the base.
+    Once enough entries pile up, they are folded into a new base and deleted (compaction). Writers
+    compact every SNAPSHOT_COMPACT_THRESHOLD appends (see compaction_due), readers that find that many
+    pending compact while they stream, so the log stays short whether the ring is read or not.
+    A full rebuild from DynamoDB (SnapshotBuilder) is only needed when there is no base at all or when it is forced.
+
+    A writer takes its number before its PUT lands, so the log can briefly show seq 7 without seq 6.
+    Compaction waits until such a gap is filled (or is older than SNAPSHOT_LOG_GAP_TIMEOUT, a writer
+    that died between the two). Otherwise the new base's mark would pass over seq 6 and it would never be read.
+    '''
+
+    def __init__(self):
+
+        self.s3_client = boto3.client('s3')
+        self.dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+        self.seq_table = self.dynamodb.Table(DYNAMODB_RINGDATA_TABLE)
+
+
+    def base_key(self,portfolio,org,ring):
+        return f'data/{portfolio}/{org}/{ring}'
+
+
+    def log_prefix(self,portfolio,org,ring):
+        return f'data/{portfolio}/{org}/{ring}/_log/'
+
+
+    def log_key(self,portfolio,org,ring,seq):
+        # Zero padded so lexicographic order == sequence order
+        return f'{self.log_prefix(portfolio,org,ring)}s{seq:020d}'
+
+
+    def log_seq(self,key):
+        '''
+        Sequence number of a log key or mark
+        '''
+        name = key.rsplit('/', 1)[-1]
+        return int(name[1:]) if name.startswith('s') else None
+
+
+    def seq_key(self,portfolio,org,ring):
+        return {'portfolio_index': 'irn:data:'+portfolio, 'doc_index': f'_logseq:{org}:{ring}'}
+
+
+    def next_log_seq(self,portfolio,org,ring):
+
+        response = self.seq_table.update_item(
+            Key=self.seq_key(portfolio,org,ring),
+            UpdateExpression='ADD #seq :one',
+            ExpressionAttributeNames={'#seq': 'seq'},
+            ExpressionAttributeValues={':one': 1},
+            ReturnValues='UPDATED_NEW'
+        )
+        return int(response['Attributes']['seq'])
+
+
+    def current_mark(self,portfolio,org,ring):
+        '''
+        Mark covering every delta sequenced so far. Taken before a full read of the ring:
+        the writes behind those deltas are already in DynamoDB, so the read sees them.
+        '''
+        response = self.seq_table.get_item(Key=self.seq_key(portfolio,org,ring), ConsistentRead=True)
+        return self.log_key(portfolio,org,ring,int(response.get('Item', {}).get('seq', 0)))
+
+
+    def bucket(self):
+        return current_app.config['S3_BUCKET_NAME']
+
+
+    def encoding(self):
+        # How new bases are stored. Bases written before compression existed are read as they are
+        return 'gzip' if current_app.config.get('SNAPSHOT_COMPRESSION', 'gzip') == 'gzip' else None
+
+
+
+    def append(self,portfolio,org,ring,puts=None,deletes=None):
+        '''
+        Appends one delta to the ring log.
+
+        @IN:
+          puts = [{(item in FE shape: attributes + _id,_modified,_index)}]
+          deletes = [(_id)]
+
+        @OUT:
+          ok: {'success':True,'key':(log key)}
+          ko: {'success':False,'error':(string)}
+        '''
+
+        ops = []
+        for item in puts or []:
+            ops.append({'op':'put','item':item})
+        for idx in deletes or []:
+            ops.append({'op':'delete','_id':idx})
+
+        if not ops:
+            return {'success':True,'key':None}
+
+        key = None
+        try:
+            clock = time.monotonic()
+            key = self.log_key(portfolio,org,ring,self.next_log_seq(portfolio,org,ring))
+            self.s3_client.put_object(
+                Bucket=self.bucket(),
+                Key=key,
+                Body=json.dumps({'ops':ops}, cls=DecimalEncoder),
+                ContentType='application/json'
+            )
+        except Exception as e:
+            current_app.logger.error(f'Could not append to ring log {key}: {str(e)}')
+            return {'success':False,'error':str(e)}
+
+        if time.monotonic() - clock >= current_app.config.get('SNAPSHOT_LOG_GAP_TIMEOUT', 60) / 2:
+            # Slow enough that a compaction may have given up on this number and passed over it
+            return {'success':False,'error':f'Ring log append took too long, {key} may be skipped'}
+
+        return {'success':True,'key':key}
+
+
+
+    def compaction_due(self,key):
+        '''
+        True for one append out of SNAPSHOT_COMPACT_THRESHOLD: that writer compacts the log
+        '''
+        seq = self.log_seq(key) if key else None
+        threshold = current_app.config.get('SNAPSHOT_COMPACT_THRESHOLD', 50)
+        return seq is not None and seq % threshold == 0
+
+
+
+    def list_log(self,portfolio,org,ring,after=None):
+        '''
+        Returns the log keys written after the given mark, oldest first
+        '''
+        entries, server_time = self.list_log_entries(portfolio,org,ring,after)
+        return [key for key, modified in entries]
+
+
+
+    def list_log_entries(self,portfolio,org,ring,after=None):
+        '''
+        @OUT:
+          ([((log key), (LastModified))] oldest first, (S3 time of the listing))
+          S3's own clock, so the age of an entry does not depend on the clock of this container
+        '''
+        entries = []
+        server_time = None
+        params = {
+            'Bucket':self.bucket(),
+            'Prefix':self.log_prefix(portfolio,org,ring)
+        }
+        if after:
+            params['StartAfter'] = after
+
+        while True:
+            response = self.s3_client.list_objects_v2(**params)
+            if server_time is None:
+                date = response.get('ResponseMetadata', {}).get('HTTPHeaders', {}).get('date')
+                server_time = parsedate_to_datetime(date) if date else None
+            for obj in response.get('Contents', []):
+                entries.append((obj['Key'], obj['LastModified']))
+
+            if not response.get('IsTruncated'):
+                break
+            params['ContinuationToken'] = response['NextContinuationToken']
+
+        return entries, server_time
+
+
+
+    def settled_mark(self,entries,log_mark,server_time):
+        '''
+        Furthest mark that is safe to record: the last log key before the first gap a writer may
+        still fill (see the class docstring). Entries after it must be read again next time.
+        '''
+        gap_timeout = current_app.config.get('SNAPSHOT_LOG_GAP_TIMEOUT', 60)
+        expected = self.log_seq(log_mark) + 1 if log_mark else 1
+
+        mark = log_mark
+        for key, modified in entries:
+            seq = self.log_seq(key)
+            if seq > expected and (server_time is None or (server_time - modified).total_seconds() < gap_timeout):
+                break
+            expected = max(expected, seq + 1)
+            mark = key
+
+        return mark
+
+
+
+    def read_log(self,key,bucket=None):
+
+        response = self.s3_client.get_object(Bucket=bucket or self.bucket(), Key=key)
+        return json.loads(response['Body'].read()).get('ops', [])
+
+
+
+    def pending_ops(self,portfolio,org,ring,log_mark):
+        '''
+        Loads the delta operations logged after the mark
+
+        @OUT:
+          (ops, (mark) to resume from next time, see settled_mark())
+        '''
+        entries, server_time = self.list_log_entries(portfolio,org,ring,after=log_mark)
+        ops = self.read_ops([key for key, modified in entries])
+        return ops, self.settled_mark(entries, log_mark, server_time)
+
+
+
+    def read_ops(self,pending):
+        '''
+        Delta operations stored in some log keys, in log order.
+        The keys are fetched in parallel (SNAPSHOT_LOG_READ_WORKERS at a time).
+        Raises LogCompacted if one is gone: it is in a newer base than the one being read, the
+        caller starts over from that base (skipping it would lose the delta).
+        '''
+        if not pending:
+            return []
+
+        # Worker threads have no app context
+        bucket = self.bucket()
+        workers = min(current_app.config.get('SNAPSHOT_LOG_READ_WORKERS', 16), len(pending))
+
+        ops = []
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            try:
+                for entry in pool.map(lambda key: self.read_log(key, bucket), pending):
+                    ops.extend(entry)
+            except self.s3_client.exceptions.NoSuchKey as e:
+                raise LogCompacted(str(e))
+
+        return ops
+
+
+
+    def compact(self,portfolio,org,ring):
+        '''
+        Folds the settled log entries into a new base without a reader (see compaction_due).
+        Only published over the base it was read from, a compaction that lost the race changes nothing.
+
+        @OUT:
+          (int) entries folded, None when there is no base yet (the caller builds one)
+        '''
+        for attempt in range(READ_ATTEMPTS):
+            try:
+                response = self.s3_client.get_object(Bucket=self.bucket(), Key=self.base_key(portfolio,org,ring))
+            except self.s3_client.exceptions.NoSuchKey:
+                return None
+
+            log_mark = response.get('Metadata', {}).get('log-mark') or None
+            entries, server_time = self.list_log_entries(portfolio,org,ring,after=log_mark)
+            mark = self.settled_mark(entries, log_mark, server_time)
+            pending = [key for key, modified in entries if mark and key <= mark]
+            if not pending:
+                response['Body'].close()
+                return 0
+
+            try:
+                ops = self.read_ops(pending)
+                break
+            except LogCompacted:
+                response['Body'].close()
+                if attempt == READ_ATTEMPTS - 1:
+                    raise
+
+        current_app.logger.debug(f'Compacting ring snapshot {portfolio}/{org}/{ring} on write ({len(pending)} deltas)')
+        items = self.merge(self.iter_base(response['Body'], response.get('ContentEncoding')), ops)
+        writer = SnapshotWriter(self.s3_client, self.bucket(), self.base_key(portfolio,org,ring), mark, encoding=self.encoding(), if_match=response['ETag'])
+        # Nobody reads the rendered chunks, render() is only used for the publish
+        for chunk in self.render(items, 'ndjson', writer, lambda: self.delete_log(pending)):
+            pass
+
+        return len(pending)
+
+
+
+    def delete_log(self,keys):
+
+        for i in range(0, len(keys), 1000):
+            chunk = keys[i:i+1000]
+            self.s3_client.delete_objects(
+                Bucket=self.bucket(),
+                Delete={'Objects':[{'Key':key} for key in chunk],'Quiet':True}
+            )
+
+
+
+    def discard_stale(self,portfolio,org,ring,started_mark):
+        '''
+        Called once a base built from a full read of the ring has been published.
+        started_mark is current_mark() taken before the read started. Every delta logged up to it
+        is already reflected in DynamoDB (and therefore in the new base), so it can be deleted.
+        '''
+        stale = [key for key in self.list_log(portfolio,org,ring) if key <= started_mark]
+        if stale:
+            self.delete_log(stale)
+
+
+
+    def publish_condition(self,portfolio,org,ring,mark):
+        '''
+        How a base with this mark may replace the one in place: over that exact version (If-Match),
+        or only if there is still none (If-None-Match). None when the base in place is already newer.
+
+        @OUT:
+          {'if_match':(ETag)} / {'if_none_match':True} / None
+        '''
+        try:
+            response = self.s3_client.head_object(Bucket=self.bucket(), Key=self.base_key(portfolio,org,ring))
+        except self.s3_client.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return {'if_none_match':True}
+            raise
+
+        log_mark = response.get('Metadata', {}).get('log-mark') or None
+        if log_mark and mark and log_mark > mark:
+            return None
+        return {'if_match':response['ETag']}
+
+
+
+    def drop(self,portfolio,org,ring):
+        '''
+        Removes the base so the next read rebuilds it from DynamoDB
+        '''
+        try:
+            self.s3_client.delete_object(Bucket=self.bucket(), Key=self.base_key(portfolio,org,ring))
+        except Exception as e:
+            current_app.logger.error(f'Could not drop snapshot {portfolio}/{org}/{ring}: {str(e)}')
+
+
+
+    # STREAMING
+    # The streaming path never holds the ring in memory. Items are read from S3 (or DynamoDB)
+    # line by line and sent to the client in chunks as they arrive.
+
+    def etag(self,base_etag,pending,fmt,fields,accept_gzip=False):
+        '''
+        Version of what stream() sends: the S3 ETag of the base plus the last pending delta.
+        Format, projection and encoding are part of it since they change the bytes.
+        '''
+        version = '|'.join([base_etag or '', pending[-1] if pending else '', fmt, ','.join(fields or []), 'gzip' if accept_gzip else ''])
+        return 's-' + hashlib.sha1(version.encode('utf-8')).hexdigest()[:20]
+
+
+
+    def encode(self,chunks,accept_gzip):
+        '''
+        Compresses response chunks if the client takes gzip
+
+        @OUT:
+          ((generator of bytes), (Content-Encoding) or None)
+        '''
+        if accept_gzip:
+            return gzip_chunks(chunks), 'gzip'
+        return chunks, None
+
+
+
+    def stream(self,portfolio,org,ring,fmt='json',fields=None,if_none_match=None,accept_gzip=False):
+        '''
+        Opens the snapshot and returns a generator of response chunks.
+        S3 is hit before returning so the caller can tell a miss apart.
+        Costs one GET (the body is only read while streaming) and one LIST of the log.
+        Compacts when SNAPSHOT_COMPACT_THRESHOLD deltas are pending and settled() allows it.
+
+        @IN:
+          fmt = <json|ndjson>
+          fields = [(attribute name)] Only these attributes are sent (the stored base keeps them all)
+          if_none_match = (werkzeug ETags) of the request. Nothing is read if the client already has this version
+          accept_gzip = The client takes gzip. A gzip base with nothing to merge is then sent as stored
+
+        @OUT:
+          ok: ((etag), (generator of bytes) or None if the client's copy is current, (Content-Encoding) or None)
+          ko: None when there is no base yet (caller should rebuild)
+              Raises LogBacklog when more than SNAPSHOT_MAX_PENDING deltas would have to be merged
+        '''
+        max_pending = current_app.config.get('SNAPSHOT_MAX_PENDING', 500)
+        for attempt in range(READ_ATTEMPTS):
+            try:
+                response = self.s3_client.get_object(Bucket=self.bucket(), Key=self.base_key(portfolio,org,ring))
+            except self.s3_client.exceptions.NoSuchKey:
+                return None
+
+            body = response['Body']
+            stored_encoding = response.get('ContentEncoding')
+            log_mark = response.get('Metadata', {}).get('log-mark') or None
+            entries, server_time = self.list_log_entries(portfolio,org,ring,after=log_mark)
+            pending = [key for key, modified in entries]
+            etag = self.etag(response.get('ETag'), pending, fmt, fields, accept_gzip)
+
+            if if_none_match is not None and if_none_match.contains_weak(etag):
+                body.close()
+                return etag, None, None
+
+            if len(pending) > max_pending:
+                # Fetching them all would delay the first byte past the gateway timeout
+                body.close()
+                raise LogBacklog(response['ETag'], len(pending))
+
+            try:
+                ops = self.read_ops(pending)
+                break
+            except LogCompacted:
+                body.close()
+                if attempt == READ_ATTEMPTS - 1:
+                    raise
+
+        if not pending and fmt == 'json' and not fields:
+            # Nothing to merge, the stored bytes are already the response
+            chunks = body.iter_chunks(STREAM_CHUNK)
+            if stored_encoding == 'gzip':
+                if accept_gzip:
+                    # Pass-through, never decompressed here
+                    return etag, chunks, 'gzip'
+                return etag, gunzip_chunks(chunks), None
+            return (etag,) + self.encode(chunks, accept_gzip)
+
+        items = self.merge(self.iter_base(body, stored_encoding), ops)
+
+        writer = None
+        on_complete = None
+        threshold = current_app.config.get('SNAPSHOT_COMPACT_THRESHOLD', 50)
+        if len(pending) >= threshold and self.settled_mark(entries, log_mark, server_time) == pending[-1]:
+            # Compact while streaming: the merged items are also written as the new base
+            current_app.logger.debug(f'Compacting ring snapshot {portfolio}/{org}/{ring} ({len(pending)} deltas)')
+            # Only published over the base it was read from, a compaction that lost the race changes nothing
+            writer = SnapshotWriter(self.s3_client, self.bucket(), self.base_key(portfolio,org,ring), pending[-1], encoding=self.encoding(), if_match=response['ETag'])
+            on_complete = lambda: self.delete_log(pending)
+
+        return (etag,) + self.encode(self.render(items, fmt, writer, on_complete, fields), accept_gzip)
+
+
+
+    def read_items(self,portfolio,org,ring):
+        '''
+        Current items of the ring (base + pending deltas) for other writers (exports).
+        Never compacts. Deltas after the returned mark may already be in the items: changes_since()
+        hands them out again, consumers keep the last version of each item.
+
+        @OUT:
+          ok: ((generator of items), (mark) last log key reflected in them)
+          ko: None when there is no base yet
+        '''
+        for attempt in range(READ_ATTEMPTS):
+            try:
+                response = self.s3_client.get_object(Bucket=self.bucket(), Key=self.base_key(portfolio,org,ring))
+            except self.s3_client.exceptions.NoSuchKey:
+                return None
+
+            log_mark = response.get('Metadata', {}).get('log-mark') or None
+            try:
+                ops, mark = self.pending_ops(portfolio,org,ring,log_mark)
+                break
+            except LogCompacted:
+                response['Body'].close()
+                if attempt == READ_ATTEMPTS - 1:
+                    raise
+
+        items = self.merge(self.iter_base(response['Body'], response.get('ContentEncoding')), ops)
+
+        return items, mark
+
+
+
+    def changes_since(self,portfolio,org,ring,mark):
+        '''
+        Delta operations logged after a mark returned by read_items()
+
+        @OUT:
+          ok: ([(op)], (new mark))
+          ko: None when the log no longer goes back that far (compacted into a newer base)
+        '''
+        try:
+            response = self.s3_client.head_object(Bucket=self.bucket(), Key=self.base_key(portfolio,org,ring))
+        except Exception:
+            return None
+
+        # Compaction only deletes entries up to the mark of the base it publishes
+        log_mark = response.get('Metadata', {}).get('log-mark') or None
+        if not mark or (log_mark and log_mark > mark):
+            return None
+
+        try:
+            return self.pending_ops(portfolio,org,ring,mark)
+        except LogCompacted:
+            return None
+
+
+
+    def stream_rebuild(self,portfolio,org,ring,items,started_mark,fmt='json',fields=None,accept_gzip=False,base_etag=None):
+        '''
+        Streams items coming from a full read of the ring and publishes them as the new base
+        once the last one has been sent (see discard_stale() for the meaning of started_mark).
+        Only published over the base the read replaces (base_etag, None if there was none): a base
+        published by a build or a compaction in the meantime is never overwritten.
+
+        @OUT:
+          ((generator of bytes), (Content-Encoding) or None)
+        '''
+        writer = SnapshotWriter(self.s3_client, self.bucket(), self.base_key(portfolio,org,ring), started_mark, encoding=self.encoding(),
+                                if_match=base_etag, if_none_match=base_etag is None)
+        on_complete = lambda: self.discard_stale(portfolio,org,ring,started_mark)
+
+        return self.encode(self.render(items, fmt, writer, on_complete, fields), accept_gzip)
+
+
+
+    def iter_lines(self,chunks):
+        '''
+        Lines of a stream of chunks (without the line break)
+        '''
+        pending = b''
+        for chunk in chunks:
+            lines = (pending + chunk).split(b'\n')
+            pending = lines.pop()
+            yield from lines
+        if pending:
+            yield pending
+
+
+
+    def iter_base(self,body,encoding=None):
+        '''
+        Yields the items of a stored base one at a time
+        '''
+        if encoding == 'gzip':
+            lines = self.iter_lines(gunzip_chunks(body.iter_chunks(STREAM_CHUNK)))
+        else:
+            lines = body.iter_lines(STREAM_CHUNK)
+        head = next(lines, b'')
+
+        if head + b'\n' != BASE_HEAD:
+            # Legacy single line document (written before the line layout). Parsed in one go.
+            # It is replaced with the line layout on the next compaction or refresh.
+            document = json.loads(head + b''.join(lines))
+            yield from document.get('items', [])
+            return
+
+        for line in lines:
+            line = line.strip()
+            if line.startswith(b']'):
+                return
+            if line.endswith(b','):
+                line = line[:-1]
+            if line:
+                yield json.loads(line)
+
+
+
+    def merge(self,items,ops):
+        '''
+        Streaming version of apply(). Only the deltas are kept in memory.
+        '''
+        overrides = {}
+        for op in ops:
+            if op['op'] == 'put':
+                overrides[op['item']['_id']] = op['item']
+            elif op['op'] == 'delete':
+                overrides[op['_id']] = None
+
+        for item in items:
+            if item.get('_id') in overrides:
+                item = overrides.pop(item['_id'])
+                if item is None:
+                    continue
+            yield item
+
+        # Items created after the base was written
+        for item in overrides.values():
+            if item is not None:
+                yield item
+
+
+
+    def render(self,items,fmt='json',writer=None,on_complete=None,fields=None):
+        '''
+        Serializes items into response chunks.
+        If a writer is given, the base layout is written to it too and published at the end
+        (always with every attribute, "fields" only applies to the response).
+        '''
+        chunk = bytearray()
+
+        try:
+            if writer:
+                writer.write(BASE_HEAD)
+            if fmt != 'ndjson':
+                chunk.extend(BASE_HEAD)
+
+            first = True
+            for item in items:
+                line = json.dumps(item, cls=DecimalEncoder).encode('utf-8')
+
+                if writer:
+                    writer.write(line if first else BASE_SEP + line)
+                    
+                if fields:
+                    line = json.dumps(project(item, fields), cls=DecimalEncoder).encode('utf-8')
+
+                if fmt == 'ndjson':
+                    chunk.extend(line)
+                    chunk.extend(b'\n')
+                else:
+                    if not first:
+                        chunk.extend(BASE_SEP)
+                    chunk.extend(line)
+
+                first = False
+                if len(chunk) >= STREAM_CHUNK:
+                    yield bytes(chunk)
+                    chunk = bytearray()
+
+            if writer:
+                writer.write(BASE_FOOT)
+            if fmt != 'ndjson':
+                chunk.extend(BASE_FOOT)
+            if chunk:
+                yield bytes(chunk)
+
+            if writer:
+                try:
+                    writer.close()
+                except Exception as e:
+                    # Another reader published first (If-Match) or S3 failed. The response is complete
+                    # and the base in place stays valid, the log is left as it is.
+                    current_app.logger.error(f'Snapshot not published: {str(e)}')
+                    writer.abort()
+                    on_complete = None
+                writer = None
+                if on_complete:
+                    try:
+                        on_complete()
+                    except Exception as e:
+                        # The base is already published. Leftover log entries are skipped by the mark.
+                        current_app.logger.error(f'Could not clean up the ring log: {str(e)}')
+
+        except BaseException:
+            # Client went away or the source failed. Never publish a partial base.
+            if writer:
+                writer.abort()
+            raise
+
+
+
+class SnapshotBuilder:
+    '''
+    Resumable full build of a ring snapshot.
+
+    The ring is read page by page and written to S3 with a multipart upload. After every page the
+    builder checks its time budget (SNAPSHOT_BUILD_BUDGET seconds). When it runs out, it saves a
+    checkpoint and returns. The next call (another Lambda invocation) continues where it stopped:
+
+        data/{portfolio}/{org}/{ring}/_build       checkpoint: read cursor (DynamoDB LastEvaluatedKey), upload id, parts, progress
+        data/{portfolio}/{org}/{ring}/_build_tail  bytes not uploaded yet (parts under 5MB can't be sent)
+
+    The base is published atomically when the multipart upload is completed. Readers keep seeing the
+    previous base (plus its log) until then. The checkpoint is kept after completion with the final
+    progress figures (items, pages, items per second, consumed read capacity).
+
+    One invocation at a time works on a build. It takes a lease in the checkpoint (expiring after
+    SNAPSHOT_BUILD_LEASE seconds) and every checkpoint write is conditional on the ETag of the previous
+    one (If-Match, If-None-Match for the first). Whoever loses gets BuildBusy and leaves the upload alone.
+    The lease is handed back when an invocation runs out of budget. A run that crashed keeps it until it expires.
+    The upload is completed over the base in place (If-Match, see DataSnapshot.publish_condition) and
+    dropped if a newer base was published while it ran: its log entries may already be gone.
+    '''
+
+    def __init__(self,snapshot):
+
+        self.DSN = snapshot
+        self.s3_client = snapshot.s3_client
+
+
+    def checkpoint_key(self,portfolio,org,ring):
+        return f'data/{portfolio}/{org}/{ring}/_build'
+
+
+    def tail_key(self,portfolio,org,ring):
+        return f'data/{portfolio}/{org}/{ring}/_build_tail'
+
+
+
+    def status(self,portfolio,org,ring):
+        '''
+        Returns the progress of the current (or last) build, None if the ring was never built
+        '''
+        checkpoint, etag = self.read(portfolio,org,ring)
+        return self.progress(checkpoint) if checkpoint else None
+
+
+
+    def progress(self,checkpoint):
+
+        elapsed = checkpoint['elapsed']
+        return {
+            'status': checkpoint['status'],
+            'complete': checkpoint['status'] == 'complete',
+            'items': checkpoint['items'],
+            'pages': checkpoint['pages'],
+            'bytes': checkpoint['bytes'],
+            'invocations': checkpoint['invocations'],
+            'elapsed': round(elapsed, 3),
+            'items_per_second': round(checkpoint['items'] / elapsed, 1) if elapsed else None,
+            'consumed_capacity': checkpoint['consumed_capacity'],
+            'started': checkpoint['started'],
+            'updated': checkpoint['updated']
+        }
+
+
+
+    def run(self,portfolio,org,ring,read_pages,format_row,restart=False,budget=None):
+        '''
+        Starts or continues a build.
+
+        @IN:
+          read_pages = callable(cursor) -> generator of ([(row)], cursor, consumed capacity)
+                       Each cursor resumes the read right after its page. None starts from the beginning.
+          format_row = callable(row) -> (item in FE shape)
+          restart = Abandons a build in progress and starts over
+          budget = Seconds this invocation may work (SNAPSHOT_BUILD_BUDGET by default)
+
+        @OUT:
+          (progress) see progress()
+          Raises BuildBusy if another invocation holds the build
+        '''
+        bucket = self.DSN.bucket()
+        base_key = self.DSN.base_key(portfolio,org,ring)
+        if budget is None:
+            budget = current_app.config.get('SNAPSHOT_BUILD_BUDGET', 20)
+        clock = time.monotonic()
+
+        checkpoint, etag = self.read(portfolio,org,ring)
+        checkpoint, etag = self.acquire(portfolio,org,ring,checkpoint,etag,budget)
+
+        if checkpoint['status'] == 'running':
+            # A build nobody continued for a while would publish stale pages, start over
+            max_age = current_app.config.get('SNAPSHOT_BUILD_MAX_AGE', 3600)
+            if (datetime.now() - datetime.fromisoformat(checkpoint['updated'])).total_seconds() > max_age:
+                restart = True
+
+        if checkpoint['status'] == 'publishing':
+            # Died while completing the upload, the last bytes were never saved
+            restart = True
+
+        if checkpoint['status'] in ('running', 'publishing') and restart and checkpoint['upload_id']:
+            SnapshotWriter(self.s3_client, bucket, base_key, None, upload_id=checkpoint['upload_id'], encoding=checkpoint.get('encoding')).abort()
+
+        if checkpoint['status'] == 'running' and not restart and checkpoint['upload_id']:
+            current_app.logger.debug(f'Resuming snapshot build {portfolio}/{org}/{ring} at page {checkpoint["pages"]}')
+            writer = SnapshotWriter(
+                self.s3_client, bucket, base_key, checkpoint['started_mark'],
+                upload_id=checkpoint['upload_id'],
+                parts=checkpoint['parts'],
+                buffer=self.load_tail(portfolio,org,ring),
+                encoding=checkpoint.get('encoding'),
+                gzip_state=checkpoint.get('gzip_state')
+            )
+        else:
+            current_app.logger.debug(f'Starting snapshot build {portfolio}/{org}/{ring}')
+            started_mark = self.DSN.current_mark(portfolio,org,ring)
+            writer = SnapshotWriter(self.s3_client, bucket, base_key, started_mark, encoding=self.DSN.encoding())
+            writer.write(BASE_HEAD)
+            checkpoint = self.new_checkpoint(lease=checkpoint['lease'])
+            checkpoint['upload_id'] = writer.upload_id
+            checkpoint['encoding'] = writer.encoding
+            checkpoint['started_mark'] = started_mark
+            checkpoint['bytes'] = len(BASE_HEAD)
+            # Record the upload right away so whoever comes next can abort or resume it
+            etag = self.save(portfolio,org,ring,checkpoint,etag=etag)
+
+        checkpoint['invocations'] += 1
+
+        pages = read_pages(checkpoint['cursor'])
+
+        try:
+            for rows, cursor, consumed in pages:
+
+                for row in rows:
+                    line = json.dumps(format_row(row), cls=DecimalEncoder).encode('utf-8')
+                    if checkpoint['items']:
+                        line = BASE_SEP + line
+                    writer.write(line)
+                    checkpoint['items'] += 1
+                    checkpoint['bytes'] += len(line)
+
+                checkpoint['pages'] += 1
+                checkpoint['consumed_capacity'] += consumed
+                checkpoint['cursor'] = cursor
+
+                if cursor and time.monotonic() - clock >= budget:
+                    # Out of time, save what we have and let the next invocation continue
+                    pages.close()
+                    checkpoint['gzip_state'] = writer.suspend()
+                    checkpoint['parts'] = writer.parts
+                    checkpoint['lease'] = None
+                    self.save_tail(portfolio,org,ring,writer.buffer)
+                    self.save(portfolio,org,ring,checkpoint,clock,etag)
+                    return self.progress(checkpoint)
+
+            writer.write(BASE_FOOT)
+            checkpoint['bytes'] += len(BASE_FOOT)
+            # Still ours? Only the lease holder may complete the upload
+            checkpoint['status'] = 'publishing'
+            etag = self.save(portfolio,org,ring,checkpoint,etag=etag)
+            condition = self.DSN.publish_condition(portfolio,org,ring,checkpoint['started_mark'])
+            if condition is None:
+                current_app.logger.info(f'Snapshot build {portfolio}/{org}/{ring} dropped, a newer base is in place')
+                writer.abort()
+            else:
+                writer.if_match = condition.get('if_match')
+                writer.if_none_match = condition.get('if_none_match', False)
+                writer.close()
+
+        except BuildBusy:
+            current_app.logger.error(f'Snapshot build {portfolio}/{org}/{ring} was taken over at page {checkpoint["pages"]}')
+            raise
+        except Exception:
+            # Leave the last checkpoint in place. The next run continues from it once the lease expires.
+            current_app.logger.error(f'Snapshot build {portfolio}/{org}/{ring} failed at page {checkpoint["pages"]}')
+            raise
+
+        # Published. Clean up what the build left behind.
+        checkpoint['status'] = 'complete'
+        checkpoint['parts'] = []
+        checkpoint['gzip_state'] = None
+        checkpoint['cursor'] = None
+        checkpoint['lease'] = None
+        self.save(portfolio,org,ring,checkpoint,clock,etag)
+        self.s3_client.delete_object(Bucket=bucket, Key=self.tail_key(portfolio,org,ring))
+        self.DSN.discard_stale(portfolio,org,ring,checkpoint['started_mark'])
+
+        current_app.logger.debug(f'Snapshot build {portfolio}/{org}/{ring} complete: {self.progress(checkpoint)}')
+
+        return self.progress(checkpoint)
+
+
+
+    def new_checkpoint(self,lease=None):
+
+        now = datetime.now().isoformat()
+        return {
+            'status': 'running',
+            'lease': lease,
+            'upload_id': None,
+            'parts': [],
+            'encoding': None,
+            'gzip_state': None,
+            'started_mark': None,
+            'cursor': None,
+            'items': 0,
+            'pages': 0,
+            'bytes': 0,
+            'invocations': 0,
+            'elapsed': 0.0,
+            'consumed_capacity': 0.0,
+            'started': now,
+            'updated': now
+        }
+
+
+
+    def acquire(self,portfolio,org,ring,checkpoint,etag,budget):
+        '''
+        Takes the lease on the build (see the class docstring)
+
+        @OUT:
+          ((checkpoint) holding the lease, (ETag) of the checkpoint object)
+          Raises BuildBusy if someone else holds it
+        '''
+        lease = checkpoint.get('lease') if checkpoint else None
+        if lease and lease['expires'] > time.time():
+            raise BuildBusy(self.progress(checkpoint))
+
+        if checkpoint is None:
+            # First build of the ring. Nothing uploaded yet (upload_id None)
+            checkpoint = self.new_checkpoint()
+
+        checkpoint['lease'] = {
+            'id': uuid.uuid4().hex,
+            'expires': time.time() + current_app.config.get('SNAPSHOT_BUILD_LEASE', budget + 60)
+        }
+        return checkpoint, self.save(portfolio,org,ring,checkpoint,etag=etag)
+
+
+
+    def read(self,portfolio,org,ring):
+        '''
+        @OUT:
+          ((checkpoint) or None, (ETag) or None)
+        '''
+        try:
+            response = self.s3_client.get_object(Bucket=self.DSN.bucket(), Key=self.checkpoint_key(portfolio,org,ring))
+        except self.s3_client.exceptions.NoSuchKey:
+            return None, None
+
+        return json.loads(response['Body'].read()), response['ETag']
+
+
+
+    def save(self,portfolio,org,ring,checkpoint,clock=None,etag=None):
+        '''
+        Writes the checkpoint over the version with that ETag (None: only if there is none yet)
+
+        @OUT:
+          (ETag) of the new version
+          Raises BuildBusy if the checkpoint was written by someone else in between
+        '''
+        if clock is not None:
+            checkpoint['elapsed'] += time.monotonic() - clock
+        checkpoint['updated'] = datetime.now().isoformat()
+
+        condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        try:
+            response = self.s3_client.put_object(
+                Bucket=self.DSN.bucket(),
+                Key=self.checkpoint_key(portfolio,org,ring),
+                Body=json.dumps(checkpoint, cls=DecimalEncoder),
+                ContentType='application/json',
+                **condition
+            )
+        except self.s3_client.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise BuildBusy()
+            raise
+
+        return response['ETag']
+
+
+
+    def load_tail(self,portfolio,org,ring):
+
+        try:
+            response = self.s3_client.get_object(Bucket=self.DSN.bucket(), Key=self.tail_key(portfolio,org,ring))
+        except self.s3_client.exceptions.NoSuchKey:
+            return b''
+
+        return response['Body'].read()
+
+
+
+    def save_tail(self,portfolio,org,ring,buffer):
+
+        self.s3_client.put_object(
+            Bucket=self.DSN.bucket(),
+            Key=self.tail_key(portfolio,org,ring),
+            Body=bytes(buffer)
+        )
@@ -0,0 +1,391 @@
+#data_validator.py
+import copy
+import json
+import re
+import threading
+import time
+from datetime import datetime
+from decimal import Decimal
+
+
+# Property names that are not quoted: {a:1} / ,b:2 / a:1 at the start / ],c:3
+JS_KEY_INNER = re.compile(r'([{,])\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*:')
+JS_KEY_ROOT = re.compile(r'^\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*:')
+JS_KEY_AFTER_CLOSE = re.compile(r'([\]}])\s*,\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*:')
+JS_TRAILING_COMMA = re.compile(r',(\s*[}\]])')
+JS_WHITESPACE = re.compile(r'\s+')
+JS_COMMA = re.compile(r'\s*,\s*')
+JS_COLON = re.compile(r'\s*:\s*(?=[^"]*["\d])')
+JS_OPEN_LIST = re.compile(r'\[\s*{')
+JS_CLOSE_LIST = re.compile(r'}\s*\]')
+JS_CLOSE_OBJECT = re.compile(r'}\s*,')
+
+# Fast path for the usual 'YYYY-MM-DD', anything else goes through strptime
+ISO_DATE = re.compile(r'(\d{4})-(\d{2})-(\d{2})')
+
+
+def convert_js_to_json(js_string):
+    """
+    Convert JavaScript object syntax to proper JSON format.
+    Handles unquoted property names and single quotes.
+    """
+    if not isinstance(js_string, str):
+        return js_string
+
+    js_string = js_string.replace("'", '"')
+    js_string = JS_KEY_INNER.sub(r'\1"\2":', js_string)
+    js_string = JS_KEY_ROOT.sub(r'"\1":', js_string)
+
+    return js_string
+
+
+def convert_js_to_json_advanced(js_string):
+    """
+    More advanced JavaScript to JSON converter that handles complex cases.
+    """
+    if not isinstance(js_string, str):
+        return js_string
+
+    js_string = convert_js_to_json(js_string)
+    # Property names after array elements
+    js_string = JS_KEY_AFTER_CLOSE.sub(r'\1,"\2":', js_string)
+
+    return js_string
+
+
+def convert_js_to_json_robust(js_string):
+    """
+    Robust JavaScript to JSON converter that handles whitespace, newlines, and formatting issues.
+    """
+    if not isinstance(js_string, str):
+        return js_string
+
+    js_string = convert_js_to_json_advanced(js_string)
+
+    # Remove trailing commas before closing braces/brackets
+    js_string = JS_TRAILING_COMMA.sub(r'\1', js_string)
+    js_string = JS_WHITESPACE.sub(' ', js_string)
+    js_string = JS_COMMA.sub(', ', js_string)
+    # Only property separators, not the colons in time strings (HH:MM)
+    js_string = JS_COLON.sub(': ', js_string)
+    js_string = JS_OPEN_LIST.sub('[{', js_string)
+    js_string = JS_CLOSE_LIST.sub('}]', js_string)
+    js_string = JS_CLOSE_OBJECT.sub('},', js_string)
+
+    return js_string
+
+
+def convert_js_to_json_simple(js_string):
+    """
+    Simple and reliable JavaScript to JSON converter.
+    """
+    if not isinstance(js_string, str):
+        return js_string
+
+    js_string = convert_js_to_json(js_string)
+    js_string = JS_TRAILING_COMMA.sub(r'\1', js_string)
+    js_string = JS_WHITESPACE.sub(' ', js_string)
+
+    return js_string
+
+
+JS_CONVERTERS = (convert_js_to_json, convert_js_to_json_advanced, convert_js_to_json_robust, convert_js_to_json_simple)
+
+
+def sanitize(obj):
+    '''
+    Avoids Floats being sent to DynamoDB (same rules as DataController.sanitize)
+    '''
+    if isinstance(obj, list):
+        return [sanitize(x) for x in obj]
+    elif isinstance(obj, dict):
+        return {k: sanitize(v) for k, v in obj.items()}
+    elif isinstance(obj, Decimal):
+        return int(obj) if obj % 1 == 0 else float(obj)
+    elif isinstance(obj, float):
+        return str(obj)
+    return obj
+
+
+def parse_js_list(raw):
+    '''
+    Array values typed by hand in the FE often use JS syntax ({a:'b'}).
+    Tries plain JSON first and then each converter, the original string is kept if all fail.
+    '''
+    text = raw.strip()
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
+
+    for converter in JS_CONVERTERS:
+        try:
+            return json.loads(converter(text))
+        except Exception:
+            continue
+
+    return text
+
+
+def to_timestamp(raw):
+    '''
+    Epoch (seconds or milliseconds) or 'YYYY-MM-DD' to milliseconds. None if it can't be read
+    '''
+    if isinstance(raw, bool):
+        raw = str(raw)
+
+    if isinstance(raw, (int, float, Decimal)):
+        number = raw
+    elif not isinstance(raw, str):
+        return None
+    else:
+        raw = raw.strip()
+        try:
+            number = float(raw)
+        except ValueError:
+            number = None
+
+    if number is not None:
+        try:
+            timestamp_value = int(number)
+        except (ValueError, OverflowError):
+            timestamp_value = None
+
+        if timestamp_value is not None:
+            if timestamp_value < 0:
+                return None
+            # Less than 1 billion means it's in seconds
+            if timestamp_value < 1000000000:
+                timestamp_value *= 1000
+            return timestamp_value
+
+        if not isinstance(raw, str):
+            return None
+
+    try:
+        match = ISO_DATE.fullmatch(raw)
+        if match:
+            date_value = datetime(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+        else:
+            date_value = datetime.strptime(raw, '%Y-%m-%d')
+        return int(date_value.timestamp() * 1000)
+    except ValueError:
+        return None
+
+
+# Coercers, one per field type. Same results the construct_* functions used to produce
+
+def coerce_object(raw):
+    if isinstance(raw, dict):
+        return sanitize(raw)
+    try:
+        return sanitize(json.loads(raw.strip()))
+    except Exception:
+        return {} if raw == '' else str(raw).strip()
+
+
+def coerce_array(raw):
+    if isinstance(raw, list):
+        return sanitize(raw)
+    try:
+        return sanitize(json.loads(raw.strip()))
+    except Exception:
+        return [] if raw == '' else str(raw).strip()
+
+
+def coerce_array_js(raw):
+    # Updates also accept JS syntax
+    if isinstance(raw, list):
+        return sanitize(raw)
+    try:
+        return sanitize(parse_js_list(raw))
+    except Exception:
+        return str(raw).strip()
+
+
+def coerce_string(raw):
+    return str(raw).strip() if raw else ''
+
+
+def coerce_other(raw):
+    return str(raw).strip() if raw else None
+
+
+POST_COERCERS = {
+    'object': coerce_object,
+    'array': coerce_array,
+    'timestamp': to_timestamp,
+    'string': coerce_string
+}
+
+PUT_COERCERS = {
+    'object': coerce_object,
+    'array': coerce_array_js
+}
+
+NO_DEFAULT = object()
+
+
+
+class BlueprintValidator:
+    '''
+    Blueprint fields compiled once into flat tables of (name, coercer, default).
+    Replaces the per-request interpretation of blueprint['fields'].
+    '''
+
+    def __init__(self,blueprint):
+
+        self.uri = blueprint.get('uri')
+        self.version = blueprint.get('version')
+        self.fields = blueprint['fields']
+
+        self.post_table = []
+        self.put_table = []
+
+        for field in self.fields:
+            name = field['name']
+            kind = field.get('type')
+            coercer = POST_COERCERS.get(kind, coerce_other)
+
+            # Defaults are coerced once here instead of on every item
+            if 'default' in field:
+                default_value = coercer(field['default'])
+            else:
+                default_value = NO_DEFAULT
+
+            self.post_table.append((name, coercer, default_value))
+            self.put_table.append((name, PUT_COERCERS.get(kind)))
+
+
+    def coerce_post(self,payload):
+        '''
+        Full set of attributes for a new item. Missing fields get the blueprint default
+
+        @OUT:
+          {(field name):(value)}
+        '''
+        values = {}
+        get = payload.get
+
+        for name, coercer, default_value in self.post_table:
+            raw = get(name)
+            if raw:
+                values[name] = coercer(raw)
+            elif default_value is NO_DEFAULT:
+                raise KeyError('default')
+            elif isinstance(default_value, (dict, list)):
+                # Never hand the same mutable default to two items
+                values[name] = copy.deepcopy(default_value)
+            else:
+                values[name] = default_value
+
+        return values
+
+
+    def coerce_put(self,payload):
+        '''
+        Attributes for a partial update. Only the fields present in the payload
+
+        @OUT:
+          ok: ({(field name):(value)}, None)
+          ko: (None, (error string))
+        '''
+        values = {}
+        get = payload.get
+
+        for name, coercer in self.put_table:
+            raw = get(name)
+            if not raw:
+                continue
+            if coercer is not None:
+                values[name] = coercer(raw)
+            elif len(str(raw)) > 0:
+                values[name] = sanitize(raw)
+            else:
+                return None, 'Attribute is required'
+
+        if not values:
+            return None, 'Attributes not recognized'
+
+        return values, None
+
+
+
+VALIDATORS = {}
+VALIDATORS_LOCK = threading.Lock()
+
+
+def get_validator(blueprint):
+    '''
+    Compiled validator for a blueprint, shared by the whole process.
+    Keyed by (uri, version). The fields are compared too, so a blueprint edited in place
+    without a version bump is recompiled instead of being served stale.
+    '''
+    key = (blueprint.get('uri'), blueprint.get('version'))
+    validator = VALIDATORS.get(key)
+    if validator is not None and validator.fields == blueprint['fields']:
+        return validator
+
+    validator = BlueprintValidator(blueprint)
+    with VALIDATORS_LOCK:
+        VALIDATORS[key] = validator
+    return validator
+
+
+
+def benchmark(width=100,items=2000):
+    '''
+    Items per second through a wide blueprint (one field of each type, repeated)
+
+    @OUT:
+      {'fields':(int),'items':(int),'compile_ms':(float),'post_per_second':(float),'put_per_second':(float)}
+    '''
+    kinds = ['string', 'object', 'array', 'timestamp', 'number']
+    samples = {
+        'string': '  some text  ',
+        'object': '{"a": 1, "b": {"c": [1, 2, 3]}}',
+        'array': '[{"name": "x", "at": "10:30"}, {"name": "y", "at": "11:00"}]',
+        'timestamp': '2024-05-17',
+        'number': 42
+    }
+
+    fields = []
+    payload = {}
+    for n in range(width):
+        kind = kinds[n % len(kinds)]
+        name = f'f{n}'
+        fields.append({'name': name, 'type': kind, 'default': '', 'required': False})
+        payload[name] = samples[kind]
+    blueprint = {'uri': 'benchmark', 'version': '1.0.0', 'fields': fields}
+
+    start = time.perf_counter()
+    validator = BlueprintValidator(blueprint)
+    compile_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    for _ in range(items):
+        get_validator(blueprint).coerce_post(payload)
+    post_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(items):
+        get_validator(blueprint).coerce_put(payload)
+    put_elapsed = time.perf_counter() - start
+
+    return {
+        'fields': width,
+        'items': items,
+        'compile_ms': round(compile_ms, 3),
+        'post_per_second': round(items / post_elapsed, 1),
+        'put_per_second': round(items / put_elapsed, 1)
+    }
+
+
+
+if __name__ == '__main__':
+    # python -m app_data.data_validator [width] [items]
+    import sys
+
+    width = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    items = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    print(json.dumps(benchmark(width, items), indent=2))
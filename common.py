@@ -2,6 +2,17 @@
 import jwt
 import re
 import hashlib
+import json
+import zlib
+from decimal import Decimal
+
+
+class DecimalEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, Decimal):
+            return str(obj)
+        return super(DecimalEncoder, self).default(obj)
+
 
 def decode_jwt(token):
     # Decode the JWT to get the user information
@@ -28,4 +39,32 @@ def create_md5_hash(input_string, num_digits):
     # Get the full hexadecimal MD5 hash
     full_hash = md5_hash.hexdigest()
     # Return the first N digits of the hash
-    return full_hash[:num_digits]
\ No newline at end of file
+    return full_hash[:num_digits]
+
+
+
+def gzip_chunks(chunks, level=6):
+    # Compresses a stream of bytes chunks into one gzip stream
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+
+def gunzip_chunks(chunks):
+    # Decompresses a gzip stream (one or more members) chunk by chunk
+    decompressor = zlib.decompressobj(31)
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        while decompressor.eof and decompressor.unused_data:
+            rest = decompressor.unused_data
+            decompressor = zlib.decompressobj(31)
+            data += decompressor.decompress(rest)
+        if data:
+            yield data
+    tail = decompressor.flush()
+    if tail:
+        yield tail
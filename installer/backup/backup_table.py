@@ -5,14 +5,26 @@ from dynamo_backup_restore import DynamoBackupRestore
 def main():
     ap = argparse.ArgumentParser(description="Backup a DynamoDB table to JSONL (DynamoDB JSON).")
     ap.add_argument("--table", required=True, help="Source table name")
-    ap.add_argument("--out", required=True, help="Output file path (e.g., backup.jsonl)")
+    ap.add_argument("--out", required=True, help="Output file path (e.g., backup.jsonl), a directory with --segments")
     ap.add_argument("--profile", help="AWS profile name")
     ap.add_argument("--region", help="AWS region name")
+    ap.add_argument("--endpoint-url", help="DynamoDB endpoint (e.g., http://localhost:8000 for DynamoDB Local)")
     ap.add_argument("--limit", type=int, help="Optional limit for quick tests")
+    ap.add_argument("--segments", type=int, help="Parallel scan in N segments, one gzip part file each")
+    ap.add_argument("--workers", type=int, help="Segments scanned at a time (default: all)")
+    ap.add_argument("--page-size", type=int, default=1000, help="Items per scan page")
+    ap.add_argument("--incremental-from", help="Previous backup directory: only export what changed since it")
+    ap.add_argument("--overlap", type=int, default=300, help="Seconds re-exported before the previous high-water mark")
     args = ap.parse_args()
 
-    tool = DynamoBackupRestore(profile=args.profile, region=args.region)
-    tool.backup_table(args.table, args.out, limit=args.limit)
+    tool = DynamoBackupRestore(profile=args.profile, region=args.region, endpoint_url=args.endpoint_url)
+    if args.incremental_from:
+        tool.backup_incremental(args.table, args.out, args.incremental_from, overlap_seconds=args.overlap,
+                                segments=args.segments or 8, workers=args.workers, page_size=args.page_size)
+    elif args.segments:
+        tool.backup_table_parallel(args.table, args.out, segments=args.segments, workers=args.workers, page_size=args.page_size)
+    else:
+        tool.backup_table(args.table, args.out, limit=args.limit)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
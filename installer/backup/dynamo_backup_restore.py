@@ -1,30 +1,146 @@
 # dynamo_backup_restore.py
 from __future__ import annotations
-import json, time, importlib, argparse
-from typing import Callable, Optional, Iterable, Dict, Any, List
+import json, time, importlib, argparse, gzip, hashlib, os, threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Optional, Iterable, Dict, Any, List, Tuple, Union
 from decimal import Decimal
 import boto3
 from botocore.exceptions import ClientError
 from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
 
+# Rows written by the app when an item is deleted: the key of the deleted item, stamped with 'modified'
+TOMBSTONE_ATTRIBUTE = "tombstone_of"
+
+THROTTLE_ERRORS = {
+    "ProvisionedThroughputExceededException",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+}
+
+
+class AdaptiveLimiter:
+    """
+    AIMD limit on concurrent BatchWriteItem calls.
+
+    Every call that goes through adds 1/limit (about +1 per round of calls), a throttled call
+    (throttling exception or UnprocessedItems) halves the limit. Calls throttled together are
+    one congestion event, so the limit halves at most once per cooldown.
+
+    capacity_per_second (optional) is a write capacity budget: consumed capacity above it
+    counts as throttling, so a restore can leave room for live traffic on a provisioned table.
+    """
+
+    def __init__(self, initial: int = 4, minimum: int = 1, maximum: int = 32,
+                 capacity_per_second: Optional[float] = None, cooldown: float = 1.0):
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.capacity_per_second = capacity_per_second
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.throttles = 0
+        self.decreases = 0
+        self._last_decrease = 0.0
+        self._window_start = time.monotonic()
+        self._window_capacity = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self) -> None:
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, throttled: bool = False, capacity: float = 0.0) -> None:
+        with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+
+            if self.capacity_per_second:
+                self._window_capacity += capacity
+                window = now - self._window_start
+                if window >= 1.0:
+                    if self._window_capacity / window > self.capacity_per_second:
+                        throttled = True
+                    self._window_start = now
+                    self._window_capacity = 0.0
+
+            if throttled:
+                self.throttles += 1
+                if now - self._last_decrease >= self.cooldown:
+                    self.limit = max(float(self.minimum), self.limit / 2)
+                    self._last_decrease = now
+                    self.decreases += 1
+            else:
+                self.limit = min(float(self.maximum), self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+
+_WORKER_TRANSFORMS: Dict[str, Callable] = {}
+
+
+def _decode_lines(lines: List[str], transform: Union[str, Callable, None]) -> Tuple[List[Dict[str, Any]], int, List[Dict[str, Any]]]:
+    """
+    Process pool worker: DynamoDB JSON lines -> transform -> DynamoDB JSON items ready for PutRequest.
+    A 'module:function' transform is imported once per worker process.
+    Tombstones are set apart (untransformed) to be replayed as deletes.
+
+    Returns (items, number of items the transform dropped, tombstones).
+    """
+    records = [json.loads(line) for line in lines]
+    tombstones = [r for r in records if TOMBSTONE_ATTRIBUTE in r]
+    if tombstones:
+        records = [r for r in records if TOMBSTONE_ATTRIBUTE not in r]
+
+    if transform is None:
+        return records, 0, tombstones
+
+    if isinstance(transform, str):
+        if transform not in _WORKER_TRANSFORMS:
+            _WORKER_TRANSFORMS[transform] = DynamoBackupRestore.load_transform(transform)
+        transform = _WORKER_TRANSFORMS[transform]
+
+    deserializer = TypeDeserializer()
+    serializer = TypeSerializer()
+    items = []
+    dropped = 0
+    for record in records:
+        item = {k: deserializer.deserialize(v) for k, v in record.items()}
+        item = transform(item)
+        if item is None:
+            dropped += 1
+            continue
+        items.append({k: serializer.serialize(v) for k, v in item.items()})
+    return items, dropped, tombstones
+
+
 class DynamoBackupRestore:
     """
     Backup and restore DynamoDB tables using lossless DynamoDB JSON (via TypeSerializer/TypeDeserializer).
 
     - backup_table() writes one serialized item per line (JSONL) to a local file.
+    - backup_table_parallel() splits the scan in segments (parallel scan) and writes one gzip JSONL part
+      file per segment plus a manifest.json with item counts and checksums.
     - restore_table_from_backup() reads JSONL and writes back using batch_write with automatic retry.
+    - restore_backup_parallel() reads part files concurrently, decodes/transforms in a process pool and
+      keeps several BatchWriteItem calls in flight under an AdaptiveLimiter.
 
     Optional transform: a callable(item: dict) -> dict to modify items during restore
     (e.g., to compute a new sort key name/value).
     """
 
-    def __init__(self, profile: Optional[str] = None, region: Optional[str] = None):
+    MANIFEST = "manifest.json"
+
+    def __init__(self, profile: Optional[str] = None, region: Optional[str] = None, endpoint_url: Optional[str] = None):
         session_kwargs = {}
         if profile:
             session_kwargs["profile_name"] = profile
         session = boto3.Session(**session_kwargs)
-        self._dynamodb = session.resource("dynamodb", region_name=region)
-        self._client = session.client("dynamodb", region_name=region)
+        # endpoint_url points at a local DynamoDB stand-in (DynamoDB Local, moto server, ...)
+        self._dynamodb = session.resource("dynamodb", region_name=region, endpoint_url=endpoint_url)
+        self._client = session.client("dynamodb", region_name=region, endpoint_url=endpoint_url)
         self._serializer = TypeSerializer()
         self._deserializer = TypeDeserializer()
 
@@ -60,6 +176,41 @@ class DynamoBackupRestore:
             if not last_evaluated_key:
                 return
 
+    def _yield_segment_pages(self, table_name: str, segment: int, total_segments: int, page_size: int = 1000,
+                             scan_filter: Optional[Dict[str, Any]] = None) -> Iterable[Dict[str, Any]]:
+        """
+        Scan pages of one segment of a parallel scan. Items stay in DynamoDB JSON (low-level client),
+        so they are written as they come, no serialize round trip. The client is thread safe, the resource is not.
+        scan_filter holds FilterExpression and its names/values.
+        """
+        last_evaluated_key = None
+        while True:
+            kwargs = {
+                "TableName": table_name,
+                "Segment": segment,
+                "TotalSegments": total_segments,
+                "Limit": page_size,
+                "ReturnConsumedCapacity": "TOTAL",
+                **(scan_filter or {}),
+            }
+            if last_evaluated_key:
+                kwargs["ExclusiveStartKey"] = last_evaluated_key
+
+            resp = self._client.scan(**kwargs)
+            yield resp
+
+            last_evaluated_key = resp.get("LastEvaluatedKey")
+            if not last_evaluated_key:
+                return
+
+    @staticmethod
+    def _sha256_file(path: str) -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
     def _batch_write(self, table_name: str, items: List[Dict[str, Any]]) -> None:
         """
         Write items using BatchWriteItem with exponential backoff for UnprocessedItems.
@@ -101,6 +252,196 @@ class DynamoBackupRestore:
         print(f"[backup] Done. Total items written: {count}")
         return count
 
+    def backup_table_parallel(
+        self,
+        table_name: str,
+        out_dir: str,
+        segments: int = 8,
+        workers: Optional[int] = None,
+        page_size: int = 1000,
+        since: Optional[str] = None,
+        parent: Optional[str] = None,
+        modified_attribute: str = "modified",
+    ) -> Dict[str, Any]:
+        """
+        Parallel scan (Segment/TotalSegments) of the table, one worker thread per segment
+        (at most `workers` at a time). Each segment streams into out_dir/part-NNNNN.jsonl.gz
+        (one DynamoDB JSON item per line, gzip compressed).
+
+        out_dir/manifest.json is written last and records, per part, the item count, the compressed
+        size and its sha256, plus totals, elapsed time and throughput. A backup without a manifest
+        is incomplete.
+
+        since (incremental backups, see backup_incremental) keeps only items whose modified_attribute
+        is >= since, plus items without one. The scan still reads (and is billed for) the whole table,
+        only the output shrinks. high_water_mark is the time the scan started, in the format the app
+        stamps 'modified' with (naive ISO time, UTC on Lambda): whatever changes from then on is in the
+        next increment. It is taken in UTC whatever the timezone of the machine running the backup.
+
+        Returns the manifest.
+        """
+        assert segments >= 1, "segments must be >= 1"
+        workers = workers or segments
+        os.makedirs(out_dir, exist_ok=True)
+
+        high_water_mark = datetime.now(timezone.utc).replace(tzinfo=None).isoformat()
+        scan_filter = None
+        if since:
+            scan_filter = {
+                "FilterExpression": "#modified >= :since OR attribute_not_exists(#modified)",
+                "ExpressionAttributeNames": {"#modified": modified_attribute},
+                "ExpressionAttributeValues": {":since": {"S": since}},
+            }
+
+        lock = threading.Lock()
+        progress = {"items": 0, "capacity": 0.0, "reported": 0}
+        started = time.monotonic()
+
+        def report(items: int, capacity: float) -> None:
+            with lock:
+                progress["items"] += items
+                progress["capacity"] += capacity
+                if progress["items"] - progress["reported"] >= 10000:
+                    progress["reported"] = progress["items"]
+                    elapsed = time.monotonic() - started
+                    print(f"[backup] {progress['items']} items, {progress['items'] / elapsed:.0f} items/s")
+
+        def backup_segment(segment: int) -> Dict[str, Any]:
+            name = f"part-{segment:05d}.jsonl.gz"
+            path = os.path.join(out_dir, name)
+            count = 0
+            tombstones = 0
+            capacity = 0.0
+            # Level 6: most of the size reduction of 9 at a fraction of the CPU
+            with gzip.open(path, "wt", encoding="utf-8", compresslevel=6) as f:
+                for resp in self._yield_segment_pages(table_name, segment, segments, page_size, scan_filter):
+                    items = resp.get("Items", [])
+                    for ddb_json in items:
+                        f.write(json.dumps(ddb_json, separators=(",", ":"), ensure_ascii=False))
+                        f.write("\n")
+                        if TOMBSTONE_ATTRIBUTE in ddb_json:
+                            tombstones += 1
+                    used = resp.get("ConsumedCapacity", {}).get("CapacityUnits", 0.0)
+                    count += len(items)
+                    capacity += used
+                    report(len(items), used)
+            return {
+                "file": name,
+                "segment": segment,
+                "items": count,
+                "tombstones": tombstones,
+                "bytes": os.path.getsize(path),
+                "sha256": self._sha256_file(path),
+                "consumed_capacity": capacity,
+            }
+
+        started_at = datetime.now(timezone.utc).isoformat()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # map() re-raises the first segment failure; no manifest is written in that case
+            parts = list(pool.map(backup_segment, range(segments)))
+        elapsed = time.monotonic() - started
+
+        total = sum(part["items"] for part in parts)
+        manifest = {
+            "table": table_name,
+            "format": "dynamodb-json/jsonl.gz",
+            "type": "incremental" if since else "full",
+            "since": since,
+            "high_water_mark": high_water_mark,
+            "parent": parent,
+            "total_segments": segments,
+            "started": started_at,
+            "finished": datetime.now(timezone.utc).isoformat(),
+            "elapsed_seconds": round(elapsed, 3),
+            "items": total,
+            "tombstones": sum(part["tombstones"] for part in parts),
+            "bytes": sum(part["bytes"] for part in parts),
+            "items_per_second": round(total / elapsed, 1) if elapsed else None,
+            "consumed_capacity": progress["capacity"],
+            "parts": parts,
+        }
+        with open(os.path.join(out_dir, self.MANIFEST), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+
+        print(f"[backup] Done. Total items written: {total} in {segments} parts, "
+              f"{elapsed:.1f}s ({manifest['items_per_second']} items/s)")
+        return manifest
+
+    def backup_incremental(
+        self,
+        table_name: str,
+        out_dir: str,
+        previous_dir: str,
+        overlap_seconds: int = 300,
+        **kwargs: Any,
+    ) -> Dict[str, Any]:
+        """
+        Backup of what changed since the backup in previous_dir (full or incremental): items modified
+        from its high-water mark on, minus overlap_seconds for clock skew between app containers.
+        Items in the overlap are exported twice, replaying them again is harmless.
+
+        Deleted items show up as the tombstones the app leaves behind (rows with 'tombstone_of').
+        The manifest links back to previous_dir, see backup_chain / replay_backups.
+        kwargs go to backup_table_parallel (segments, workers, page_size, modified_attribute).
+        """
+        with open(os.path.join(previous_dir, self.MANIFEST), "r", encoding="utf-8") as f:
+            previous = json.load(f)
+        if previous.get("table") != table_name:
+            raise ValueError(f"{previous_dir} is a backup of {previous.get('table')}, not {table_name}")
+
+        since = datetime.fromisoformat(previous["high_water_mark"]) - timedelta(seconds=overlap_seconds)
+        parent = os.path.relpath(os.path.abspath(previous_dir), os.path.abspath(out_dir))
+        return self.backup_table_parallel(table_name, out_dir, since=since.isoformat(), parent=parent, **kwargs)
+
+    def backup_chain(self, backup_dir: str) -> List[str]:
+        """
+        Backup directories to replay for backup_dir: its full backup first, then every incremental
+        up to backup_dir, following the 'parent' links of the manifests.
+        """
+        chain = []
+        current = backup_dir
+        while True:
+            with open(os.path.join(current, self.MANIFEST), "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            chain.append(current)
+            if not manifest.get("parent"):
+                break
+            current = os.path.normpath(os.path.join(current, manifest["parent"]))
+            if current in chain:
+                raise ValueError(f"Backup chain of {backup_dir} loops at {current}")
+        chain.reverse()
+        return chain
+
+    def replay_backups(self, table_name: str, backup_dir: str, **kwargs: Any) -> List[Dict[str, Any]]:
+        """
+        Restore a full backup and its incrementals up to backup_dir, oldest first.
+        Each backup's items are written before its tombstones are applied.
+        kwargs go to restore_backup_parallel. Returns the stats of each backup.
+        """
+        results = []
+        for path in self.backup_chain(backup_dir):
+            print(f"[restore] Replaying {path}")
+            results.append(self.restore_backup_parallel(table_name, path, **kwargs))
+        return results
+
+    def verify_backup(self, backup_dir: str) -> Dict[str, Any]:
+        """
+        Check every part listed in the manifest against its sha256 and item count.
+        Raises ValueError on the first mismatch, returns the manifest otherwise.
+        """
+        with open(os.path.join(backup_dir, self.MANIFEST), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+
+        for part in manifest["parts"]:
+            path = os.path.join(backup_dir, part["file"])
+            if self._sha256_file(path) != part["sha256"]:
+                raise ValueError(f"{part['file']}: checksum mismatch")
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                count = sum(1 for line in f if line.strip())
+            if count != part["items"]:
+                raise ValueError(f"{part['file']}: {count} items, manifest says {part['items']}")
+        return manifest
+
     # -------------------------
     # Public: Restore
     # -------------------------
@@ -155,6 +496,225 @@ class DynamoBackupRestore:
         print(f"[restore] Done. Total items {'(dry-run) ' if dry_run else ''}processed: {total}")
         return total
 
+    def _backup_parts(self, in_path: str) -> List[str]:
+        # A parallel backup directory (parts listed in its manifest) or a single .jsonl / .jsonl.gz file
+        if not os.path.isdir(in_path):
+            return [in_path]
+        with open(os.path.join(in_path, self.MANIFEST), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        return [os.path.join(in_path, part["file"]) for part in manifest["parts"]]
+
+    @staticmethod
+    def _open_part(path: str):
+        if path.endswith(".gz"):
+            return gzip.open(path, "rt", encoding="utf-8")
+        return open(path, "r", encoding="utf-8")
+
+    def _write_requests(self, table_name: str, put_requests: List[Dict[str, Any]], limiter: AdaptiveLimiter) -> int:
+        """
+        One BatchWriteItem (<= 25 PutRequests in DynamoDB JSON) through the limiter, retried with
+        backoff until every request is processed. Returns the number of throttled attempts.
+        """
+        request_items = {table_name: put_requests}
+        backoff = 0.05
+        max_backoff = 16
+        throttled_attempts = 0
+        while request_items.get(table_name):
+            limiter.acquire()
+            try:
+                resp = self._client.batch_write_item(RequestItems=request_items, ReturnConsumedCapacity="TOTAL")
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code") not in THROTTLE_ERRORS:
+                    limiter.release()
+                    raise
+                limiter.release(throttled=True)
+                throttled_attempts += 1
+                time.sleep(backoff)
+                backoff = min(max_backoff, backoff * 2)
+                continue
+
+            capacity = sum(c.get("CapacityUnits", 0.0) for c in resp.get("ConsumedCapacity", []))
+            unprocessed = resp.get("UnprocessedItems", {}).get(table_name, [])
+            limiter.release(throttled=bool(unprocessed), capacity=capacity)
+            if not unprocessed:
+                break
+            throttled_attempts += 1
+            time.sleep(backoff)
+            backoff = min(max_backoff, backoff * 2)
+            request_items = {table_name: unprocessed}
+        return throttled_attempts
+
+    def _apply_tombstones(self, table_name: str, tombstones: List[Dict[str, Any]], limiter: AdaptiveLimiter) -> Tuple[int, int]:
+        """
+        Deletes the items the tombstones point at, unless the item was written again after the delete
+        (its 'modified' is newer than the tombstone's). Keys are the original ones: a transform that
+        changes keys does not apply to deletes.
+
+        Returns (deleted, kept).
+        """
+        def delete(tombstone: Dict[str, Any]) -> bool:
+            backoff = 0.05
+            while True:
+                limiter.acquire()
+                try:
+                    self._client.delete_item(
+                        TableName=table_name,
+                        Key=tombstone[TOMBSTONE_ATTRIBUTE]["M"],
+                        ConditionExpression="attribute_not_exists(#modified) OR #modified <= :deleted",
+                        ExpressionAttributeNames={"#modified": "modified"},
+                        ExpressionAttributeValues={":deleted": tombstone["modified"]},
+                    )
+                    limiter.release()
+                    return True
+                except ClientError as e:
+                    code = e.response.get("Error", {}).get("Code")
+                    limiter.release(throttled=code in THROTTLE_ERRORS)
+                    if code == "ConditionalCheckFailedException":
+                        return False
+                    if code not in THROTTLE_ERRORS:
+                        raise
+                    time.sleep(backoff)
+                    backoff = min(16, backoff * 2)
+
+        if not tombstones:
+            return 0, 0
+        # DeleteItem one by one (BatchWriteItem has no conditions), the limiter caps how many run at once
+        with ThreadPoolExecutor(max_workers=limiter.maximum) as pool:
+            results = list(pool.map(delete, tombstones))
+        deleted = sum(results)
+        return deleted, len(results) - deleted
+
+    def restore_backup_parallel(
+        self,
+        table_name: str,
+        in_path: str,
+        transform: Union[str, Callable[[Dict[str, Any]], Dict[str, Any]], None] = None,
+        readers: int = 4,
+        decoders: Optional[int] = None,
+        max_concurrency: int = 32,
+        initial_concurrency: int = 4,
+        capacity_per_second: Optional[float] = None,
+        chunk_lines: int = 2000,
+        verify: bool = False,
+        dry_run: bool = False,
+    ) -> Dict[str, Any]:
+        """
+        Restore a backup directory (backup_table_parallel) or a single JSONL file, as a pipeline:
+
+        - `readers` threads read part files concurrently, in chunks of `chunk_lines` lines
+        - a process pool of `decoders` processes (default: CPU count) parses, transforms and
+          re-serializes each chunk, so JSON and the transform do not compete for the GIL
+        - up to `max_concurrency` BatchWriteItem calls are in flight, the actual number set by an
+          AdaptiveLimiter from throttling and consumed capacity (`capacity_per_second` budget)
+
+        transform is a 'module:function' spec or a module level function (it is sent to the
+        decode processes, so lambdas and closures do not work).
+        verify checks the manifest checksums before writing anything.
+
+        Tombstones (rows with 'tombstone_of', see backup_incremental) are not written back: once every
+        item is in, they delete what they point at.
+
+        Returns counters: items, dropped, throttled, tombstones, deleted, kept, elapsed_seconds,
+        items_per_second, final_concurrency.
+        """
+        if verify and os.path.isdir(in_path):
+            self.verify_backup(in_path)
+        parts = self._backup_parts(in_path)
+
+        limiter = AdaptiveLimiter(initial=initial_concurrency, maximum=max_concurrency,
+                                  capacity_per_second=capacity_per_second)
+        lock = threading.Lock()
+        counters = {"items": 0, "dropped": 0, "throttled": 0, "reported": 0}
+        tombstones: List[Dict[str, Any]] = []
+        errors: List[BaseException] = []
+        # Batches waiting for a writer; bounds memory when decoding outruns the table
+        pending = threading.BoundedSemaphore(max_concurrency * 4)
+        started = time.monotonic()
+
+        def written(items: int, throttled: int) -> None:
+            with lock:
+                counters["items"] += items
+                counters["throttled"] += throttled
+                if counters["items"] - counters["reported"] >= 10000:
+                    counters["reported"] = counters["items"]
+                    elapsed = time.monotonic() - started
+                    print(f"[restore] {counters['items']} items, {counters['items'] / elapsed:.0f} items/s, "
+                          f"concurrency {int(limiter.limit)}, throttled {counters['throttled']}")
+
+        def write(batch: List[Dict[str, Any]]) -> None:
+            try:
+                if not errors:
+                    throttled = 0
+                    if not dry_run:
+                        throttled = self._write_requests(table_name, [{"PutRequest": {"Item": it}} for it in batch], limiter)
+                    written(len(batch), throttled)
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                pending.release()
+
+        def drain(future) -> None:
+            items, dropped, deleted = future.result()
+            with lock:
+                counters["dropped"] += dropped
+                tombstones.extend(deleted)
+            for i in range(0, len(items), 25):
+                pending.acquire()
+                write_pool.submit(write, items[i:i + 25])
+
+        def read_part(path: str) -> None:
+            # Two chunks in the decode pool per reader: one decoding while the other is written
+            decoding = deque()
+            lines: List[str] = []
+            try:
+                with self._open_part(path) as f:
+                    for line in f:
+                        if errors:
+                            return
+                        if not line.strip():
+                            continue
+                        lines.append(line)
+                        if len(lines) >= chunk_lines:
+                            decoding.append(decode_pool.submit(_decode_lines, lines, transform))
+                            lines = []
+                            if len(decoding) >= 2:
+                                drain(decoding.popleft())
+                if lines:
+                    decoding.append(decode_pool.submit(_decode_lines, lines, transform))
+                while decoding:
+                    drain(decoding.popleft())
+            except BaseException as e:
+                # Stops the other readers too
+                errors.append(e)
+
+        with ProcessPoolExecutor(max_workers=decoders) as decode_pool, \
+                ThreadPoolExecutor(max_workers=max_concurrency) as write_pool, \
+                ThreadPoolExecutor(max_workers=readers) as read_pool:
+            for future in [read_pool.submit(read_part, path) for path in parts]:
+                future.result()
+        if errors:
+            raise errors[0]
+
+        # After every put of this backup, so a delete never runs ahead of the write it follows
+        deleted, kept = (0, 0) if dry_run else self._apply_tombstones(table_name, tombstones, limiter)
+
+        elapsed = time.monotonic() - started
+        stats = {
+            "items": counters["items"],
+            "dropped": counters["dropped"],
+            "throttled": counters["throttled"],
+            "tombstones": len(tombstones),
+            "deleted": deleted,
+            "kept": kept,
+            "elapsed_seconds": round(elapsed, 3),
+            "items_per_second": round(counters["items"] / elapsed, 1) if elapsed else None,
+            "final_concurrency": int(limiter.limit),
+        }
+        print(f"[restore] Done. Total items {'(dry-run) ' if dry_run else ''}processed: {stats['items']} "
+              f"({stats['dropped']} dropped by transform, {stats['tombstones']} tombstones), "
+              f"{elapsed:.1f}s ({stats['items_per_second']} items/s)")
+        return stats
+
     # -------------------------
     # Utility: Load transform by "module:function" string
     # -------------------------
@@ -1,19 +1,45 @@
 # restore_table.py
 import argparse
+import os
 from dynamo_backup_restore import DynamoBackupRestore
 
 def main():
     ap = argparse.ArgumentParser(description="Restore items into a DynamoDB table from JSONL backup.")
     ap.add_argument("--table", required=True, help="Target table name (must already exist)")
-    ap.add_argument("--in", dest="in_path", required=True, help="Input file path (backup.jsonl)")
+    ap.add_argument("--in", dest="in_path", required=True, help="Input file path (backup.jsonl) or parallel backup directory")
     ap.add_argument("--profile", help="AWS profile name")
     ap.add_argument("--region", help="AWS region name")
+    ap.add_argument("--endpoint-url", help="DynamoDB endpoint (e.g., http://localhost:8000 for DynamoDB Local)")
     ap.add_argument("--transform", help="Optional 'module:function' to transform items before write")
     ap.add_argument("--batch-size", type=int, default=25, help="Batch write size (<=25)")
     ap.add_argument("--dry-run", action="store_true", help="Parse/transform only; do not write")
+    ap.add_argument("--parallel", action="store_true", help="Pipelined restore (implied for a backup directory)")
+    ap.add_argument("--readers", type=int, default=4, help="Part files read at a time")
+    ap.add_argument("--decoders", type=int, help="Decode/transform processes (default: CPU count)")
+    ap.add_argument("--max-concurrency", type=int, default=32, help="Upper bound of BatchWriteItem calls in flight")
+    ap.add_argument("--target-wcu", type=float, help="Write capacity units per second to stay under")
+    ap.add_argument("--verify", action="store_true", help="Check manifest checksums before restoring")
+    ap.add_argument("--chain", action="store_true", help="Replay the full backup and every incremental up to --in")
     args = ap.parse_args()
 
-    tool = DynamoBackupRestore(profile=args.profile, region=args.region)
+    tool = DynamoBackupRestore(profile=args.profile, region=args.region, endpoint_url=args.endpoint_url)
+    if args.parallel or args.chain or os.path.isdir(args.in_path):
+        # The transform spec is imported inside each decode process
+        DynamoBackupRestore.load_transform(args.transform)
+        restore = tool.replay_backups if args.chain else tool.restore_backup_parallel
+        restore(
+            args.table,
+            args.in_path,
+            transform=args.transform,
+            readers=args.readers,
+            decoders=args.decoders,
+            max_concurrency=args.max_concurrency,
+            capacity_per_second=args.target_wcu,
+            verify=args.verify,
+            dry_run=args.dry_run,
+        )
+        return
+
     transform_fn = DynamoBackupRestore.load_transform(args.transform)
     tool.restore_table_from_backup(
         table_name=args.table,
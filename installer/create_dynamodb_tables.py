@@ -2,6 +2,7 @@ import boto3
 import argparse
 import os
 import configparser
+import time
 from typing import Dict
 
 def get_available_aws_profiles():
@@ -34,10 +35,55 @@ def table_exists(dynamodb, table_name):
     except dynamodb.exceptions.ResourceNotFoundException:
         return False
 
-def create_table(dynamodb, table_name, partition_key, sort_key=None, local_secondary_indexes=None):
-    """Create a DynamoDB table with optional LSI indexes."""
+def global_index_params(index):
+    """GlobalSecondaryIndexes entry (keys are strings, on-demand billing)."""
+    projection = {"ProjectionType": index["ProjectionType"]}
+    if index["ProjectionType"] == "INCLUDE":
+        projection["NonKeyAttributes"] = index.get("NonKeyAttributes", [])
+        
+    return {
+        "IndexName": index["IndexName"],
+        "KeySchema": [
+            {"AttributeName": index["PartitionKey"], "KeyType": "HASH"},
+            {"AttributeName": index["SortKey"], "KeyType": "RANGE"},
+        ],
+        "Projection": projection,
+    }
+
+def add_missing_global_indexes(dynamodb, table_name, global_secondary_indexes):
+    """GSIs (unlike LSIs) can be added to an existing table. One index per UpdateTable call."""
+    response = dynamodb.describe_table(TableName=table_name)
+    existing = {index["IndexName"] for index in response["Table"].get("GlobalSecondaryIndexes", [])}
+    
+    for index in global_secondary_indexes:
+        if index["IndexName"] in existing:
+            continue
+        
+        print(f"🛠️  Adding global index '{index['IndexName']}' to {table_name}...")
+        dynamodb.update_table(
+            TableName=table_name,
+            AttributeDefinitions=[
+                {"AttributeName": index["PartitionKey"], "AttributeType": "S"},
+                {"AttributeName": index["SortKey"], "AttributeType": "S"},
+            ],
+            GlobalSecondaryIndexUpdates=[{"Create": global_index_params(index)}],
+        )
+        
+        # The next index can only be created once this one is active
+        while True:
+            response = dynamodb.describe_table(TableName=table_name)
+            status = {i["IndexName"]: i["IndexStatus"] for i in response["Table"].get("GlobalSecondaryIndexes", [])}
+            if status.get(index["IndexName"]) == "ACTIVE":
+                break
+            time.sleep(10)
+        print(f"✅ Global index '{index['IndexName']}' is now active.")
+
+def create_table(dynamodb, table_name, partition_key, sort_key=None, local_secondary_indexes=None, global_secondary_indexes=None):
+    """Create a DynamoDB table with optional LSI and GSI indexes."""
     if table_exists(dynamodb, table_name):
         print(f"✅ Table '{table_name}' already exists. Skipping creation.")
+        if global_secondary_indexes:
+            add_missing_global_indexes(dynamodb, table_name, global_secondary_indexes)
         return
 
     print(f"🛠️  Creating table: {table_name}...")
@@ -73,6 +119,15 @@ def create_table(dynamodb, table_name, partition_key, sort_key=None, local_secon
                 "Projection": projection,
             })
             attribute_definitions.append({"AttributeName": index["SortKey"], "AttributeType": "S"})
+            
+    # Add Global Secondary Indexes if provided
+    if global_secondary_indexes:
+        table_params["GlobalSecondaryIndexes"] = []
+        for index in global_secondary_indexes:
+            table_params["GlobalSecondaryIndexes"].append(global_index_params(index))
+            for key in (index["PartitionKey"], index["SortKey"]):
+                if key not in {a["AttributeName"] for a in attribute_definitions}:
+                    attribute_definitions.append({"AttributeName": key, "AttributeType": "S"})
 
     dynamodb.create_table(**table_params)
     print(f"⏳ Waiting for table '{table_name}' to become active...")
@@ -81,6 +136,17 @@ def create_table(dynamodb, table_name, partition_key, sort_key=None, local_secon
     waiter.wait(TableName=table_name)
     print(f"✅ Table '{table_name}' is now active.")
 
+def enable_time_to_live(dynamodb, table_name, attribute):
+    """Turn on DynamoDB TTL on an epoch seconds attribute (no-op if it already is)."""
+    response = dynamodb.describe_time_to_live(TableName=table_name)
+    if response["TimeToLiveDescription"].get("TimeToLiveStatus") in ("ENABLED", "ENABLING"):
+        return
+    dynamodb.update_time_to_live(
+        TableName=table_name,
+        TimeToLiveSpecification={"Enabled": True, "AttributeName": attribute},
+    )
+    print(f"✅ TTL on '{attribute}' enabled for '{table_name}'.")
+
 def run(env_name: str, aws_profile: str, region: str = "us-east-1") -> Dict[str, str]:
     """Programmatic entry point that returns structured data"""
     # Initialize Boto3 Session with selected profile
@@ -115,7 +181,14 @@ def run(env_name: str, aws_profile: str, region: str = "us-east-1") -> Dict[str,
         {"IndexName": "time_index", "SortKey": "time_index", "ProjectionType": "INCLUDE", "NonKeyAttributes": ["path_index"]},
     ]
     
-    create_table(dynamodb, data_table_name, "portfolio_index", "doc_index", local_secondary_indexes=data_table_lsis)
+    # Sorted listings: one partition per ring and sort field, ordered by the encoded value
+    data_table_gsis = [
+        {"IndexName": "sort_index", "PartitionKey": "sort_partition", "SortKey": "sort_index", "ProjectionType": "ALL"},
+    ]
+    
+    create_table(dynamodb, data_table_name, "portfolio_index", "doc_index", local_secondary_indexes=data_table_lsis, global_secondary_indexes=data_table_gsis)
+    # Tombstones of deleted items (kept for incremental backups) expire on their own
+    enable_time_to_live(dynamodb, data_table_name, "expires")
     response = dynamodb.describe_table(TableName=data_table_name)
     table_arns[data_table_name] = response["Table"]["TableArn"]
 
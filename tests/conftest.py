@@ -0,0 +1,103 @@
+#conftest.py
+import os
+import sys
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, TESTS_DIR)
+sys.path.insert(1, os.path.dirname(TESTS_DIR))
+
+# moto answers every call, these only keep botocore from looking for real credentials
+os.environ['AWS_ACCESS_KEY_ID'] = 'testing'
+os.environ['AWS_SECRET_ACCESS_KEY'] = 'testing'
+os.environ['AWS_SESSION_TOKEN'] = 'testing'
+os.environ['AWS_DEFAULT_REGION'] = 'us-east-1'
+
+import boto3
+from flask import Flask
+from flask_caching import Cache
+from moto import mock_aws
+
+import env_config
+
+
+KEY = [
+    {'AttributeName':'portfolio_index','KeyType':'HASH'},
+    {'AttributeName':'doc_index','KeyType':'RANGE'}
+]
+
+
+def create_data_table(client, name):
+
+    attributes = [
+        {'AttributeName':'portfolio_index','AttributeType':'S'},
+        {'AttributeName':'doc_index','AttributeType':'S'}
+    ]
+    indexes = []
+    for index in ('geo_index', 'path_index', 'time_index'):
+        attributes.append({'AttributeName':index,'AttributeType':'S'})
+        indexes.append({
+            'IndexName':index,
+            'KeySchema':[KEY[0], {'AttributeName':index,'KeyType':'RANGE'}],
+            'Projection':{'ProjectionType':'ALL'}
+        })
+
+    client.create_table(
+        TableName=name,
+        KeySchema=KEY,
+        AttributeDefinitions=attributes,
+        LocalSecondaryIndexes=indexes,
+        BillingMode='PAY_PER_REQUEST'
+    )
+
+
+@pytest.fixture
+def aws():
+
+    with mock_aws():
+        dynamodb = boto3.client('dynamodb', region_name='us-east-1')
+        dynamodb.create_table(
+            TableName=env_config.DYNAMODB_BLUEPRINT_TABLE,
+            KeySchema=[
+                {'AttributeName':'irn','KeyType':'HASH'},
+                {'AttributeName':'version','KeyType':'RANGE'}
+            ],
+            AttributeDefinitions=[
+                {'AttributeName':'irn','AttributeType':'S'},
+                {'AttributeName':'version','AttributeType':'S'}
+            ],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        create_data_table(dynamodb, env_config.DYNAMODB_RINGDATA_TABLE)
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket=env_config.S3_BUCKET_NAME)
+        yield dynamodb
+
+
+@pytest.fixture
+def app(aws):
+
+    app = Flask('tests')
+    app.config.from_object(env_config)
+    app.config['TESTING'] = True
+    app.config['CACHE_TYPE'] = 'SimpleCache'
+    app.cache = Cache(app)
+
+    with app.test_request_context():
+        yield app
+
+
+@pytest.fixture
+def add_blueprint(aws):
+
+    def add(name, fields):
+        table = boto3.resource('dynamodb', region_name='us-east-1').Table(env_config.DYNAMODB_BLUEPRINT_TABLE)
+        table.put_item(Item={
+            'irn':'irn:blueprint:irma:' + name,
+            'version':'1.0.0',
+            'uri':'u/' + name,
+            'name':name,
+            'fields':fields
+        })
+
+    return add
@@ -0,0 +1,39 @@
+#env_config.py
+# Settings for the test suite. conftest.py puts this directory first on sys.path so it is used
+# instead of a local env_config.py. Every AWS call is served by moto.
+
+WL_NAME='test'
+
+TANK_BASE_URL = 'http://localhost'
+TANK_FE_BASE_URL = 'http://localhost'
+TANK_DOC_BASE_URL = 'http://localhost'
+TANK_AWS_REGION = 'us-east-1'
+
+TANK_API_GATEWAY_ARN = 'x'
+TANK_ROLE_ARN = 'x'
+TANK_ENV = 'test'
+
+DYNAMODB_ENTITY_TABLE = 'test_entities'
+DYNAMODB_BLUEPRINT_TABLE = 'test_blueprints'
+DYNAMODB_RINGDATA_TABLE = 'test_data'
+DYNAMODB_REL_TABLE = 'test_rel'
+DYNAMODB_CHAT_TABLE = 'test_chat'
+
+CSRF_SESSION_KEY = 'test'
+SECRET_KEY = 'test'
+CURSOR_SECRET = ''
+
+COGNITO_REGION = 'us-east-1'
+COGNITO_USERPOOL_ID = 'x'
+COGNITO_APP_CLIENT_ID = 'x'
+COGNITO_CHECK_TOKEN_EXPIRATION = True
+
+PREVIEW_LAYER = 2
+
+S3_BUCKET_NAME = 'test-bucket'
+
+OPENAI_API_KEY=''
+
+WEBSOCKET_CONNECTIONS=''
+
+ALLOW_DEV_ORIGINS = False
@@ -0,0 +1,144 @@
+#test_backup_restore.py
+import gzip
+import hashlib
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'installer', 'backup'))
+
+from conftest import KEY
+from dynamo_backup_restore import DynamoBackupRestore
+
+
+PORTFOLIO = 'irn:data:p'
+SEGMENTS = 3
+
+
+def now():
+
+    # The app stamps 'modified' with naive UTC ISO times
+    return datetime.now(timezone.utc).replace(tzinfo=None).isoformat()
+
+
+@pytest.fixture
+def backups(aws):
+
+    for name in ('source', 'target'):
+        aws.create_table(
+            TableName=name,
+            KeySchema=KEY,
+            AttributeDefinitions=[
+                {'AttributeName':'portfolio_index','AttributeType':'S'},
+                {'AttributeName':'doc_index','AttributeType':'S'}
+            ],
+            BillingMode='PAY_PER_REQUEST'
+        )
+    return DynamoBackupRestore(region='us-east-1')
+
+
+def put(table, idx, value):
+
+    table.put_item(Item={'portfolio_index':PORTFOLIO, 'doc_index':f'o:r:{idx}', 'value':value, 'modified':now()})
+
+
+def delete(table, idx):
+
+    # Same rows DataModel.delete_a_b_c leaves behind
+    key = {'portfolio_index':PORTFOLIO, 'doc_index':f'o:r:{idx}'}
+    table.delete_item(Key=key)
+    table.put_item(Item={'portfolio_index':PORTFOLIO, 'doc_index':f'_tomb:o:r:{idx}', 'tombstone_of':key, 'modified':now()})
+
+
+def rows(backups, table_name):
+
+    table = backups._dynamodb.Table(table_name)
+    items = []
+    kwargs = {}
+    while True:
+        response = table.scan(**kwargs)
+        items += response['Items']
+        if 'LastEvaluatedKey' not in response:
+            break
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return {item['doc_index']:item for item in items if 'tombstone_of' not in item}
+
+
+def test_full_backup_manifest(backups, tmp_path):
+
+    table = backups._dynamodb.Table('source')
+    for idx in range(50):
+        put(table, idx, 0)
+
+    manifest = backups.backup_table_parallel('source', str(tmp_path), segments=SEGMENTS)
+
+    assert manifest['type'] == 'full'
+    assert manifest['total_segments'] == SEGMENTS
+    assert [part['segment'] for part in manifest['parts']] == list(range(SEGMENTS))
+    assert manifest['items'] == 50
+    for part in manifest['parts']:
+        with open(tmp_path / part['file'], 'rb') as f:
+            assert hashlib.sha256(f.read()).hexdigest() == part['sha256']
+    assert backups.verify_backup(str(tmp_path)) == manifest
+
+
+def test_verify_rejects_a_changed_part(backups, tmp_path):
+
+    table = backups._dynamodb.Table('source')
+    for idx in range(10):
+        put(table, idx, 0)
+    manifest = backups.backup_table_parallel('source', str(tmp_path), segments=SEGMENTS)
+
+    part = next(part for part in manifest['parts'] if part['items'])
+    path = tmp_path / part['file']
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        lines = f.readlines()
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        f.writelines(lines[:-1])
+
+    with pytest.raises(ValueError, match='checksum mismatch'):
+        backups.verify_backup(str(tmp_path))
+
+
+def test_incremental_replay_applies_tombstones(backups, tmp_path):
+
+    table = backups._dynamodb.Table('source')
+    full, first, second = (str(tmp_path / name) for name in ('full', 'inc1', 'inc2'))
+
+    for idx in range(100):
+        put(table, idx, 0)
+    backups.backup_table_parallel('source', full, segments=SEGMENTS)
+    time.sleep(0.01)
+
+    for idx in range(10):
+        put(table, idx, 1)
+    for idx in range(10, 15):
+        delete(table, idx)
+    manifest = backups.backup_incremental('source', first, full, overlap_seconds=0, segments=SEGMENTS)
+    assert manifest['type'] == 'incremental'
+    assert manifest['total_segments'] == SEGMENTS
+    assert manifest['items'] == 15
+    assert manifest['tombstones'] == 5
+    time.sleep(0.01)
+
+    # Deleted then written again: the item must survive the replay of its tombstone
+    delete(table, 20)
+    time.sleep(0.01)
+    put(table, 20, 2)
+    delete(table, 0)
+    manifest = backups.backup_incremental('source', second, first, overlap_seconds=0, segments=SEGMENTS)
+    assert manifest['tombstones'] == 2
+
+    assert backups.backup_chain(second) == [full, first, second]
+    results = backups.replay_backups('target', second, verify=True)
+    assert [result['tombstones'] for result in results] == [0, 5, 2]
+
+    source, target = rows(backups, 'source'), rows(backups, 'target')
+    assert target == source
+    assert 'o:r:0' not in target
+    assert 'o:r:12' not in target
+    assert target['o:r:20']['value'] == 2
+    assert target['o:r:5']['value'] == 1
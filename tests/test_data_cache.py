@@ -0,0 +1,181 @@
+#test_data_cache.py
+import time
+
+import pytest
+
+from app_data.data_cache import ITEM_CACHE, ItemCache, LocalSharedTier
+
+
+TTL = 30
+
+
+def test_lru_evicts_least_recently_used():
+
+    cache = ItemCache()
+    for idx in ('a', 'b', 'c'):
+        cache.set(idx, {'_id':idx}, TTL, 3)
+
+    # Touching 'a' makes 'b' the oldest entry
+    assert cache.get('a', TTL, 3) == {'_id':'a'}
+    cache.set('d', {'_id':'d'}, TTL, 3)
+
+    assert cache.get('b', TTL, 3) is None
+    assert [cache.get(idx, TTL, 3)['_id'] for idx in ('a', 'c', 'd')] == ['a', 'c', 'd']
+    assert cache.stats()['evictions'] == 1
+    assert cache.stats()['entries'] == 3
+
+
+def test_expired_entries_are_misses(monkeypatch):
+
+    cache = ItemCache()
+    cache.set('a', {'_id':'a'}, TTL, 10)
+
+    now = time.monotonic() + TTL + 1
+    monkeypatch.setattr('app_data.data_cache.time.monotonic', lambda: now)
+
+    assert cache.get('a', TTL, 10) is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_zero_ttl_disables_caching():
+
+    cache = ItemCache()
+    cache.set('a', {'_id':'a'}, 0, 10)
+
+    assert cache.get('a', 0, 10) is None
+
+
+def test_entries_are_isolated_from_callers():
+
+    cache = ItemCache()
+    item = {'_id':'a', 'tags':['x']}
+    cache.set('a', item, TTL, 10)
+
+    # Changing the original after set() does not reach the cache
+    item['tags'].append('y')
+    got = cache.get('a', TTL, 10)
+    assert got['tags'] == ['x']
+
+    # Neither does changing what get() returned
+    got['tags'].append('z')
+    assert cache.get('a', TTL, 10)['tags'] == ['x']
+
+
+def test_shared_tier_fills_local_cache():
+
+    shared = LocalSharedTier()
+    writer = ItemCache()
+    reader = ItemCache()
+    writer.set('a', {'_id':'a'}, TTL, 10, shared=shared)
+
+    assert reader.get('a', TTL, 10, shared=shared) == {'_id':'a'}
+    assert reader.get('a', TTL, 10, shared=shared) == {'_id':'a'}
+    stats = reader.stats()
+    assert stats['shared_hits'] == 1
+    assert stats['hits'] == 1
+
+
+def test_invalidate_drops_shared_entry():
+
+    shared = LocalSharedTier()
+    writer = ItemCache()
+    reader = ItemCache()
+    writer.set('a', {'_id':'a'}, TTL, 10, shared=shared)
+    writer.invalidate('a', shared=shared)
+
+    assert shared.get('a') is None
+    assert writer.get('a', TTL, 10, shared=shared) is None
+    assert reader.get('a', TTL, 10, shared=shared) is None
+
+
+def test_stale_read_is_not_cached_after_invalidation():
+
+    shared = LocalSharedTier()
+    cache = ItemCache()
+
+    # A read takes its ticket, a write lands before the read finishes
+    ticket = cache.ticket()
+    cache.invalidate('a', shared=shared)
+    cache.set('a', {'_id':'a', 'name':'old'}, TTL, 10, shared=shared, ticket=ticket)
+
+    assert cache.get('a', TTL, 10) is None
+    assert cache.stats()['skipped'] == 1
+
+    # A read that started after the write is cached
+    ticket = cache.ticket()
+    cache.set('a', {'_id':'a', 'name':'new'}, TTL, 10, shared=shared, ticket=ticket)
+    assert cache.get('a', TTL, 10)['name'] == 'new'
+
+
+def test_local_shared_tier_expires_entries(monkeypatch):
+
+    shared = LocalSharedTier()
+    shared.set('a', b'x', TTL)
+    assert shared.get('a') == b'x'
+
+    now = time.monotonic() + TTL + 1
+    monkeypatch.setattr('app_data.data_cache.time.monotonic', lambda: now)
+    assert shared.get('a') is None
+    assert 'a' not in shared.entries
+
+
+
+@pytest.fixture
+def controller(app, add_blueprint):
+
+    from app_data.data_controller import DataController
+
+    add_blueprint('books', [
+        {'name':'title','type':'string','default':'','required':False}
+    ])
+    app.config['ITEM_CACHE_TTL'] = TTL
+    app.config['ITEM_CACHE_MAX_ITEMS'] = 100
+    app.config['ITEM_CACHE_SHARED'] = LocalSharedTier()
+    ITEM_CACHE.clear()
+    yield DataController()
+    ITEM_CACHE.clear()
+
+
+def post(controller, title):
+
+    result, status = controller.post_a_b('p', 'o', 'books', {'title':title})
+    assert status == 200, result
+    return result['path'].split('/')[-1]
+
+
+def test_controller_serves_reads_from_cache(controller):
+
+    idx = post(controller, 'Dune')
+    hits = ITEM_CACHE.stats()['hits']
+
+    assert controller.get_a_b_c('p', 'o', 'books', idx)['title'] == 'Dune'
+    assert controller.get_a_b_c('p', 'o', 'books', idx)['title'] == 'Dune'
+    assert ITEM_CACHE.stats()['hits'] == hits + 1
+
+
+def test_controller_put_invalidates(app, controller):
+
+    idx = post(controller, 'Dune')
+    key = ITEM_CACHE.key('p', 'o', 'books', idx)
+    controller.get_a_b_c('p', 'o', 'books', idx)
+    assert app.config['ITEM_CACHE_SHARED'].get(key) is not None
+
+    result, status = controller.put_a_b_c('p', 'o', 'books', idx, {'title':'Dune Messiah'})
+    assert status == 200, result
+
+    assert app.config['ITEM_CACHE_SHARED'].get(key) is None
+    assert controller.get_a_b_c('p', 'o', 'books', idx)['title'] == 'Dune Messiah'
+
+
+def test_controller_delete_invalidates(app, controller):
+
+    idx = post(controller, 'Dune')
+    key = ITEM_CACHE.key('p', 'o', 'books', idx)
+    controller.get_a_b_c('p', 'o', 'books', idx)
+
+    result, status = controller.delete_a_b_c('p', 'o', 'books', idx)
+    assert status == 200, result
+
+    assert app.config['ITEM_CACHE_SHARED'].get(key) is None
+    assert ITEM_CACHE.get(key, TTL, 100) is None
+    assert 'title' not in controller.get_a_b_c('p', 'o', 'books', idx)